@@ -0,0 +1,160 @@
+"""Compares the time it takes to compute discordance columns in compare_flipbook_form_response_tables.py with the
+previous row-by-row implementation (DataFrame.apply(.., axis=1)) and with the current vectorized implementation, and
+checks that both produce the same output table.
+
+Two synthetic form response tables are generated with --rows rows each, where some paths are only in one of the tables
+and some responses are empty. Both the default schema (Verdict + Confidence columns) and the generic schema (any shared
+columns) are tested.
+
+Usage:
+    python3 benchmarks/benchmark_compare_form_response_tables.py --rows 300000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import compare_flipbook_form_response_tables as compare  # noqa: E402
+
+VERDICTS = ["", "normal", "intermediate", "full expansion", "double expansion"]
+CONFIDENCES = ["", "low", "high"]
+NOTES = ["", "", "", "check again", "low coverage", "ok"]
+GENERIC_COLUMNS = ["Verdict", "Confidence", "Notes", "Score"]
+
+
+def previous_default_schema_discordance_columns_func(suffix1, suffix2):
+    """Returns the row-by-row function that compare_flipbook_form_response_tables.py previously passed to
+    DataFrame.apply(.., axis=1)
+    """
+    verdict_column1 = f"Verdict {suffix1}"
+    verdict_column2 = f"Verdict {suffix2}"
+    confidence_column1 = f"Confidence {suffix1}"
+    confidence_column2 = f"Confidence {suffix2}"
+
+    def compute_discordance_columns(row):
+        if not row[verdict_column1] or not row[verdict_column2]:
+            return row
+
+        if row[verdict_column1] == row[verdict_column2]:
+            row[compare.DISCORDANT_VERDICT_COLUMN] = 0
+            row[compare.DISCORDANT_SCORE_COLUMN] = 0
+            row[compare.DISCORDANT_TEXT_COLUMN] = "same verdict"
+            if row[confidence_column1] and row[confidence_column2]:
+                if row[confidence_column1] == compare.HIGH_CONFIDENCE and row[confidence_column2] == compare.HIGH_CONFIDENCE:
+                    row[compare.DISCORDANT_SCORE_COLUMN] = 0
+                    row[compare.DISCORDANT_TEXT_COLUMN] = "same verdict, both high confidence"
+                elif row[confidence_column1] == compare.HIGH_CONFIDENCE or row[confidence_column2] == compare.HIGH_CONFIDENCE:
+                    row[compare.DISCORDANT_SCORE_COLUMN] = 1
+                    row[compare.DISCORDANT_TEXT_COLUMN] = "same verdict, one high confidence"
+                else:
+                    row[compare.DISCORDANT_SCORE_COLUMN] = 0
+                    row[compare.DISCORDANT_TEXT_COLUMN] = "same verdict, zero high confidence"
+        else:
+            row[compare.DISCORDANT_VERDICT_COLUMN] = 1
+            row[compare.DISCORDANT_SCORE_COLUMN] = 2
+            row[compare.DISCORDANT_TEXT_COLUMN] = "different verdict"
+            if row[confidence_column1] or row[confidence_column2]:
+                if row[confidence_column1] == compare.HIGH_CONFIDENCE and row[confidence_column2] == compare.HIGH_CONFIDENCE:
+                    row[compare.DISCORDANT_SCORE_COLUMN] = 4
+                    row[compare.DISCORDANT_TEXT_COLUMN] = "different verdict, both high confidence"
+                elif row[confidence_column1] == compare.HIGH_CONFIDENCE or row[confidence_column2] == compare.HIGH_CONFIDENCE:
+                    row[compare.DISCORDANT_SCORE_COLUMN] = 3
+                    row[compare.DISCORDANT_TEXT_COLUMN] = "different verdict, one high confidence"
+                else:
+                    row[compare.DISCORDANT_SCORE_COLUMN] = 2
+                    row[compare.DISCORDANT_TEXT_COLUMN] = "different verdict, zero high confidence"
+
+        return row
+
+    return compute_discordance_columns
+
+
+def previous_generic_schema_discordance_columns_func(columns_to_compare, suffix1, suffix2):
+    def compute_discordance_columns(row):
+        for column in columns_to_compare:
+            column1 = f"{column} {suffix1}"
+            column2 = f"{column} {suffix2}"
+            if row[column1] == row[column2]:
+                row[f"{column} diff"] = ""
+                row[f"{column} diff score"] = 0
+            else:
+                row[f"{column} diff"] = f"{row[column1]} ({suffix1}), {row[column2]} ({suffix2})"
+                row[f"{column} diff score"] = 1
+
+        return row
+
+    return compute_discordance_columns
+
+
+def generate_table(rng, num_rows):
+    """Returns a form response table with the same index and missing values as after compare.parse_args(..)"""
+    paths = [f"dir{i}/subdir" for i in rng.choice(int(num_rows * 1.2), size=num_rows, replace=False)]
+    df = pd.DataFrame({
+        compare.PATH_COLUMN: paths,
+        "Verdict": rng.choice(VERDICTS, size=num_rows, p=[0.1, 0.5, 0.2, 0.1, 0.1]),
+        "Confidence": rng.choice(CONFIDENCES, size=num_rows),
+        "Notes": rng.choice(NOTES, size=num_rows),
+        "Score": rng.integers(0, 3, size=num_rows),
+    })
+
+    return df.set_index(compare.PATH_COLUMN).fillna("")
+
+
+def join_tables(df1, df2, suffix1, suffix2):
+    df_joined = df1.join(df2, lsuffix=f" {suffix1}", rsuffix=f" {suffix2}", how="outer").reset_index()
+    return df_joined.fillna("")
+
+
+def time_function(function):
+    start_time = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start_time
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--rows", type=int, default=100_000, help="Number of rows in each synthetic table")
+    p.add_argument("--seed", type=int, default=0, help="Random seed for generating the tables")
+    args = p.parse_args()
+
+    suffix1, suffix2 = "1", "2"
+    rng = np.random.default_rng(args.seed)
+    df_joined = join_tables(generate_table(rng, args.rows), generate_table(rng, args.rows), suffix1, suffix2)
+    print(f"Comparing 2 tables with {args.rows} rows each ({len(df_joined)} rows after joining on {compare.PATH_COLUMN}):\n")
+
+    def run_previous_default_schema():
+        return df_joined.copy().apply(previous_default_schema_discordance_columns_func(suffix1, suffix2), axis=1)
+
+    def run_vectorized_default_schema():
+        return compare.compute_default_schema_discordance_columns(df_joined.copy(), suffix1, suffix2)
+
+    def run_previous_generic_schema():
+        return df_joined.copy().apply(
+            previous_generic_schema_discordance_columns_func(GENERIC_COLUMNS, suffix1, suffix2), axis=1)
+
+    def run_vectorized_generic_schema():
+        df = df_joined.copy()
+        compare.compute_generic_schema_discordance_columns(df, GENERIC_COLUMNS, suffix1, suffix2)
+        return df
+
+    print(f"{'schema':15s} {'row-by-row seconds':>20s} {'vectorized seconds':>20s} {'speedup':>10s} {'same output':>12s}")
+    for schema, run_previous, run_vectorized in [
+        ("default", run_previous_default_schema, run_vectorized_default_schema),
+        ("generic", run_previous_generic_schema, run_vectorized_generic_schema),
+    ]:
+        df_previous, previous_time = time_function(run_previous)
+        df_vectorized, vectorized_time = time_function(run_vectorized)
+        same_output = df_previous.to_csv(sep="\t", index=False) == df_vectorized.to_csv(sep="\t", index=False)
+        print(f"{schema:15s} {previous_time:20.2f} {vectorized_time:20.3f} {previous_time / vectorized_time:9.0f}x "
+              f"{str(same_output):>12s}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""Compares the throughput of serving large data files with flask.send_from_directory(..) (the previous way FlipBook
+served them) and with file_server.send_file_from_directory(..), which uses zero-copy transfers.
+
+For each method, a server is started in a separate process, and --concurrency threads download the test files over
+keep-alive connections until --requests downloads have completed. The server process's CPU time is measured when it
+exits.
+
+Usage:
+    python3 benchmarks/benchmark_file_serving.py --file-size-mb 20 --concurrency 16
+    python3 benchmarks/benchmark_file_serving.py --server gunicorn
+"""
+
+import argparse
+import concurrent.futures
+import http.client
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SEND_FROM_DIRECTORY_METHOD = "send_from_directory"
+ZERO_COPY_METHOD = "zero-copy"
+
+SERVER_SCRIPT = """
+import sys
+from flask import Flask, send_from_directory
+from flipbook.file_server import send_file_from_directory
+
+method, server, port, directory, threads = sys.argv[1], sys.argv[2], int(sys.argv[3]), sys.argv[4], int(sys.argv[5])
+app = Flask(__name__, static_folder=None)
+
+@app.route("/<path:path>")
+def send_file(path):
+    if method == "send_from_directory":
+        return send_from_directory(directory, path, conditional=True, etag=True)
+    return send_file_from_directory(directory, path)
+
+if server == "gunicorn":
+    from flipbook.production_server import run_production_server
+    run_production_server(app, "127.0.0.1", port, 1, threads, lambda app: None)
+else:
+    from werkzeug.serving import run_simple
+    run_simple("127.0.0.1", port, app, threaded=True)
+"""
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    start_time = time.time()
+    while time.time() - start_time < timeout:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+
+    sys.exit(f"Server didn't start listening on port {port} within {timeout} seconds")
+
+
+def download_files(port, paths, file_size):
+    """Downloads the given paths over one keep-alive connection, and returns the number of bytes received"""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    total_bytes = 0
+    try:
+        for path in paths:
+            conn.request("GET", f"/{path}")
+            response = conn.getresponse()
+            num_bytes = 0
+            while True:
+                data = response.read(1024 * 1024)
+                if not data:
+                    break
+                num_bytes += len(data)
+            if response.status != 200 or num_bytes != file_size:
+                raise ValueError(f"Unexpected response for {path}: status {response.status}, {num_bytes} bytes")
+            total_bytes += num_bytes
+    finally:
+        conn.close()
+
+    return total_bytes
+
+
+def run_benchmark(method, args, directory, filenames, file_size, env):
+    port = get_free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-c", SERVER_SCRIPT, method, args.server, str(port), directory, str(args.concurrency)],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+
+        paths = [filenames[i % len(filenames)] for i in range(args.requests)]
+        paths_per_thread = [paths[i::args.concurrency] for i in range(args.concurrency)]
+        start_time = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(args.concurrency) as executor:
+            total_bytes = sum(executor.map(lambda p: download_files(port, p, file_size), paths_per_thread))
+        elapsed_time = time.perf_counter() - start_time
+    finally:
+        server.send_signal(signal.SIGINT if args.server == "werkzeug" else signal.SIGTERM)
+
+    # the resource usage of the server process includes its worker processes
+    _, _, rusage = os.wait4(server.pid, 0)
+    cpu_time = rusage.ru_utime + rusage.ru_stime
+
+    return total_bytes, elapsed_time, cpu_time
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--files", type=int, default=8, help="Number of test files")
+    p.add_argument("--file-size-mb", type=float, default=10, help="Size of each test file in megabytes")
+    p.add_argument("--requests", type=int, default=200, help="Total number of downloads")
+    p.add_argument("--concurrency", type=int, default=8, help="Number of downloads in flight at the same time")
+    p.add_argument("--server", choices=("werkzeug", "gunicorn"), default="werkzeug", help="'werkzeug' is Flask's "
+                   "development server, which FlipBook uses by default. 'gunicorn' is used with --workers.")
+    args = p.parse_args()
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([REPO_DIR] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+
+    file_size = int(args.file_size_mb * 1024 * 1024)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filenames = []
+        for i in range(args.files):
+            filenames.append(f"image{i}.png")
+            with open(os.path.join(temp_dir, filenames[-1]), "wb") as f:
+                f.write(os.urandom(file_size))
+
+        print(f"Downloading {args.requests} x {args.file_size_mb:g} MB files with {args.concurrency} concurrent "
+              f"connections from {args.server}:\n")
+        print(f"{'method':25s} {'MB/s':>10s} {'seconds':>10s} {'server CPU seconds':>20s}")
+        for method in SEND_FROM_DIRECTORY_METHOD, ZERO_COPY_METHOD:
+            total_bytes, elapsed_time, cpu_time = run_benchmark(method, args, temp_dir, filenames, file_size, env)
+            print(f"{method:25s} {total_bytes / 1024**2 / elapsed_time:10.1f} {elapsed_time:10.2f} {cpu_time:20.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Compares how long it takes to load a large metadata table from .tsv, .parquet and .feather files, and to convert
+its rows to the per-page metadata dicts that FlipBook uses.
+
+Usage:
+    python3 benchmarks/benchmark_metadata_table.py --rows 500000
+
+Parquet and Feather timings require the optional 'pyarrow' package.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from flipbook import tables  # noqa: E402
+
+
+def create_table(num_rows, num_columns):
+    rng = np.random.default_rng(0)
+    data = {tables.PATH_COLUMN: [f"sample{i // 100}/locus{i}" for i in range(num_rows)]}
+    for j in range(num_columns):
+        if j % 3 == 0:
+            data[f"int_column{j}"] = rng.integers(0, 1000, size=num_rows)
+        elif j % 3 == 1:
+            data[f"float_column{j}"] = rng.random(size=num_rows)
+        else:
+            data[f"str_column{j}"] = [f"value{v}" for v in rng.integers(0, 100, size=num_rows)]
+
+    return pd.DataFrame(data)
+
+
+def ingest_with_iterrows(df):
+    """The previous way of converting table rows to metadata dicts"""
+    relative_directory_to_metadata = {}
+    for relative_directory, row in df.iterrows():
+        relative_directory_to_metadata[relative_directory] = {
+            k: v for k, v in row.to_dict().items() if k != tables.PATH_COLUMN}
+    return relative_directory_to_metadata
+
+
+def ingest(df):
+    columns = [c for c in df.columns if c != tables.PATH_COLUMN]
+    return dict(tables.get_table_rows(df, columns))
+
+
+def time_it(label, function, *args):
+    start_time = time.perf_counter()
+    result = function(*args)
+    print(f"{label:45s} {time.perf_counter() - start_time:8.2f} seconds")
+    return result
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--rows", type=int, default=500_000, help="Number of rows in the metadata table")
+    p.add_argument("--columns", type=int, default=10, help="Number of metadata columns")
+    p.add_argument("--projected-columns", type=int, default=2, help="Number of columns to load when benchmarking "
+                   "column projection")
+    p.add_argument("--skip-iterrows", action="store_true", help="Don't time the previous df.iterrows() approach, "
+                   "which can take minutes for large tables")
+    args = p.parse_args()
+
+    df = create_table(args.rows, args.columns)
+    projected_columns = [c for c in df.columns if c != tables.PATH_COLUMN][:args.projected_columns]
+    print(f"Metadata table with {args.rows:,d} rows and {args.columns} columns")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        paths = [os.path.join(temp_dir, "flipbook_metadata.tsv")]
+        df.to_csv(paths[0], sep="\t", index=False)
+        if tables.is_pyarrow_available():
+            paths.append(os.path.join(temp_dir, "flipbook_metadata.parquet"))
+            df.to_parquet(paths[-1], index=False)
+            paths.append(os.path.join(temp_dir, "flipbook_metadata.feather"))
+            df.to_feather(paths[-1])
+        else:
+            print("NOTE: pyarrow isn't installed, so only the .tsv format will be benchmarked")
+
+        for path in paths:
+            print(f"\n{os.path.basename(path)} ({os.path.getsize(path) / 10**6:0.1f} MB):")
+            parsed_df = time_it("parse_table(..)", tables.parse_table, path)
+            if not args.skip_iterrows:
+                time_it("convert rows with df.iterrows()", ingest_with_iterrows, parsed_df)
+            time_it("convert rows with get_table_rows(..)", ingest, parsed_df)
+
+            parsed_df = time_it(f"parse_table(..) with {len(projected_columns)} columns",
+                                tables.parse_table, path, projected_columns)
+            time_it("convert rows with get_table_rows(..)", ingest, parsed_df)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Measures how long FlipBook takes to start up:
+
+    --help           time for 'python3 -m flipbook --help' to exit
+    import           time to import the flipbook package
+    full scan        time for create_app(..) to find all pages and load their metadata
+    first response   time from the start of the process until the home page and the 1st data page have been returned
+
+Each step runs in a new python process, so imports aren't cached between runs. The directory has --pages
+subdirectories, each with an image and a flipbook_metadata.json file.
+
+Usage:
+    python3 benchmarks/benchmark_startup.py --pages 20000
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 1x1 pixel png
+PNG_DATA = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44ae426082")
+
+STARTUP_SCRIPT = """
+import sys, time, json
+start_time = time.perf_counter()
+import flipbook
+import_time = time.perf_counter() - start_time
+app = flipbook.create_app(sys.argv[1:])
+scan_time = time.perf_counter() - start_time - import_time
+client = app.test_client()
+assert client.get("/").status_code == 200
+assert client.get("/page?i=1&last=1").status_code == 200
+first_response_time = time.perf_counter() - start_time
+print(json.dumps({"import": import_time, "full scan": scan_time, "first response": first_response_time}))
+"""
+
+
+def create_directory(top_level_dir, num_pages):
+    for i in range(num_pages):
+        page_dir = os.path.join(top_level_dir, f"sample{i // 1000}", f"locus{i}")
+        os.makedirs(page_dir)
+        with open(os.path.join(page_dir, "image.png"), "wb") as f:
+            f.write(PNG_DATA)
+        with open(os.path.join(page_dir, "flipbook_metadata.json"), "wt") as f:
+            json.dump({"coverage": i % 50, "sample": f"sample{i // 1000}"}, f)
+
+
+def run(command, env):
+    start_time = time.perf_counter()
+    result = subprocess.run(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    elapsed_time = time.perf_counter() - start_time
+    if result.returncode != 0:
+        sys.exit(f"{' '.join(command)} failed:\n{result.stderr}")
+
+    return elapsed_time, result.stdout
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--pages", type=int, default=10_000, help="Number of pages in the test directory")
+    p.add_argument("--repeats", type=int, default=5, help="Number of times to run each step. The median is reported.")
+    p.add_argument("flipbook_args", nargs="*", help="Additional args to pass to flipbook, eg. --lazy-metadata")
+    args = p.parse_args()
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([REPO_DIR] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+    # don't let a ~/.flipbook_config file change the results
+    env["HOME"] = tempfile.gettempdir()
+
+    timings = {"--help": [], "import": [], "full scan": [], "first response": []}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        print(f"Creating {args.pages:,d} pages in {temp_dir}")
+        create_directory(temp_dir, args.pages)
+        for _ in range(args.repeats):
+            elapsed_time, _ = run([sys.executable, "-m", "flipbook", "--help"], env)
+            timings["--help"].append(elapsed_time)
+
+            table_path = os.path.join(temp_dir, "flipbook_form_responses.tsv")
+            _, output = run([sys.executable, "-c", STARTUP_SCRIPT, temp_dir, "-t", table_path] + args.flipbook_args, env)
+            for name, elapsed_time in json.loads(output.strip().split("\n")[-1]).items():
+                timings[name].append(elapsed_time)
+
+    print(f"\nMedian of {args.repeats} runs:")
+    for name, values in timings.items():
+        print(f"{name:20s} {statistics.median(values):8.3f} seconds")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,12 @@
 import argparse
-import collections
+import concurrent.futures
 import json
+import numpy as np
 import pandas as pd
 import sys
+import time
+
+from pandas.api.types import union_categoricals
 
 PATH_COLUMN = "Path"
 
@@ -11,19 +15,49 @@ HIGH_CONFIDENCE = "high"
 DISCORDANT_VERDICT_COLUMN = "Discordant Verdict"
 DISCORDANT_SCORE_COLUMN = "Discordance Score"
 DISCORDANT_TEXT_COLUMN = "Discordance Text"
+DISAGREEMENT_SCORE_COLUMN = "Disagreement Score"
 
 
 def parse_args():
-    p = argparse.ArgumentParser(description="Check concordance between two form response tables created by 2 users "
-        "reviewing the same images. Rows in the two tables are matched by their same Path column.")
-    p.add_argument("-j", "--form-schema-json", help="Optionally provide the flipbook schema JSON used to generate the 2 tables")
-    p.add_argument("-s1", "--suffix1", help="Suffix to append to column names from table1", default="1")
-    p.add_argument("-s2", "--suffix2", help="Suffix to append to column names from table2", default="2")
+    p = argparse.ArgumentParser(description="Check concordance between form response tables created by 2 or more users "
+        "reviewing the same images. Rows in the tables are matched by their same Path column. When comparing more than "
+        "2 tables (or with --n-way), inter-rater agreement statistics are computed for each question instead of diffs.")
+    p.add_argument("-j", "--form-schema-json", help="Optionally provide the flipbook schema JSON used to generate the tables")
+    p.add_argument("-s1", "--suffix1", help="Suffix to append to column names from table1 when comparing 2 tables", default="1")
+    p.add_argument("-s2", "--suffix2", help="Suffix to append to column names from table2 when comparing 2 tables", default="2")
+    p.add_argument("-n", "--name", dest="names", action="append", help="Reviewer name for each table, in the same order "
+        "as the tables. When comparing more than 2 tables (or with --n-way), it's appended to the column names from "
+        "that table. Default: 1, 2, 3, etc.")
+    p.add_argument("--n-way", action="store_true", help="Compute inter-rater agreement statistics (Fleiss' and Cohen's "
+        "kappa, the most common response, and a ranking of the paths with the most disagreement) even when comparing "
+        "2 tables. This is always done when comparing more than 2 tables.")
+    p.add_argument("--threads", type=int, default=8, help="Max number of tables to load at the same time when "
+        "comparing more than 2 tables")
+    p.add_argument("--chunk-size", type=int, default=100_000, help="When comparing more than 2 tables, .tsv tables "
+        "are read this many rows at a time, and only the columns being compared are kept")
+    p.add_argument("--top", type=int, default=10, help="Number of paths with the most disagreement to print when "
+        "comparing more than 2 tables")
     p.add_argument("-o", "--output-table", help="Path of output .tsv or .xls", default="combined.tsv")
-    p.add_argument("table1", help="Path of form response table .tsv")
-    p.add_argument("table2", help="Path of form response table .tsv")
+    p.add_argument("tables", nargs="+", metavar="table", help="Paths of 2 or more form response tables (.tsv or .xls)")
     args = p.parse_args()
 
+    if len(args.tables) < 2:
+        p.error("At least 2 tables are required")
+
+    if args.form_schema_json:
+        try:
+            with open(args.form_schema_json, "rt") as f:
+                args.form_schema_json = json.load(f)
+
+        except Exception as e:
+            p.error(f"Error parsing {args.form_schema_json}: {e}")
+
+    args.n_way = args.n_way or len(args.tables) > 2
+    if args.n_way:
+        return args, load_tables_for_n_way_comparison(p, args)
+
+    args.table1, args.table2 = args.tables
+
     try:
         if args.table1.endswith(".xls") or args.table1.endswith(".xlsx"):
             df1 = pd.read_excel(args.table1, engine="openpyxl")
@@ -40,14 +74,6 @@ def parse_args():
     except Exception as e:
         p.error(f"Error parsing {args.table2}: {e}")
 
-    if args.form_schema_json:
-        try:
-            with open(args.form_schema_json, "rt") as f:
-                args.form_schema_json = json.load(f)
-
-        except Exception as e:
-            p.error(f"Error parsing {args.form_schema_json}: {e}")
-
     if PATH_COLUMN not in df1.columns:
         p.error(f"{args.table1} is missing a '{PATH_COLUMN}' column")
 
@@ -67,88 +93,95 @@ def parse_args():
         p.error(f"{args.table1} {PATH_COLUMN} column values have 0 overlap with {args.table2} {PATH_COLUMN} column "
                 f"values. Tables can only be combined if they have the same Paths.")
 
-    return args, df1, df2
-
-
-def compute_default_schema_discordance_columns_func(suffix1, suffix2):
-    verdict_column1 = f"Verdict {suffix1}"
-    verdict_column2 = f"Verdict {suffix2}"
-    confidence_column1 = f"Confidence {suffix1}"
-    confidence_column2 = f"Confidence {suffix2}"
-
-    def compute_discordance_columns(row):
-        if not row[verdict_column1] or not row[verdict_column2]:
-            return row
-
-        if row[verdict_column1] == row[verdict_column2]:
-            # same verdict
-            row[DISCORDANT_VERDICT_COLUMN] = 0
-            row[DISCORDANT_SCORE_COLUMN] = 0
-            row[DISCORDANT_TEXT_COLUMN] = "same verdict"
-            if row[confidence_column1] and row[confidence_column2]:
-                if row[confidence_column1] == HIGH_CONFIDENCE and row[confidence_column2] == HIGH_CONFIDENCE:
-                    row[DISCORDANT_SCORE_COLUMN] = 0
-                    row[DISCORDANT_TEXT_COLUMN] = "same verdict, both high confidence"
-                elif row[confidence_column1] == HIGH_CONFIDENCE or row[confidence_column2] == HIGH_CONFIDENCE:
-                    row[DISCORDANT_SCORE_COLUMN] = 1
-                    row[DISCORDANT_TEXT_COLUMN] = "same verdict, one high confidence"
-                else:
-                    row[DISCORDANT_SCORE_COLUMN] = 0
-                    row[DISCORDANT_TEXT_COLUMN] = "same verdict, zero high confidence"
-        else:
-            # different verdicts
-            row[DISCORDANT_VERDICT_COLUMN] = 1
-            row[DISCORDANT_SCORE_COLUMN] = 2
-            row[DISCORDANT_TEXT_COLUMN] = "different verdict"
-            if row[confidence_column1] or row[confidence_column2]:
-                if row[confidence_column1] == HIGH_CONFIDENCE and row[confidence_column2] == HIGH_CONFIDENCE:
-                    row[DISCORDANT_SCORE_COLUMN] = 4
-                    row[DISCORDANT_TEXT_COLUMN] = "different verdict, both high confidence"
-                elif row[confidence_column1] == HIGH_CONFIDENCE or row[confidence_column2] == HIGH_CONFIDENCE:
-                    row[DISCORDANT_SCORE_COLUMN] = 3
-                    row[DISCORDANT_TEXT_COLUMN] = "different verdict, one high confidence"
-                else:
-                    row[DISCORDANT_SCORE_COLUMN] = 2
-                    row[DISCORDANT_TEXT_COLUMN] = "different verdict, zero high confidence"
-
-        return row
-
-    return compute_discordance_columns
-
-
-def compute_generic_schema_discordance_columns_func(columns_to_compare, suffix1, suffix2):
-
-    def compute_discordance_columns(row):
-        for column in columns_to_compare:
-            column1 = f"{column} {suffix1}"
-            column2 = f"{column} {suffix2}"
-            if row[column1] == row[column2]:
-                row[f"{column} diff"] = ""
-                row[f"{column} diff score"] = 0
-            else:
-                row[f"{column} diff"] = f"{row[column1]} ({suffix1}), {row[column2]} ({suffix2})"
-                row[f"{column} diff score"] = 1
-
-        return row
-
-    return compute_discordance_columns
+    return args, [df1, df2]
+
+
+def compute_default_schema_discordance_columns(df_joined, suffix1, suffix2):
+    """Adds the DISCORDANT_VERDICT_COLUMN, DISCORDANT_SCORE_COLUMN and DISCORDANT_TEXT_COLUMN columns to the joined
+    table. Rows that don't have a verdict from both tables are left empty in these columns.
+
+    Args:
+        df_joined (pd.DataFrame): the outer join of the 2 tables, with empty strings instead of missing values
+        suffix1 (str): suffix of column names from table1
+        suffix2 (str): suffix of column names from table2
+
+    Return:
+        pd.DataFrame: the joined table with the discordance columns
+    """
+    verdict1 = df_joined[f"Verdict {suffix1}"]
+    verdict2 = df_joined[f"Verdict {suffix2}"]
+    confidence1 = df_joined[f"Confidence {suffix1}"]
+    confidence2 = df_joined[f"Confidence {suffix2}"]
+
+    has_both_verdicts = verdict1.astype(bool) & verdict2.astype(bool)
+    same_verdict = (verdict1 == verdict2).to_numpy()
+    has_both_confidences = (confidence1.astype(bool) & confidence2.astype(bool)).to_numpy()
+    has_any_confidence = (confidence1.astype(bool) | confidence2.astype(bool)).to_numpy()
+    num_high_confidence = ((confidence1 == HIGH_CONFIDENCE).astype(int) + (confidence2 == HIGH_CONFIDENCE).astype(int)).to_numpy()
+
+    #  same verdict:       0, or 1 if only one of the reviewers had high confidence
+    #  different verdicts: 2 + the number of reviewers that had high confidence
+    discordance_score = np.where(
+        same_verdict,
+        np.where(has_both_confidences & (num_high_confidence == 1), 1, 0),
+        np.where(has_any_confidence, 2 + num_high_confidence, 2))
+
+    confidence_text = np.select(
+        [num_high_confidence == 2, num_high_confidence == 1],
+        ["both high confidence", "one high confidence"],
+        "zero high confidence")
+    discordance_text = np.where(
+        same_verdict,
+        np.where(has_both_confidences, np.char.add("same verdict, ", confidence_text), "same verdict"),
+        np.where(has_any_confidence, np.char.add("different verdict, ", confidence_text), "different verdict"))
+
+    df_joined[DISCORDANT_VERDICT_COLUMN] = pd.Series(
+        (~same_verdict).astype(int), index=df_joined.index).where(has_both_verdicts)
+    df_joined[DISCORDANT_SCORE_COLUMN] = pd.Series(discordance_score, index=df_joined.index).where(has_both_verdicts)
+    df_joined[DISCORDANT_TEXT_COLUMN] = pd.Series(discordance_text, index=df_joined.index).where(has_both_verdicts)
+
+    if not has_both_verdicts.all():
+        # keep the same column order as previous versions, which computed these columns one row at a time and so
+        # ended up with the columns in alphabetical order when some rows were missing them
+        df_joined = df_joined[sorted(df_joined.columns)]
+
+    return df_joined
+
+
+def compute_generic_schema_discordance_columns(df_joined, columns_to_compare, suffix1, suffix2):
+    """Adds a "<column> diff" and a "<column> diff score" column to the joined table for each column being compared.
+
+    Args:
+        df_joined (pd.DataFrame): the outer join of the 2 tables, with empty strings instead of missing values
+        columns_to_compare (set): names of the columns to compare
+        suffix1 (str): suffix of column names from table1
+        suffix2 (str): suffix of column names from table2
+    """
+    for column in columns_to_compare:
+        column1 = df_joined[f"{column} {suffix1}"]
+        column2 = df_joined[f"{column} {suffix2}"]
+        is_same = (column1 == column2).to_numpy()
+        diff = column1.astype(str) + f" ({suffix1}), " + column2.astype(str) + f" ({suffix2})"
+        df_joined[f"{column} diff"] = np.where(is_same, "", diff)
+        df_joined[f"{column} diff score"] = (~is_same).astype(int)
+
 
 def get_counts_string(df, column, label="", sep=", ", prefix=""):
     label = f"{label} " if label else ""
     return sep.join(
-        [f"{prefix}{count} {label}{key}" for key, count in sorted(collections.Counter(df[column].fillna("<empty>")).items())])
+        [f"{prefix}{count} {label}{key}" for key, count in sorted(df[column].fillna("<empty>").value_counts(sort=False).items())])
 
 
 def compare_tables_with_default_schema(args, df1, df2):
     #  print stats about input tables
     df1_verdicts_counter = get_counts_string(df1, "Verdict")
-    df1_num_verdicts = sum(df1['Verdict'].str.len() > 0)
-    df1_num_high_confidence = collections.Counter(df1['Confidence']).get(HIGH_CONFIDENCE, 0)
+    df1_num_verdicts = (df1['Verdict'].str.len() > 0).sum()
+    df1_num_high_confidence = (df1['Confidence'] == HIGH_CONFIDENCE).sum()
     df1_high_confidence_fraction = df1_num_high_confidence / df1_num_verdicts
 
     df2_verdicts_counter = get_counts_string(df2, "Verdict")
-    df2_num_verdicts = sum(df2['Verdict'].str.len() > 0)
-    df2_num_high_confidence = collections.Counter(df2['Confidence']).get(HIGH_CONFIDENCE, 0)
+    df2_num_verdicts = (df2['Verdict'].str.len() > 0).sum()
+    df2_num_high_confidence = (df2['Confidence'] == HIGH_CONFIDENCE).sum()
     df2_high_confidence_fraction = df2_num_high_confidence / df2_num_verdicts
 
     filename_len = max(len(args.table1), len(args.table2))
@@ -159,15 +192,15 @@ def compare_tables_with_default_schema(args, df1, df2):
     df_joined = df1.join(df2, lsuffix=f" {args.suffix1}", rsuffix=f" {args.suffix2}", how="outer").reset_index()
     df_joined = df_joined.fillna("")
 
-    df_joined = df_joined.apply(compute_default_schema_discordance_columns_func(args.suffix1, args.suffix2), axis=1)
+    df_joined = compute_default_schema_discordance_columns(df_joined, args.suffix1, args.suffix2)
 
     # print concordance stats
     print("-"*20)
-    num_discordant_verdicts = sum(df_joined[DISCORDANT_VERDICT_COLUMN])
+    num_discordant_verdicts = int(df_joined[DISCORDANT_VERDICT_COLUMN].sum())
     if num_discordant_verdicts:
         print(f"{num_discordant_verdicts} out of {len(df_joined)} ({100*num_discordant_verdicts/len(df_joined):0.1f}%) of "
           f"verdicts differed between the two tables")
-    print(f"\nDiscordance score = {sum(df_joined[DISCORDANT_SCORE_COLUMN])}:")
+    print(f"\nDiscordance score = {int(df_joined[DISCORDANT_SCORE_COLUMN].sum())}:")
     print(get_counts_string(df_joined, DISCORDANT_TEXT_COLUMN, label="review comparisons:", sep="\n"))
 
     print("-"*20)
@@ -183,7 +216,7 @@ def compare_tables_with_default_schema(args, df1, df2):
 def compare_tables_with_generic_schema(args, df1, df2):
 
     columns_shared_by_table1_and_table2 = set(df1.columns) & set(df2.columns) - {PATH_COLUMN}
-    columns_in_schema = set([r["columnName"] for r in args.form_schema_json if r.get("columnName")]) or None
+    columns_in_schema = set([r["columnName"] for r in (args.form_schema_json or []) if r.get("columnName")]) or None
 
     columns_to_compare = columns_shared_by_table1_and_table2
     if columns_in_schema:
@@ -199,10 +232,10 @@ def compare_tables_with_generic_schema(args, df1, df2):
     #  print stats about input tables
     for column in columns_to_compare:
         df1_counter = get_counts_string(df1, column)
-        df1_num_responses = sum(df1[column].astype(str).str.len() > 0)
+        df1_num_responses = (df1[column].astype(str).str.len() > 0).sum()
 
         df2_counter = get_counts_string(df2, column)
-        df2_num_responses = sum(df2[column].astype(str).str.len() > 0)
+        df2_num_responses = (df2[column].astype(str).str.len() > 0).sum()
 
         filename_len = max(len(args.table1), len(args.table2))
         print(f"{args.table1:{filename_len}s} \"{column.strip(':')}\" column had {df1_num_responses} responses:  {df1_counter}")
@@ -212,15 +245,14 @@ def compare_tables_with_generic_schema(args, df1, df2):
     df_joined = df1.join(df2, lsuffix=f" {args.suffix1}", rsuffix=f" {args.suffix2}", how="outer").reset_index()
     df_joined = df_joined.fillna("")
 
-    df_joined = df_joined.apply(compute_generic_schema_discordance_columns_func(
-        columns_to_compare, args.suffix1, args.suffix2), axis=1)
+    compute_generic_schema_discordance_columns(df_joined, columns_to_compare, args.suffix1, args.suffix2)
 
     # print concordance stats
     for column in columns_to_compare:
         diff_column = f"{column} diff"
         diff_score_column = f"{column} diff score"
-        num_concordant_responses = sum(df_joined[diff_score_column] == 0)
-        num_discordant_responses = sum(df_joined[diff_score_column] > 0)
+        num_concordant_responses = (df_joined[diff_score_column] == 0).sum()
+        num_discordant_responses = (df_joined[diff_score_column] > 0).sum()
         print(f"{num_concordant_responses} out of {len(df_joined)} ({100*num_concordant_responses/len(df_joined):0.1f}%) "
               f"\"{column.strip(':')}\" responses agreed between the two tables:")
         print(get_counts_string(df_joined[df_joined[diff_score_column] == 0], f"{column} {args.suffix1}", sep="\n", prefix="    "))
@@ -232,13 +264,302 @@ def compare_tables_with_generic_schema(args, df1, df2):
 
     return df_joined
 
+def is_excel_table(path):
+    return path.endswith(".xls") or path.endswith(".xlsx")
+
+
+def read_table_columns(path):
+    """Returns the column names of a form response table without reading its rows"""
+    if is_excel_table(path):
+        return list(pd.read_excel(path, engine="openpyxl", nrows=0).columns)
+    else:
+        return list(pd.read_table(path, nrows=0).columns)
+
+
+def get_columns_to_compare_in_n_tables(columns_shared_by_all_tables, form_schema_json):
+    """Returns the columns that have responses which can be compared between reviewers. Free-text columns are skipped,
+    since 2 different notes don't mean that the reviewers disagreed.
+    """
+    if form_schema_json:
+        columns_in_schema = {
+            r["columnName"] for r in form_schema_json if r.get("columnName") and r.get("type") != "text"}
+        return columns_shared_by_all_tables & columns_in_schema
+
+    if DEFAULT_SCHEMA_COLUMNS.issubset(columns_shared_by_all_tables):
+        return set(DEFAULT_SCHEMA_COLUMNS)
+
+    return columns_shared_by_all_tables
+
+
+def read_responses(path, columns, chunk_size):
+    """Reads the Path column and the given columns from a form response table. Responses are converted to categoricals
+    one chunk at a time, so the table is never held in memory as strings, and only the given columns are read.
+
+    Args:
+        path (str): path of the .tsv or .xls table
+        columns (list): the response columns to read
+        chunk_size (int): number of rows to read at a time from .tsv tables
+
+    Return:
+        pd.DataFrame: table indexed by Path, with a categorical column for each of the given columns. Empty responses
+            are missing values.
+    """
+    if is_excel_table(path):
+        chunks = [pd.read_excel(path, engine="openpyxl", usecols=[PATH_COLUMN] + columns, dtype=str)]
+    else:
+        chunks = pd.read_table(path, usecols=[PATH_COLUMN] + columns, dtype=str, chunksize=chunk_size)
+
+    paths = []
+    responses = {column: [] for column in columns}
+    for chunk in chunks:
+        chunk = chunk[chunk[PATH_COLUMN].notna()]
+        paths.append(chunk[PATH_COLUMN].to_numpy(dtype=object))
+        for column in columns:
+            responses[column].append(pd.Categorical(chunk[column]))
+
+    if not paths:
+        return pd.DataFrame(columns=columns, index=pd.Index([], name=PATH_COLUMN))
+
+    df = pd.DataFrame(
+        {column: union_categoricals(responses[column]) for column in columns},
+        index=pd.Index(np.concatenate(paths), name=PATH_COLUMN))
+
+    # if a path was saved more than once, keep its most recent responses
+    return df[~df.index.duplicated(keep="last")]
+
+
+def load_tables_for_n_way_comparison(p, args):
+    """Reads all tables at the same time in a thread pool.
+
+    Return:
+        list: a pd.DataFrame for each table, as returned by read_responses(..)
+    """
+    if args.names is None:
+        args.names = [str(i + 1) for i in range(len(args.tables))]
+    if len(args.names) != len(args.tables):
+        p.error(f"{len(args.names)} names were specified for {len(args.tables)} tables")
+    if len(set(args.names)) != len(args.names):
+        p.error(f"Names must be unique: {', '.join(args.names)}")
+
+    table_columns = []
+    for path in args.tables:
+        try:
+            table_columns.append(read_table_columns(path))
+        except Exception as e:
+            p.error(f"Error parsing {path}: {e}")
+
+        if PATH_COLUMN not in table_columns[-1]:
+            p.error(f"{path} is missing a '{PATH_COLUMN}' column")
+
+    columns_shared_by_all_tables = set.intersection(*[set(columns) for columns in table_columns]) - {PATH_COLUMN}
+    columns_to_compare = get_columns_to_compare_in_n_tables(columns_shared_by_all_tables, args.form_schema_json)
+    if not columns_to_compare:
+        p.error(f"No columns to compare. Columns shared by all tables: {', '.join(sorted(columns_shared_by_all_tables))}")
+
+    args.columns_to_compare = [column for column in table_columns[0] if column in columns_to_compare]
+
+    start_time = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(args.threads, len(args.tables)))) as executor:
+        futures = [
+            executor.submit(read_responses, path, args.columns_to_compare, args.chunk_size) for path in args.tables]
+
+    dfs = []
+    for path, future in zip(args.tables, futures):
+        try:
+            dfs.append(future.result())
+        except Exception as e:
+            p.error(f"Error parsing {path}: {e}")
+
+        if len(dfs[-1]) == 0:
+            p.error(f"{path} is empty")
+
+    print(f"Loaded {len(args.tables)} tables in {time.time() - start_time:0.1f} seconds")
+
+    return dfs
+
+
+def get_response_counts(codes, num_categories):
+    """Counts how many reviewers gave each response.
+
+    Args:
+        codes (np.array): (paths x reviewers) array of response category codes, where -1 means no response
+        num_categories (int): number of possible responses
+
+    Return:
+        np.array: (paths x num_categories) array of counts
+    """
+    num_paths = codes.shape[0]
+    has_response = codes >= 0
+    path_indices = np.broadcast_to(np.arange(num_paths)[:, None], codes.shape)[has_response]
+    return np.bincount(
+        path_indices * num_categories + codes[has_response], minlength=num_paths * num_categories
+    ).reshape(num_paths, num_categories)
+
+
+def compute_fleiss_kappa(counts):
+    """Computes Fleiss' kappa from the response counts for each path. Paths with responses from fewer than 2 reviewers
+    are skipped, and paths can have responses from different numbers of reviewers.
+
+    Args:
+        counts (np.array): (paths x num_categories) array returned by get_response_counts(..)
+
+    Return:
+        float: Fleiss' kappa, or NaN if it's undefined (eg. if all reviewers always gave the same response)
+    """
+    num_responses = counts.sum(axis=1)
+    counts = counts[num_responses >= 2]
+    num_responses = num_responses[num_responses >= 2]
+    if len(counts) == 0:
+        return np.nan
+
+    observed_agreement = ((counts * (counts - 1)).sum(axis=1) / (num_responses * (num_responses - 1))).mean()
+    category_fractions = counts.sum(axis=0) / counts.sum()
+    expected_agreement = (category_fractions ** 2).sum()
+    if expected_agreement >= 1:
+        return np.nan
+
+    return (observed_agreement - expected_agreement) / (1 - expected_agreement)
+
+
+def compute_cohens_kappa(codes1, codes2, num_categories):
+    """Computes Cohen's kappa between 2 reviewers, using the paths that both of them reviewed.
+
+    Args:
+        codes1 (np.array): response category codes from the 1st reviewer, where -1 means no response
+        codes2 (np.array): response category codes from the 2nd reviewer for the same paths
+        num_categories (int): number of possible responses
+
+    Return:
+        float: Cohen's kappa, or NaN if it's undefined
+    """
+    has_both_responses = (codes1 >= 0) & (codes2 >= 0)
+    num_paths = has_both_responses.sum()
+    if num_paths == 0:
+        return np.nan
+
+    confusion_matrix = np.bincount(
+        codes1[has_both_responses] * num_categories + codes2[has_both_responses], minlength=num_categories**2
+    ).reshape(num_categories, num_categories)
+
+    observed_agreement = np.trace(confusion_matrix) / num_paths
+    expected_agreement = (confusion_matrix.sum(axis=1) @ confusion_matrix.sum(axis=0)) / num_paths**2
+    if expected_agreement >= 1:
+        return np.nan
+
+    return (observed_agreement - expected_agreement) / (1 - expected_agreement)
+
+
+def format_kappa(kappa):
+    return "n/a" if np.isnan(kappa) else f"{kappa:0.3f}"
+
+
+def compare_n_tables(args, dfs):
+    """Joins the tables on their Path column, and computes inter-rater agreement statistics for each column being
+    compared.
+
+    Return:
+        pd.DataFrame: the joined table, with the responses from each reviewer, the most common response and the
+            fraction of reviewers who gave it for each column, and the DISAGREEMENT_SCORE_COLUMN. Rows are sorted
+            so that paths with the most disagreement are first.
+    """
+    names = args.names
+    columns = args.columns_to_compare
+
+    #  print stats about input tables
+    filename_len = max(len(path) for path in args.tables)
+    for column in columns:
+        for path, df in zip(args.tables, dfs):
+            response_counts = df[column].value_counts(sort=False)
+            counts_string = ", ".join(f"{count} {response}" for response, count in sorted(response_counts.items()))
+            print(f"{path:{filename_len}s} \"{column.strip(':')}\" column had {response_counts.sum()} responses:  "
+                  f"{counts_string}")
+
+    #  join all tables in one pass
+    df_joined = pd.concat([df.add_suffix(f" {name}") for df, name in zip(dfs, names)], axis=1, join="outer")
+    num_paths = len(df_joined)
+    disagreement_score = np.zeros(num_paths, dtype=int)
+    for column in columns:
+        reviewer_columns = [f"{column} {name}" for name in names]
+        categories = pd.Index(sorted(set().union(*[df[column].cat.categories for df in dfs])))
+        codes = np.column_stack([
+            pd.Categorical(df_joined[reviewer_column], categories=categories).codes.astype(np.int64)
+            for reviewer_column in reviewer_columns])
+
+        counts = get_response_counts(codes, len(categories))
+        num_responses = counts.sum(axis=1)
+        max_count = counts.max(axis=1, initial=0)
+        is_tied = (counts == max_count[:, None]).sum(axis=1) > 1
+        has_most_common_response = (max_count > 0) & ~is_tied
+        most_common_response = np.full(num_paths, "", dtype=object)
+        if has_most_common_response.any():
+            most_common_response[has_most_common_response] = categories.to_numpy(dtype=object)[
+                counts[has_most_common_response].argmax(axis=1)]
+
+        df_joined[f"{column} majority"] = most_common_response
+        df_joined[f"{column} agreement"] = np.round(max_count / np.maximum(num_responses, 1), 3)
+        df_joined.loc[num_responses == 0, f"{column} agreement"] = np.nan
+        disagreement_score += num_responses - max_count
+
+        # print concordance stats
+        has_multiple_responses = num_responses >= 2
+        num_paths_with_multiple_responses = has_multiple_responses.sum()
+        num_unanimous = (has_multiple_responses & (max_count == num_responses)).sum()
+        print("-"*20)
+        print(f"\"{column.strip(':')}\": {num_paths_with_multiple_responses} out of {num_paths} paths had responses "
+              f"from at least 2 reviewers")
+        if num_paths_with_multiple_responses:
+            print(f"    {num_unanimous} of them ({100*num_unanimous/num_paths_with_multiple_responses:0.1f}%) had the "
+                  f"same response from all reviewers")
+        print(f"    Fleiss' kappa: {format_kappa(compute_fleiss_kappa(counts))}")
+
+        print("    Cohen's kappa between each pair of reviewers:")
+        name_len = max(6, max(len(name) for name in names))
+        print("    " + " " * name_len + "".join(f"  {name:>{name_len}s}" for name in names))
+        for i, name1 in enumerate(names):
+            kappas = [
+                "-" if i == j else format_kappa(compute_cohens_kappa(codes[:, i], codes[:, j], len(categories)))
+                for j in range(len(names))]
+            print(f"    {name1:>{name_len}s}" + "".join(f"  {kappa:>{name_len}s}" for kappa in kappas))
+
+        majority_counts = pd.Series(most_common_response[has_most_common_response]).value_counts(sort=False)
+        print("    Most common responses: " + ", ".join(
+            [f"{count} {response}" for response, count in sorted(majority_counts.items())] +
+            [f"{(is_tied & (max_count > 0)).sum()} tied"]))
+
+    df_joined[DISAGREEMENT_SCORE_COLUMN] = disagreement_score
+
+    # put each column's responses next to each other, followed by the summary columns for that column
+    output_columns = [
+        output_column for column in columns for output_column in
+        [f"{column} {name}" for name in names] + [f"{column} majority", f"{column} agreement"]]
+    df_joined = df_joined[output_columns + [DISAGREEMENT_SCORE_COLUMN]].reset_index()
+    df_joined.sort_values([DISAGREEMENT_SCORE_COLUMN, PATH_COLUMN], ascending=[False, True], inplace=True)
+
+    print("-"*20)
+    top_rows = df_joined[df_joined[DISAGREEMENT_SCORE_COLUMN] > 0].head(args.top)
+    print(f"{(df_joined[DISAGREEMENT_SCORE_COLUMN] > 0).sum()} out of {num_paths} paths had at least one response "
+          f"that differed from the most common response" + (". Paths with the most disagreement:" if len(top_rows) else ""))
+    for _, row in top_rows.iterrows():
+        responses_string = "; ".join(
+            f"{column.strip(':')}: " + ", ".join(
+                f"{row[f'{column} {name}']} ({name})" for name in names if pd.notna(row[f"{column} {name}"]))
+            for column in columns)
+        print(f"    {row[DISAGREEMENT_SCORE_COLUMN]:3d}  {row[PATH_COLUMN]}  {responses_string}")
+
+    return df_joined
+
+
 def main():
-    args, df1, df2 = parse_args()
+    args, dfs = parse_args()
 
     print("-"*20)
-    if DEFAULT_SCHEMA_COLUMNS.issubset(df1.columns) and DEFAULT_SCHEMA_COLUMNS.issubset(df2.columns):
+    if args.n_way:
+        df_joined = compare_n_tables(args, dfs)
+    elif DEFAULT_SCHEMA_COLUMNS.issubset(dfs[0].columns) and DEFAULT_SCHEMA_COLUMNS.issubset(dfs[1].columns):
+        df1, df2 = dfs
         df_joined = compare_tables_with_default_schema(args, df1, df2)
     else:
+        df1, df2 = dfs
         df_joined = compare_tables_with_generic_schema(args, df1, df2)
 
     # write outtable
@@ -1,17 +1,81 @@
 import os
 from flask import request, Response
 from pprint import pprint, pformat
-from flipbook import args, RELATIVE_DIRECTORY_TO_DATA_FILES_LIST, FORM_SCHEMA, FORM_RESPONSES, \
-    RELATIVE_DIRECTORY_TO_METADATA, FORM_RADIO_BUTTON_KEYBOARD_SHORTCUTS, EXTRA_DATA_IN_FORM_RESPONSES_TABLE, \
-    get_static_data_page_url, DATA_PAGE_HEADER_FILENAME
+from flipbook import DATA_PAGE_HEADER_FILENAME
+from flipbook.page_cache import get_page_cache_key, get_rendered_page, put_rendered_page
+from flipbook.state import get_state
+from flipbook.thumbnails import get_thumbnail_url, is_resizing_available
 from flipbook.utils import load_jinja_template, get_data_page_url, CONTENT_HTML_FILE_TYPE, \
     IMAGE_FILE_TYPE
 
 DATA_PAGE_TEMPLATE = None
 
 
+def get_image_url(state, image_file_path, max_image_width=None):
+    """Returns the url that data pages use to show the given image"""
+    if max_image_width:
+        return f"{get_thumbnail_url(image_file_path, max_image_width)}&cache={state.get_ctime(image_file_path)}"
+
+    return f"{image_file_path}?cache={state.get_ctime(image_file_path)}"
+
+
+def get_prefetch_urls(state, page_set, i, last, max_image_width=None, sort_order=None, get_page_url=get_data_page_url):
+    """Returns the urls of the pages that the user is most likely to open after page i, and of their images.
+
+    The pages are i + 1, i - 1, and then i + 2 to i + --prefetch-depth. Images are added in that order until their
+    total size reaches --prefetch-max-mb.
+
+    Args:
+        state (FlipBookState): the server state
+        page_set (PageSet): the snapshot of state.pages that the request is using
+        sort_order (numpy array): optional positions of the pages in page_set.relative_directory_to_data_files_list, in
+            the order that page numbers refer to
+        get_page_url (function): returns the url of a page, given the page number and the number of pages
+
+    Returns:
+        2-tuple: (list of page urls, list of image urls)
+    """
+    args = state.args
+    if args.prefetch_depth < 1:
+        return [], []
+
+    pages = page_set.relative_directory_to_data_files_list
+    num_pages = min(last, len(pages) if sort_order is None else len(sort_order))
+    max_bytes = args.prefetch_max_mb * 1024 * 1024
+    total_bytes = 0
+    page_urls = []
+    image_urls = []
+    for page_number in [i + 1, i - 1] + list(range(i + 2, i + args.prefetch_depth + 1)):
+        if page_number < 1 or page_number > num_pages:
+            continue
+
+        page_urls.append(get_page_url(page_number, last))
+        position = page_number - 1 if sort_order is None else sort_order[page_number - 1]
+        _, data_file_types_and_paths = pages[position]
+        for data_file_type, data_file_path in data_file_types_and_paths:
+            if data_file_type != IMAGE_FILE_TYPE or total_bytes >= max_bytes:
+                continue
+            try:
+                # for scaled-down images, the size of the original is an upper bound
+                total_bytes += os.path.getsize(os.path.join(args.directory, data_file_path))
+            except OSError:
+                continue
+            if total_bytes <= max_bytes:
+                image_urls.append(get_image_url(state, data_file_path, max_image_width))
+
+    return page_urls, image_urls
+
+
+def get_prefetch_link_header(prefetch_page_urls, prefetch_image_urls):
+    return ", ".join(
+        [f"<{url}>; rel=prefetch" for url in prefetch_page_urls] +
+        [f"<{url}>; rel=prefetch; as=image" for url in prefetch_image_urls])
+
+
 def data_page_handler(is_static_website=False):
     global DATA_PAGE_TEMPLATE
+    state = get_state()
+    args = state.args
     if DATA_PAGE_TEMPLATE is None or args.dev_mode:
         DATA_PAGE_TEMPLATE = load_jinja_template("data_page")
 
@@ -37,15 +101,37 @@ def data_page_handler(is_static_website=False):
         print(f"data_page_handler request.__dict__: {pformat(request.__dict__)}")
         print(f"data_page_handler params: {params}")
 
+    # with ?sort= or ?filter= url params, page numbers refer to pages in that order instead of the default order
+    sort_by, reverse, filter_expression = (), False, ""
+    if not is_static_website:
+        try:
+            sort_by, reverse, filter_expression = state.get_requested_page_order(request.args)
+        except ValueError as e:
+            return Response(str(e), status=400, mimetype='text/plain')
+
+    # use the same snapshot of the pages for the whole request, since --watch may replace state.pages
+    page_set = state.pages
+    pages, page_index = page_set
+    sort_order = None
+    num_pages = len(pages)
+    if sort_by or reverse or filter_expression:
+        sort_order = page_index.get_sort_order(sort_by, reverse, filter_expression)
+        num_pages = len(sort_order)
+        if num_pages == 0:
+            return Response(f"No pages match the filter: {filter_expression}", status=404, mimetype='text/plain')
+
+    get_page_url = state.get_data_page_url_function(
+        sort_order, state.get_page_order_query_string(sort_by, reverse, filter_expression), page_set)
+
     i = None
     relative_dir = params.get("path")
     if relative_dir:
         # override i
-        for idx, (known_relative_dir, _) in enumerate(RELATIVE_DIRECTORY_TO_DATA_FILES_LIST):
-            if relative_dir == known_relative_dir:
-                i = idx + 1
-                break
-        else:
+        position = page_index.get_position(relative_dir)
+        if position is not None:
+            i = position + 1 if sort_order is None else page_index.get_page_number(
+                position, sort_by, reverse, filter_expression)
+        if i is None:
             print(f"ERROR: path param '{relative_dir}' not recognized. Falling back on using i param.")
 
     if i is None:
@@ -78,21 +164,45 @@ def data_page_handler(is_static_website=False):
         print(f"ERROR: parameter i (= {i}) is less than 1. Resetting it to 1.")
         i = 1
 
-    if i > len(RELATIVE_DIRECTORY_TO_DATA_FILES_LIST):
-        print(f"ERROR: parameter i (= {i}) is greater than the # of pages "
-              f"(= {len(RELATIVE_DIRECTORY_TO_DATA_FILES_LIST)}). "
-              f"Resetting it to {len(RELATIVE_DIRECTORY_TO_DATA_FILES_LIST)}.")
-        i = len(RELATIVE_DIRECTORY_TO_DATA_FILES_LIST)
+    if i > num_pages:
+        print(f"ERROR: parameter i (= {i}) is greater than the # of pages (= {num_pages}). Resetting it to {num_pages}.")
+        i = num_pages
 
-    relative_dir, data_file_types_and_paths = RELATIVE_DIRECTORY_TO_DATA_FILES_LIST[i - 1]
+    relative_dir, data_file_types_and_paths = pages[i - 1 if sort_order is None else sort_order[i - 1]]
+
+    # the page html only changes if the form responses or metadata change (which update the version counters in the
+    # cache key), or if one of the page's files or the header file change (which changes their mtimes in the key)
+    max_image_width = args.max_image_width if not is_static_website and is_resizing_available() else None
+    prefetch_page_urls, prefetch_image_urls = [], []
+    cache_key = None
+    if not is_static_website:
+        prefetch_page_urls, prefetch_image_urls = get_prefetch_urls(
+            state, page_set, i, last, max_image_width, sort_order, get_page_url)
+        data_page_header_path = os.path.join(args.directory, DATA_PAGE_HEADER_FILENAME)
+        cache_key = get_page_cache_key(
+            relative_dir,
+            (i, last, get_page_url(i - 1, last), get_page_url(i + 1, last), tuple(prefetch_page_urls),
+             tuple(prefetch_image_urls)),
+            [data_page_header_path] + [
+                os.path.join(args.directory, data_file_path) for _, data_file_path in data_file_types_and_paths])
+        html = get_rendered_page(cache_key)
+        if html is not None:
+            if args.verbose:
+                print(f"data_page_handler returning cached html for i={i}, last={last}, relative_directory={relative_dir}")
+            return get_data_page_response(html, prefetch_page_urls, prefetch_image_urls)
 
     image_file_paths = []
+    image_urls = []
     for data_file_type, data_file_path in data_file_types_and_paths:
         if data_file_type == IMAGE_FILE_TYPE:
             image_file_paths.append(data_file_path)
+            image_urls.append((
+                data_file_path,
+                get_image_url(state, data_file_path, max_image_width),
+                get_image_url(state, data_file_path) if max_image_width else None))
 
-    metadata_json_dict = RELATIVE_DIRECTORY_TO_METADATA.get(relative_dir, {})
-    metadata_json_dict.update(EXTRA_DATA_IN_FORM_RESPONSES_TABLE.get(relative_dir, {}))
+    metadata_json_dict = dict(state.get_page_metadata(relative_dir, data_file_types_and_paths))
+    metadata_json_dict.update(state.extra_data_in_form_responses_table.get(relative_dir, {}))
 
     content_html_strings = []
     for data_file_type, data_file_path in data_file_types_and_paths:
@@ -118,12 +228,15 @@ def data_page_handler(is_static_website=False):
         header_html=data_page_header_html,
         relative_directory=relative_dir,
         image_file_paths=image_file_paths,
+        image_urls=image_urls,
+        prefetch_page_urls=prefetch_page_urls,
+        prefetch_image_urls=prefetch_image_urls,
         metadata_json_dict=metadata_json_dict,
         content_html_strings=content_html_strings,
-        get_data_page_url=get_data_page_url if not is_static_website else get_static_data_page_url,
-        form_schema=FORM_SCHEMA,
-        form_radio_button_keyboard_shortcuts=FORM_RADIO_BUTTON_KEYBOARD_SHORTCUTS,
-        form_responses=FORM_RESPONSES.get(relative_dir, {}),
+        get_data_page_url=get_page_url if not is_static_website else state.get_static_data_page_url,
+        form_schema=state.form_schema,
+        form_radio_button_keyboard_shortcuts=state.form_radio_button_keyboard_shortcuts,
+        form_responses=state.form_response_store.get(relative_dir, {}),
         is_static_website=is_static_website,
         show_one_key_per_line=args.show_one_key_per_line,
         zoom=args.zoom,
@@ -131,5 +244,16 @@ def data_page_handler(is_static_website=False):
         autosave_form=args.autosave_form,
     )
 
-    return Response(html, mimetype='text/html')
+    if cache_key is not None:
+        put_rendered_page(cache_key, html)
+
+    return get_data_page_response(html, prefetch_page_urls, prefetch_image_urls)
+
+
+def get_data_page_response(html, prefetch_page_urls, prefetch_image_urls):
+    response = Response(html, mimetype='text/html')
+    if prefetch_page_urls or prefetch_image_urls:
+        response.headers["Link"] = get_prefetch_link_header(prefetch_page_urls, prefetch_image_urls)
+
+    return response
 
@@ -0,0 +1,201 @@
+"""/export streams a table with one row per page, which combines the pages' form responses, metadata and the extra
+columns from the form responses table, the same way as when they're saved to the form responses table.
+
+    /export?format=tsv|xlsx|parquet&columns=Path,Verdict,coverage
+
+Pages are listed in the same order as on the home page, and the ?sort= and ?filter= url params work the same way. The
+table is built EXPORT_CHUNK_SIZE rows at a time, so memory use doesn't depend on the number of pages. .tsv and .parquet
+files are sent while they're being created. Excel files can only be sent once they're complete, so they're written to
+a temp file first.
+"""
+
+import io
+import os
+import tempfile
+
+from flask import request, Response
+
+from flipbook.main_list import get_pages_in_requested_order
+from flipbook.save import error_response, get_form_responses_table_row
+from flipbook.state import get_state
+from flipbook.tables import PATH_COLUMN, is_pyarrow_available
+
+TSV_EXPORT_FORMAT = "tsv"
+XLSX_EXPORT_FORMAT = "xlsx"
+PARQUET_EXPORT_FORMAT = "parquet"
+EXPORT_FORMATS = (TSV_EXPORT_FORMAT, XLSX_EXPORT_FORMAT, PARQUET_EXPORT_FORMAT)
+
+EXPORT_FORMAT_TO_MIMETYPE = {
+    TSV_EXPORT_FORMAT: "text/tab-separated-values",
+    XLSX_EXPORT_FORMAT: "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    PARQUET_EXPORT_FORMAT: "application/vnd.apache.parquet",
+}
+
+FORMAT_URL_PARAM = "format"
+COLUMNS_URL_PARAM = "columns"
+
+EXPORT_CHUNK_SIZE = 1000
+
+# number of bytes to read at a time when sending a temp file
+EXPORT_FILE_BLOCK_SIZE = 1024 * 1024
+
+
+def get_export_columns(state):
+    """Returns all columns that can be exported, in their default order"""
+    columns = [PATH_COLUMN] + state.form_schema_columns + state.extra_columns_in_form_responses_table + \
+        state.metadata_columns
+
+    return list(dict.fromkeys(columns))
+
+
+def get_requested_columns(state, request_args):
+    """Returns the columns requested by the ?columns= url param, which is a comma-separated list of columns and can be
+    repeated. The 'Path' column is always included. Without ?columns=, all columns are returned.
+
+    Raises:
+        ValueError: if an unknown column is requested
+    """
+    valid_columns = get_export_columns(state)
+    requested_columns = [
+        column.strip() for value in request_args.getlist(COLUMNS_URL_PARAM) for column in value.split(",")
+        if column.strip()]
+    if not requested_columns:
+        return valid_columns
+
+    unknown_columns = [column for column in requested_columns if column not in valid_columns]
+    if unknown_columns:
+        raise ValueError(f"Unknown column(s): {', '.join(unknown_columns)}. Valid columns are: "
+                         f"{', '.join(valid_columns)}")
+
+    return list(dict.fromkeys([PATH_COLUMN] + requested_columns))
+
+
+def iter_export_rows(state, pages, columns):
+    """Yields lists of up to EXPORT_CHUNK_SIZE rows, where each row is a list of values for the given columns.
+
+    Args:
+        state (FlipBookState): the server state
+        pages (list): (relative directory, data file types and paths) tuples for the pages to export
+        columns (list): the columns to include
+    """
+    for i in range(0, len(pages), EXPORT_CHUNK_SIZE):
+        relative_directories = [relative_directory for relative_directory, _ in pages[i:i + EXPORT_CHUNK_SIZE]]
+        form_responses = state.form_response_store.get_many(relative_directories)
+        rows = []
+        for relative_directory in relative_directories:
+            row = get_form_responses_table_row(
+                state, relative_directory, form_responses.get(relative_directory, {}), include_metadata=True)
+            rows.append([row.get(column) for column in columns])
+        yield rows
+
+
+def to_string(value):
+    return "" if value is None else str(value)
+
+
+def iter_tsv(row_chunks, columns):
+    import pandas as pd
+
+    is_first_chunk = True
+    for rows in row_chunks:
+        # dtype=object keeps integers with missing values from being written as floats
+        yield pd.DataFrame(rows, columns=columns, dtype=object).to_csv(sep="\t", header=is_first_chunk, index=False)
+        is_first_chunk = False
+
+    if is_first_chunk:
+        yield "\t".join(columns) + "\n"
+
+
+def iter_xlsx(row_chunks, columns):
+    from openpyxl import Workbook
+
+    # in write-only mode, openpyxl keeps rows in a temp file rather than in memory
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet()
+    worksheet.append(columns)
+    for rows in row_chunks:
+        for row in rows:
+            worksheet.append([
+                value if value is None or isinstance(value, (str, int, float, bool)) else str(value) for value in row])
+
+    with tempfile.TemporaryFile() as f:
+        workbook.save(f)
+        f.seek(0)
+        while True:
+            data = f.read(EXPORT_FILE_BLOCK_SIZE)
+            if not data:
+                break
+            yield data
+
+
+class StreamingOutputFile(io.RawIOBase):
+    """Write-only file that keeps the data that's written to it until it's retrieved by pop()"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def pop(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_parquet(row_chunks, columns):
+    import pyarrow as pa
+    import pyarrow.parquet
+
+    # like tables.write_table(..), store all values as strings, since columns may contain a mix of strings and numbers
+    schema = pa.schema([(column, pa.string()) for column in columns])
+    output_file = StreamingOutputFile()
+    with pyarrow.parquet.ParquetWriter(pa.PythonFile(output_file, mode="w"), schema) as writer:
+        for rows in row_chunks:
+            writer.write_table(pa.Table.from_pydict(
+                {column: [to_string(row[i]) for row in rows] for i, column in enumerate(columns)}, schema=schema))
+            yield output_file.pop()
+
+    yield output_file.pop()
+
+
+def export_handler():
+    state = get_state()
+    args = state.args
+    if args.verbose:
+        print(f"export_handler received {request.url}")
+
+    export_format = request.args.get(FORMAT_URL_PARAM, TSV_EXPORT_FORMAT)
+    if export_format not in EXPORT_FORMATS:
+        return error_response(f"Unexpected format: '{export_format}'. It should be one of: {', '.join(EXPORT_FORMATS)}")
+    if export_format == PARQUET_EXPORT_FORMAT and not is_pyarrow_available():
+        return error_response("Exporting to Parquet requires the 'pyarrow' package. To install it, run: "
+                              "python3 -m pip install pyarrow")
+
+    try:
+        columns = get_requested_columns(state, request.args)
+        pages, _, _ = get_pages_in_requested_order(state, state.pages)
+    except ValueError as e:
+        return error_response(str(e))
+
+    row_chunks = iter_export_rows(state, pages, columns)
+    if export_format == TSV_EXPORT_FORMAT:
+        output = iter_tsv(row_chunks, columns)
+    elif export_format == XLSX_EXPORT_FORMAT:
+        output = iter_xlsx(row_chunks, columns)
+    else:
+        output = iter_parquet(row_chunks, columns)
+
+    filename = f"{os.path.splitext(os.path.basename(args.form_responses_table))[0]}.{export_format}"
+    return Response(output, mimetype=EXPORT_FORMAT_TO_MIMETYPE[export_format],
+                    headers={"Content-Disposition": f"attachment; filename={filename}"})
@@ -0,0 +1,147 @@
+"""Serves images and other data files from the top-level directory.
+
+Data files can be large (eg. 20 MB images), so rather than copying them through Python in small chunks, their contents
+are sent with zero-copy transfers where the server allows it:
+
+    gunicorn (--workers)          the file is passed to the server's wsgi.file_wrapper, which sends it with os.sendfile
+    Flask's development server    the status line and headers are sent first, and then the file is sent directly to
+                                  the client's socket with socket.sendfile (which uses os.sendfile)
+
+Otherwise, the file is read in FILE_BLOCK_SIZE chunks.
+"""
+
+import mimetypes
+import os
+import zlib
+
+from flask import request, Response
+from werkzeug.exceptions import NotFound
+from werkzeug.utils import safe_join
+
+from flipbook.state import get_state
+
+# urls with a ?cache=<ctime> param change whenever the file changes, so browsers can keep them for a year
+# without checking for updates. ?cache=0 means the ctime couldn't be determined, so it doesn't count as versioned.
+VERSIONED_URL_PARAM = "cache"
+VERSIONED_URL_MAX_AGE = 365 * 24 * 60 * 60
+
+# number of bytes to read at a time when the file can't be sent with a zero-copy transfer
+FILE_BLOCK_SIZE = 1024 * 1024
+
+
+def set_cache_headers(response):
+    """Lets browsers reuse data files they already downloaded. Files requested with a versioned url are cached without
+    revalidation. Otherwise, browsers check the ETag or Last-Modified headers, and get a 304 response if the file is
+    unchanged.
+    """
+    if request.args.get(VERSIONED_URL_PARAM, "0") != "0":
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = VERSIONED_URL_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+
+    return response
+
+
+class FileRangeBody:
+    """WSGI response body that sends length bytes of an open file, starting at offset.
+
+    When iterated by Flask's development server, it yields an empty chunk so that the server sends the status line and
+    headers, and then sends the file directly to the client's socket.
+    """
+
+    def __init__(self, file, offset, length, client_socket=None):
+        """
+        Args:
+            file (file): the file, opened in binary mode. It's closed by close().
+            offset (int): position of the first byte to send
+            length (int): number of bytes to send
+            client_socket (socket.socket): the socket to send the file to, or None to read the file in chunks instead
+        """
+        self.file = file
+        self.offset = offset
+        self.length = length
+        self.client_socket = client_socket
+
+    def __iter__(self):
+        if self.client_socket is not None:
+            yield b""
+            self.client_socket.sendfile(self.file, self.offset, self.length)
+            return
+
+        self.file.seek(self.offset)
+        remaining = self.length
+        while remaining > 0:
+            data = self.file.read(min(FILE_BLOCK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+    def close(self):
+        self.file.close()
+
+
+def send_file_from_directory(directory, path):
+    """Returns a response with the contents of a file. Like flask.send_from_directory(..), it handles If-None-Match,
+    If-Modified-Since and Range headers, so unchanged files get a 304 response and large files can be downloaded in parts.
+    Unlike flask.send_from_directory(..), it sends the file with a zero-copy transfer when possible.
+
+    Args:
+        directory (str): the top-level directory
+        path (str): path of the file, relative to the directory
+
+    Raises:
+        NotFound: if the path is outside the directory or the file doesn't exist
+    """
+    absolute_path = safe_join(directory, path)
+    if absolute_path is None:
+        raise NotFound()
+
+    try:
+        file = open(absolute_path, "rb")
+        stat = os.fstat(file.fileno())
+    except OSError:
+        raise NotFound()
+
+    try:
+        response = Response(
+            mimetype=mimetypes.guess_type(absolute_path)[0] or "application/octet-stream", direct_passthrough=True)
+        response.last_modified = stat.st_mtime
+        # same ETag as flask.send_from_directory(..), so browsers don't download files again after an upgrade
+        response.set_etag(f"{stat.st_mtime}-{stat.st_size}-{zlib.adler32(absolute_path.encode('UTF-8')) & 0xFFFFFFFF}")
+        response.content_length = stat.st_size
+
+        # this sets the status code to 304 or 206 and sets the Content-Range and Content-Length headers as needed
+        response.make_conditional(request.environ, accept_ranges=True, complete_length=stat.st_size)
+        if response.status_code == 304:
+            file.close()
+            return response
+
+        if response.status_code == 206:
+            offset, length = response.content_range.start, response.content_range.stop - response.content_range.start
+        else:
+            offset, length = 0, stat.st_size
+
+        file_wrapper = request.environ.get("wsgi.file_wrapper")
+        client_socket = request.environ.get("werkzeug.socket")
+        if response.status_code == 200 and file_wrapper is not None:
+            # servers only know how to send whole files with their file wrappers
+            response.response = file_wrapper(file, FILE_BLOCK_SIZE)
+        else:
+            response.response = FileRangeBody(file, offset, length, client_socket=client_socket)
+    except Exception:
+        file.close()
+        raise
+
+    return response
+
+
+def send_file(path):
+    args = get_state().args
+    if args.verbose:
+        print(f"Sending {args.directory} {path}")
+
+    return set_cache_headers(send_file_from_directory(args.directory, path))
@@ -0,0 +1,223 @@
+import json
+import os
+import threading
+import time
+
+JOURNAL_FILE_SUFFIX = ".journal"
+COMPACTING_JOURNAL_FILE_SUFFIX = ".journal.compacting"
+
+
+def get_journal_path(form_responses_table_path):
+    return f"{form_responses_table_path}{JOURNAL_FILE_SUFFIX}"
+
+
+def read_journal_records(journal_path):
+    """Yields the records from the given journal file. A truncated last line (eg. from a crash in the middle of a
+    write) is skipped. A line can also contain a list of records that were saved together (see
+    ResponseJournal.append_many(..)), so these are either all replayed or all skipped.
+    """
+    if not os.path.isfile(journal_path):
+        return
+
+    with open(journal_path, "rt") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                print(f"WARNING: skipping unparseable line #{line_number} in {journal_path}: {e}")
+                continue
+            if isinstance(record, dict):
+                yield record
+            elif isinstance(record, list):
+                yield from (r for r in record if isinstance(r, dict))
+
+
+def replay_journal(form_responses_table_path, form_responses, path_column, verbose=False):
+    """Applies any records from the form responses journal (and from a previously interrupted compaction) to the
+    form_responses dict, so that it reflects all responses saved since the table was last written out.
+
+    Returns the number of records that were replayed.
+    """
+    journal_path = get_journal_path(form_responses_table_path)
+    counter = 0
+    for path in f"{form_responses_table_path}{COMPACTING_JOURNAL_FILE_SUFFIX}", journal_path:
+        for record in read_journal_records(path):
+            relative_directory = record.get(path_column)
+            if relative_directory is None:
+                continue
+            form_responses.setdefault(relative_directory, {}).update(record)
+            counter += 1
+            if verbose > 1:
+                print(f"Replayed {path} record: {record}")
+
+    if counter:
+        print(f"Replayed {counter} form response(s) from {journal_path}")
+
+    return counter
+
+
+class ResponseJournal:
+    """Append-only log of form responses.
+
+    Each save appends one json record to the journal file instead of rewriting the whole form responses table. Writes
+    are fsync'ed in batches by a background thread, which also periodically compacts the journal into the form
+    responses table. Compaction first renames the journal so that new records can be appended while the table is
+    being written, and the renamed file is only deleted after the table has been written out.
+
+    Args:
+        form_responses_table_path (str): path of the .tsv or .xls table that the journal gets compacted into.
+        get_table_snapshot (function): called with the journal lock held. Returns a snapshot of the current form
+            responses that can later be passed to write_table.
+        write_table (function): writes the snapshot to the form responses table.
+        fsync_interval (float): max. number of seconds between when a record is appended and when it's fsync'ed.
+        compact_interval (float): number of seconds between compactions.
+        lock (threading.RLock): optional lock that guards the in-memory form responses. If not specified, a new
+            lock is created.
+    """
+
+    def __init__(self, form_responses_table_path, get_table_snapshot, write_table, fsync_interval=1.0,
+                 compact_interval=30.0, lock=None, verbose=False):
+        self.journal_path = get_journal_path(form_responses_table_path)
+        self.compacting_journal_path = f"{form_responses_table_path}{COMPACTING_JOURNAL_FILE_SUFFIX}"
+        self.get_table_snapshot = get_table_snapshot
+        self.write_table = write_table
+        self.fsync_interval = fsync_interval
+        self.compact_interval = compact_interval
+        self.verbose = verbose
+
+        # this lock must be held while modifying the in-memory form responses, so that each journal record and each
+        # table snapshot is consistent with the in-memory state
+        self.lock = lock or threading.RLock()
+        self._compaction_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        self._merge_interrupted_compaction()
+
+        self._file = open(self.journal_path, "at")
+        self._num_unsynced_records = 0
+        self._num_uncompacted_records = 0
+        if self._file.tell() > 0:
+            # start on a new line in case the last write was interrupted
+            self._file.write("\n")
+            self._num_uncompacted_records = 1
+
+    def _merge_interrupted_compaction(self):
+        """If a previous compaction was interrupted before the table was written, prepend its records to the journal
+        so they're included in the next compaction.
+        """
+        if not os.path.isfile(self.compacting_journal_path):
+            return
+
+        temp_path = f"{self.journal_path}.tmp"
+        with open(temp_path, "wt") as out_f:
+            for path in self.compacting_journal_path, self.journal_path:
+                if os.path.isfile(path):
+                    with open(path, "rt") as in_f:
+                        content = in_f.read()
+                    if content and not content.endswith("\n"):
+                        content += "\n"
+                    out_f.write(content)
+            out_f.flush()
+            os.fsync(out_f.fileno())
+
+        os.replace(temp_path, self.journal_path)
+        os.remove(self.compacting_journal_path)
+
+    def append(self, record):
+        """Appends a record to the journal. The caller should hold self.lock while updating the in-memory form
+        responses and calling this method.
+        """
+        with self.lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            self._num_unsynced_records += 1
+            self._num_uncompacted_records += 1
+
+    def append_many(self, records):
+        """Appends several records to the journal as a single line, so that if the server is interrupted while
+        they're being written, none of them are replayed rather than only some of them.
+        """
+        with self.lock:
+            self._file.write(json.dumps(records) + "\n")
+            self._file.flush()
+            self._num_unsynced_records += len(records)
+            self._num_uncompacted_records += len(records)
+
+    def has_uncompacted_records(self):
+        """Returns True if some records haven't been written to the form responses table yet, including while they're
+        being written.
+        """
+        with self.lock:
+            return self._num_uncompacted_records > 0 or os.path.isfile(self.compacting_journal_path)
+
+    def fsync(self):
+        with self.lock:
+            if not self._num_unsynced_records:
+                return
+            os.fsync(self._file.fileno())
+            if self.verbose > 1:
+                print(f"Synced {self._num_unsynced_records} record(s) to {self.journal_path}")
+            self._num_unsynced_records = 0
+
+    def compact(self):
+        """Writes all form responses to the form responses table and clears the journal."""
+        with self._compaction_lock:
+            with self.lock:
+                if not self._num_uncompacted_records:
+                    return
+                snapshot = self.get_table_snapshot()
+
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                if os.path.isfile(self.compacting_journal_path):
+                    # the previous compaction failed, so keep its records
+                    self._merge_interrupted_compaction()
+                os.replace(self.journal_path, self.compacting_journal_path)
+                self._file = open(self.journal_path, "at")
+                self._num_unsynced_records = 0
+                self._num_uncompacted_records = 0
+
+            start_time = time.time()
+            try:
+                self.write_table(snapshot)
+            except Exception:
+                with self.lock:
+                    self._num_uncompacted_records += 1
+                raise
+            os.remove(self.compacting_journal_path)
+            if self.verbose:
+                print(f"Compacted {self.journal_path} in {time.time() - start_time:0.2f} seconds")
+
+    def _run(self):
+        last_compaction_time = time.time()
+        while not self._stop_event.wait(self.fsync_interval):
+            try:
+                self.fsync()
+                if time.time() - last_compaction_time >= self.compact_interval:
+                    self.compact()
+                    last_compaction_time = time.time()
+            except Exception as e:
+                print(f"ERROR: unable to update {self.journal_path}: {type(e).__name__} {e}")
+
+    def start(self):
+        """Starts the background thread that fsyncs and compacts the journal."""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="flipbook-response-journal", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stops the background thread and compacts any remaining records into the form responses table."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        self.compact()
+        with self.lock:
+            self._file.close()
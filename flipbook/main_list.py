@@ -1,37 +1,155 @@
+import html
+import json
 import os
 
+import numpy as np
+
 from flask import request, Response
-from flipbook import args, RELATIVE_DIRECTORY_TO_DATA_FILES_LIST, FORM_RESPONSES, FORM_SCHEMA_COLUMNS, \
-    RELATIVE_DIRECTORY_TO_METADATA, METADATA_COLUMNS, EXTRA_DATA_IN_FORM_RESPONSES_TABLE, \
-    EXTRA_COLUMNS_IN_FORM_RESPONSES_TABLE, get_static_data_page_url, MAIN_PAGE_HEADER_FILENAME
-from flipbook.utils import load_jinja_template, get_data_page_url
+from flipbook import MAIN_PAGE_HEADER_FILENAME
+from flipbook.state import get_state, FILTER_URL_PARAM
+from flipbook.tables import PATH_COLUMN
+from flipbook.thumbnails import get_thumbnail_url, get_first_image_path
+from flipbook.utils import load_jinja_template
 
 MAIN_LIST_TEMPLATE = None
 
+# the home page table has these columns before the form and metadata columns. The thumbnail column is only shown
+# with --show-thumbnails.
+PAGE_NUMBER_COLUMN_INDEX = 0
+PATH_COLUMN_INDEX = 1
+THUMBNAIL_COLUMN_INDEX = 2
+
+
+def get_home_page_metadata_columns(state, is_static_website=False):
+    """Returns the metadata columns to show in the home page table"""
+    args = state.args
+    metadata_columns = []
+    if not args.hide_metadata_on_home_page:
+        metadata_columns = list(state.metadata_columns)  # make a copy
+        if args.home_page_metadata_column:
+            metadata_columns = [c for c in metadata_columns if c in args.home_page_metadata_column]
+        if not is_static_website:
+            metadata_columns += state.extra_columns_in_form_responses_table
+
+    return metadata_columns
+
+
+def get_home_page_metadata(state, relative_dir):
+    """Returns the metadata to show in the home page table for the given relative directory"""
+
+    # combine metadata from 2 potential sources: state.relative_directory_to_metadata and
+    # state.extra_data_in_form_responses_table
+    metadata = dict(state.relative_directory_to_metadata.get(relative_dir, {}))
+    metadata.update(state.extra_data_in_form_responses_table.get(relative_dir, {}))
+    return metadata
+
+
+def get_home_page_metadata_dict(state):
+    """Returns a dictionary that maps each relative directory to the metadata to show in the home page table"""
+    metadata_dict = {}
+    if not state.args.hide_metadata_on_home_page:
+        relative_directories = list(state.relative_directory_to_metadata.keys()) + \
+            list(state.extra_data_in_form_responses_table.keys())
+        for relative_dir in relative_directories:
+            metadata_dict[relative_dir] = get_home_page_metadata(state, relative_dir)
+
+    return metadata_dict
+
+
+def get_home_page_thumbnail_width(state, is_static_website=False):
+    """Returns the width of the thumbnails to show in the home page table, or None if thumbnails aren't shown"""
+    args = state.args
+    return args.thumbnail_width if args.show_thumbnails and not is_static_website else None
+
+
+def get_thumbnail_html(relative_path, thumbnail_width):
+    return f'<img loading="lazy" style="max-width: {thumbnail_width}px" ' \
+        f'src="{html.escape(get_thumbnail_url(relative_path, thumbnail_width))}" />'
+
+
+def get_requested_sort_order(state, page_set, is_static_website=False):
+    """Returns the page order requested by the ?sort= and ?filter= url params.
+
+    Args:
+        state (FlipBookState): the server state
+        page_set (PageSet): the snapshot of state.pages that the request is using
+
+    Return:
+        3-tuple: (numpy array of positions in page_set.relative_directory_to_data_files_list, or None for the default
+            order, function that returns the url of a page in this order given its page number and the number of
+            pages, filter expression or "")
+
+    Raises:
+        ValueError: if the filter expression isn't valid
+    """
+    sort_by, reverse, filter_expression = state.get_requested_page_order(request.args) \
+        if not is_static_website else ((), False, "")
+    if not sort_by and not reverse and not filter_expression:
+        return None, state.get_data_page_url_function(), ""
+
+    sort_order = page_set.page_index.get_sort_order(sort_by, reverse, filter_expression)
+    page_order_query_string = state.get_page_order_query_string(sort_by, reverse, filter_expression)
+    return sort_order, state.get_data_page_url_function(sort_order, page_order_query_string, page_set), \
+        filter_expression
+
+
+def get_pages_in_requested_order(state, page_set, is_static_website=False):
+    """Returns the list of pages in the order requested by the ?sort= and ?filter= url params.
+
+    Args:
+        state (FlipBookState): the server state
+        page_set (PageSet): the snapshot of state.pages that the request is using
+
+    Return:
+        3-tuple: (list of (relative directory, data file types and paths) tuples, function that returns the url of a
+            page in this order given its page number and the number of pages, filter expression or "")
+
+    Raises:
+        ValueError: if the filter expression isn't valid
+    """
+    sort_order, get_page_url, filter_expression = get_requested_sort_order(state, page_set, is_static_website)
+    pages = page_set.relative_directory_to_data_files_list
+    if sort_order is None:
+        return pages, get_page_url, ""
+
+    return [pages[position] for position in sort_order], get_page_url, filter_expression
+
 
 def main_list_handler(is_static_website=False):
     global MAIN_LIST_TEMPLATE
+    state = get_state()
+    args = state.args
     if MAIN_LIST_TEMPLATE is None or args.dev_mode:
         MAIN_LIST_TEMPLATE = load_jinja_template("main_list")
 
     if args.verbose:
         print(f"main_list_handler received {request.url}")
 
-    data_files_list = [
-        (page_number + 1, relative_directory, data_file_types_and_paths)
-        for page_number, (relative_directory, data_file_types_and_paths) in enumerate(RELATIVE_DIRECTORY_TO_DATA_FILES_LIST)
-    ]
+    # use the same snapshot of the pages for the whole request, since --watch may replace state.pages
+    page_set = state.pages
+    num_pages = len(page_set.relative_directory_to_data_files_list)
+    filter_error = ""
+    try:
+        pages, get_page_url, filter_expression = get_pages_in_requested_order(state, page_set, is_static_website)
+    except ValueError as e:
+        filter_error = str(e)
+        pages, get_page_url, filter_expression = [], state.get_data_page_url_function(), \
+            request.args.get(FILTER_URL_PARAM)
 
-    # combine metadata from 2 potential sources: RELATIVE_DIRECTORY_TO_METADATA and EXTRA_DATA_IN_FORM_RESPONSES_TABLE
-    metadata_columns = []
+    # for large numbers of pages, the table rows are retrieved from the /api/pages endpoint one page at a time
+    server_side_paging = not is_static_website and num_pages > args.server_side_paging_threshold
+
+    data_files_list = []
+    form_responses_dict = {}
+    metadata_columns = get_home_page_metadata_columns(state, is_static_website)
     metadata_dict = {}
-    if not args.hide_metadata_on_home_page:
-        metadata_columns = list(METADATA_COLUMNS)  # make a copy
-        if not is_static_website:
-            metadata_columns += EXTRA_COLUMNS_IN_FORM_RESPONSES_TABLE
-        for relative_dir in list(RELATIVE_DIRECTORY_TO_METADATA.keys()) + list(EXTRA_DATA_IN_FORM_RESPONSES_TABLE.keys()):
-            metadata_dict[relative_dir] = dict(RELATIVE_DIRECTORY_TO_METADATA.get(relative_dir, {}))
-            metadata_dict[relative_dir].update(dict(EXTRA_DATA_IN_FORM_RESPONSES_TABLE.get(relative_dir, {})))
+    if not server_side_paging:
+        data_files_list = [
+            (page_number + 1, relative_directory, data_file_types_and_paths)
+            for page_number, (relative_directory, data_file_types_and_paths) in enumerate(pages)
+        ]
+        form_responses_dict = state.form_response_store.get_all()
+        metadata_dict = get_home_page_metadata_dict(state)
 
     main_page_header_html = ""
     if os.path.isfile(os.path.join(args.directory, MAIN_PAGE_HEADER_FILENAME)):
@@ -41,14 +159,133 @@ def main_list_handler(is_static_website=False):
     html = MAIN_LIST_TEMPLATE.render(
         header_html=main_page_header_html,
         data_files_list=data_files_list,
-        get_data_page_url=get_data_page_url if not is_static_website else get_static_data_page_url,
-        form_column_names=FORM_SCHEMA_COLUMNS,
-        form_responses_dict=FORM_RESPONSES,
+        num_pages=num_pages,
+        server_side_paging=server_side_paging,
+        num_listed_pages=len(pages),
+        get_data_page_url=get_page_url if not is_static_website else state.get_static_data_page_url,
+        pages_api_url=f"/api/pages?{request.query_string.decode()}" if request.query_string else "/api/pages",
+        export_url=f"/export?{request.query_string.decode()}&" if request.query_string else "/export?",
+        filter_expression=filter_expression,
+        filter_error=filter_error,
+        sort_params=[(name, value) for name, value in request.args.items(multi=True) if name != FILTER_URL_PARAM]
+        if not is_static_website else [],
+        form_column_names=state.form_schema_columns,
+        form_responses_dict=form_responses_dict,
+        num_form_responses=len(state.form_response_store),
         metadata_column_names=metadata_columns,
         metadata_dict=metadata_dict,
+        thumbnail_width=get_home_page_thumbnail_width(state, is_static_website),
+        get_first_image_path=get_first_image_path,
+        get_thumbnail_html=get_thumbnail_html,
         form_responses_table_path=args.form_responses_table,
         is_static_website=is_static_website,
     )
 
     return Response(html, mimetype='text/html')
 
+
+def get_int_param(params, name, default):
+    value = params.get(name, default)
+    try:
+        return int(value)
+    except (ValueError, TypeError) as e:
+        print(f"ERROR: unable to parse parameter {name}: '{value}': {type(e).__name__} {e}. Setting {name} = {default}.")
+        return default
+
+
+def pages_api_handler():
+    """Returns one page of rows for the home page table, using the DataTables server-side processing protocol
+    (see https://datatables.net/manual/server-side). The rows can be filtered by a search string and sorted by any
+    column. Searching and sorting use the page index's column arrays, and form responses and metadata are only
+    retrieved for the returned rows.
+    """
+    state = get_state()
+    params = request.args
+    if state.args.verbose:
+        print(f"pages_api_handler received {request.url}")
+
+    draw = get_int_param(params, "draw", 0)
+    start = max(get_int_param(params, "start", 0), 0)
+    length = get_int_param(params, "length", 100)
+    search_terms = params.get("search[value]", "").lower().split()
+
+    form_schema_columns = state.form_schema_columns
+    metadata_columns = get_home_page_metadata_columns(state)
+    thumbnail_width = get_home_page_thumbnail_width(state)
+    column_names = ["#", PATH_COLUMN] + (["Thumbnail"] if thumbnail_width else []) + form_schema_columns + metadata_columns
+
+    # use the same snapshot of the pages for the whole request, since --watch may replace state.pages
+    page_set = state.pages
+    try:
+        sort_order, get_page_url, _ = get_requested_sort_order(state, page_set)
+    except ValueError as e:
+        return Response(json.dumps({"draw": draw, "error": str(e)}), mimetype='application/json')
+
+    pages, page_index = page_set
+    positions = np.arange(len(pages)) if sort_order is None else sort_order
+    page_numbers = np.arange(1, len(positions) + 1)
+    records_total = len(positions)
+
+    # keep rows that contain all search terms
+    if search_terms:
+        searchable_columns = list(dict.fromkeys([PATH_COLUMN] + form_schema_columns + metadata_columns))
+        page_number_strings = page_numbers.astype(str)
+        is_match = np.ones(len(positions), dtype=bool)
+        for term in search_terms:
+            is_match &= page_index.search(searchable_columns, term)[positions] | \
+                (np.char.find(page_number_strings, term) >= 0)
+        positions = positions[is_match]
+        page_numbers = page_numbers[is_match]
+    records_filtered = len(positions)
+
+    # sort by the requested columns' ranks. np.lexsort(..) is stable and sorts by the last key first.
+    sort_keys = []
+    while f"order[{len(sort_keys)}][column]" in params:
+        column_index = get_int_param(params, f"order[{len(sort_keys)}][column]", PAGE_NUMBER_COLUMN_INDEX)
+        descending = params.get(f"order[{len(sort_keys)}][dir]") == "desc"
+        if column_index == PAGE_NUMBER_COLUMN_INDEX:
+            sort_key = page_numbers
+        elif 0 <= column_index < len(column_names) and not (thumbnail_width and column_index == THUMBNAIL_COLUMN_INDEX):
+            sort_key = page_index.get_ranks(column_names[column_index])[positions]
+        else:
+            sort_key = np.zeros(len(positions), dtype=np.int64)
+        sort_keys.append(-sort_key if descending else sort_key)
+
+    if sort_keys:
+        order = np.lexsort(sort_keys[::-1])
+        positions = positions[order]
+        page_numbers = page_numbers[order]
+
+    end = start + length if length >= 0 else len(positions)
+    positions = positions[start:end]
+    page_numbers = page_numbers[start:end]
+
+    relative_directories = [pages[position][0] for position in positions]
+    form_responses_dict = state.form_response_store.get_many(relative_directories)
+
+    # render the rows the same way as in main_list.html. The path, page url and form responses are escaped, since form
+    # responses are entered by users. Metadata keys and values are treated as html, so they aren't escaped.
+    data = []
+    for position, page_number in zip(positions, page_numbers):
+        relative_directory, data_file_types_and_paths = pages[position]
+        page_number = int(page_number)
+        form_responses = form_responses_dict.get(relative_directory, {})
+        metadata = get_home_page_metadata(state, relative_directory) if metadata_columns else {}
+        row = [
+            f'<span class="keyboard-shortcut">{page_number}</span>' if page_number < 10 else f"{page_number}.",
+            f'<a id="link{page_number}" href="{html.escape(get_page_url(page_number, records_total))}">'
+            f'{html.escape(relative_directory)}</a>',
+        ]
+        if thumbnail_width:
+            first_image_path = get_first_image_path(data_file_types_and_paths)
+            row.append(get_thumbnail_html(first_image_path, thumbnail_width) if first_image_path else "")
+        row += [html.escape(str(form_responses.get(column_name, ''))) for column_name in form_schema_columns]
+        row += [str(metadata.get(column_name, '')) for column_name in metadata_columns]
+        data.append(row)
+
+    return Response(json.dumps({
+        "draw": draw,
+        "recordsTotal": records_total,
+        "recordsFiltered": records_filtered,
+        "data": data,
+    }), mimetype='application/json')
@@ -0,0 +1,194 @@
+"""Command-line options for the FlipBook server.
+
+This module only imports lightweight modules, so that 'flipbook --help' and option errors don't have to wait for
+Flask, pandas or the directory scan.
+"""
+
+import configargparse
+import os
+
+from flipbook.response_store import RESPONSE_STORE_TYPES, MEMORY_RESPONSE_STORE, SQLITE_RESPONSE_STORE
+from flipbook.scan_index import INDEX_COMMAND, SCAN_INDEX_FILENAME
+from flipbook.utils import WEBSITE_DIR, DEFAULT_SCAN_THREADS, LINK_MODES, COPY_LINK_MODE, STATIC_WEBSITE_MODES, \
+    PAGES_STATIC_WEBSITE_MODE, STATIC_WEBSITE_VIEWER_FILENAME
+
+
+def get_argument_parser():
+    p = configargparse.ArgumentParser(
+        formatter_class=configargparse.DefaultsFormatter,
+        add_config_file_help=True,
+        add_env_var_help=True,
+        config_file_parser_class=configargparse.YAMLConfigFileParser,
+        default_config_files=["~/.flipbook_config"],
+        args_for_writing_out_config_file=["--save-current-options-to-config-file"],
+    )
+    p.add_argument("-i", "--include", action="append", help="Only include files whose path contains this keyword")
+    p.add_argument("-x", "--exclude", action="append", help="Skip files whose path contains this keyword. If both "
+                   " --include and --exclude are specified, --exclude takes precedence over --include", default=[WEBSITE_DIR])
+    p.add_argument("-t", "--form-responses-table", default="flipbook_form_responses.tsv",
+                   help="The .tsv, .xls, .parquet or .feather path where form responses are saved. If the file already exists,"
+                        "it will be parsed for previous form responses and then updated as the user fills in the form(s)."
+                        "If the file doesn't exist, it will be created after the 1st form response.")
+    p.add_argument("-m", "--metadata-table", default="flipbook_metadata.tsv",
+                   help="The .tsv, .xls, .parquet or .feather path containing metadata to show on data pages. There are two optional ways "
+                        "to add metadata to the data pages. The 1st way is to put a 'flipbook_metadata.json' file "
+                        "inside a directory that contains images or data files (in which case any key-value pairs from "
+                        "the json file will be shown at the top of the data page that displays those images). "
+                        "The other way is to specify this table, which needs to have a 'Path' column with relative "
+                        "directory paths that contain images and data files. The data page corresponding to those "
+                        "directory paths will then display values from the other columns in this table. If both this table "
+                        "and 'flipbook_metadata.json' files are found, the values from this table will override values in "
+                        "the 'flipbook_metadata.json' files. Parquet and Feather tables require the 'pyarrow' package, and are "
+                        "faster to load than .tsv or .xls tables when they're large.")
+    p.add_argument("--metadata-table-column", action="append", help="Only load this column from the metadata table. Can "
+                   "be specified more than once. By default, all columns are loaded. For Parquet and Feather tables, the "
+                   "other columns aren't read from disk at all.")
+    p.add_argument("-j", "--form-schema-json", help="Path of .json file containing a custom form schema. For the expected format "
+                   "see https://github.com/broadinstitute/flipbook/tree/main/form_schema_examples")
+    p.add_argument("-s", "--sort-by", action="append", help="Order pages by metadata column(s)")
+    p.add_argument("-r", "--reverse-sort", action="store_true", help="Reverses the sort order")
+    p.add_argument("-f", "--filter", help="Only show pages that match this expression, which can refer to metadata and form "
+                   "response columns. For example: 'Verdict == \"\" and coverage > 30'. Column names that contain spaces or "
+                   "other special characters can be quoted with backticks. The filter can also be changed while the server "
+                   "is running by adding a ?filter= param to the home page url.")
+    p.add_argument("--hide-metadata-on-home-page", action="store_true", help="Don't show metadata columns in the "
+                   "home page table")
+    p.add_argument("--home-page-metadata-column", action="append", help="Only show this metadata column in the home page "
+                   "table. Can be specified more than once. By default, all metadata columns are shown.")
+    p.add_argument("--lazy-metadata", action="store_true", help="At startup, only keep the keys from "
+                   "flipbook_metadata.json files that are needed for the home page table (see "
+                   "--home-page-metadata-column and --hide-metadata-on-home-page) and for --sort-by and --filter, and "
+                   "read the rest of each file when its page is first opened. If no keys are needed, the files aren't "
+                   "read at startup at all. This makes startup faster and uses less memory when the metadata files are "
+                   "large. The ?sort= and ?filter= url params can then only use the metadata columns that are kept at "
+                   "startup.")
+    p.add_argument("--server-side-paging-threshold", type=int, default=5000, help="If there are more than this many "
+                   "pages, the home page table will retrieve rows from the server one page at a time instead of "
+                   "including all rows in the home page html")
+    p.add_argument("--show-thumbnails", action="store_true", help="Show a thumbnail of the first image on each page in "
+                   "the home page table. Thumbnails are created on demand and require the 'Pillow' package.")
+    p.add_argument("--thumbnail-width", type=int, default=128, help="Width in pixels of the thumbnails shown with "
+                   "--show-thumbnails")
+    p.add_argument("--max-image-width", type=int, help="On data pages, show versions of images that are scaled down to "
+                   "at most this many pixels wide, to reduce the amount of data sent to the browser. Clicking an image "
+                   "loads the full-resolution version. Requires the 'Pillow' package.")
+    p.add_argument("--thumbnail-cache-dir", help="Directory for storing scaled-down images, relative to the top-level "
+                   "directory. The default is a hidden directory named .flipbook_thumbnails. If you change it, use a "
+                   "hidden directory or one outside the top-level directory, so the cached images aren't shown as pages.")
+    p.add_argument("--thumbnail-cache-size", type=float, default=500, help="Max. total size in megabytes of the "
+                   "scaled-down images in --thumbnail-cache-dir. When it's exceeded, the least recently used images are "
+                   "deleted.")
+    p.add_argument("--add-metadata-to-form-responses-table", action="store_true", help="Also write metadata columns to the "
+                   "form responses table when saving users' form responses")
+    p.add_argument("-l", "--show-one-key-per-line", action="store_true", help="At the top of the data pages, show one key per line.")
+    p.add_argument("-b", "--open-browser", action="store_true", help="Open a web browser after starting the server")
+    p.add_argument("--generate-static-website", action="store_true", help="Instead of starting a web server, this option "
+                   "causes FlipBook to write out a set of static html pages for all the images it finds and then exit. "
+                   "The generated pages can then be viewed in a browser, uploaded to some other web server (such as "
+                   "GitHub Pages, embedded in another existing website, etc. The generated web pages are identical to "
+                   "the standard FlipBook user interface except they don't contain the forms for entering responses about "
+                   "each image - and so just allow flipping through the images.")
+
+    p.add_argument("--static-website-mode", choices=STATIC_WEBSITE_MODES, default=PAGES_STATIC_WEBSITE_MODE, help="With "
+                   "--generate-static-website, whether to write a separate html file for each page, or a single "
+                   f"{STATIC_WEBSITE_VIEWER_FILENAME} page that loads the pages from a sharded json manifest and flips "
+                   "between them without reloading. The 'single-page' mode writes far fewer files, which makes large "
+                   "websites faster to upload.")
+    p.add_argument("--static-website-shard-size", type=int, default=1000, help="With --static-website-mode single-page, "
+                   "number of pages in each json manifest file")
+    p.add_argument("--static-website-processes", type=int, default=os.cpu_count() or 1, help="With "
+                   "--generate-static-website, number of processes to use for rendering pages and copying images")
+    p.add_argument("--static-website-link-mode", choices=LINK_MODES, default=COPY_LINK_MODE, help="With "
+                   "--generate-static-website, whether to copy images into the website directory, or to create hardlinks "
+                   "or reflinks (copy-on-write clones) which don't use additional disk space. Falls back on copying if "
+                   "the filesystem doesn't support the selected mode.")
+    p.add_argument("--static-website-gzip", action="store_true", help="With --generate-static-website, also write a "
+                   "gzip-compressed .html.gz file next to each .html file, for web servers that can serve precompressed "
+                   "files.")
+    p.add_argument("-z", "--zoom", type=float, help="Optional zoom factor for images. This can be > or < 1.0")
+    p.add_argument("--scroll-to-image", action="store_true", help="Automatically scroll to the image after opening the data page.")
+    p.add_argument("--autosave-form", action="store_true", help="Automatically save form responses after each change")
+    p.add_argument("--response-store", choices=RESPONSE_STORE_TYPES, default=MEMORY_RESPONSE_STORE, help="Where to keep "
+                   "form responses while the server is running. 'memory' keeps them in memory and appends each response "
+                   "to a journal file next to the form responses table. 'sqlite' keeps them in a SQLite database next to "
+                   "the form responses table, which allows several users to save responses at the same time. In both "
+                   "cases, the form responses table is periodically updated in the background.")
+    p.add_argument("--journal-fsync-interval", type=float, default=1.0, help="With '--response-store memory', form "
+                   "responses are appended to a journal file next to the form responses table when they're saved. This is "
+                   "the max. number of seconds before new journal entries are flushed to disk.")
+    p.add_argument("--table-update-interval", type=float, default=30.0, help="Number of seconds between updates of the "
+                   "form responses table with newly saved form responses. The table is also updated when the server "
+                   "shuts down.")
+
+    #p.add_argument("-c", "--config-file", help="Path of yaml config file", env_var="FLIPBOOK_CONFIG_FILE")
+    p.add_argument("--prefetch-depth", type=int, default=1, help="On each data page, tell the browser to prefetch the "
+                   "previous page and this many next pages, along with their images, so that flipping to them is "
+                   "instant. Set to 0 to disable prefetching.")
+    p.add_argument("--prefetch-max-mb", type=float, default=20, help="Max. total size in megabytes of the images that "
+                   "each data page prefetches. Images are prefetched in order of the pages the user is most likely to "
+                   "open next, until this limit is reached.")
+    p.add_argument("--page-cache-size", type=int, default=256, help="Number of rendered data pages to keep in memory so "
+                   "that revisiting a page doesn't require rendering it again. Set to 0 to disable. Cache hit and miss "
+                   "counts are available at /api/page-cache-stats")
+    p.add_argument("--index-file", default=SCAN_INDEX_FILENAME, help="Path of the scan index file, relative to the "
+                   f"top-level directory. If this file exists (eg. after running 'flipbook {INDEX_COMMAND}'), it's used to "
+                   "find images and data files instead of searching the whole directory tree, and is refreshed by "
+                   "re-listing only the directories that changed since it was created.")
+    p.add_argument("--skip-index-refresh", action="store_true", help="Use the scan index as-is, without checking for "
+                   "directories that changed since it was created")
+    p.add_argument("--watch", action="store_true", help="Watch the directory for new, changed or deleted images and "
+                   "data files while the server is running, and update the pages without restarting the server. This "
+                   "uses inotify via the 'watchdog' package if it's installed, and otherwise checks for changes every "
+                   "--watch-interval seconds.")
+    p.add_argument("--watch-interval", type=float, default=5.0, help="With --watch, number of seconds between checks "
+                   "for changes when the 'watchdog' package isn't installed.")
+    p.add_argument("--scan-threads", type=int, default=DEFAULT_SCAN_THREADS, help="Number of directories to list in "
+                   "parallel when searching for images and data files")
+    p.add_argument("-v", "--verbose", action='count', default=0, help="Print more info")
+    p.add_argument("--host", default="127.0.0.1", env_var="HOST", help="Listen for connections on this hostname or IP")
+    p.add_argument("-p", "--port", default="8080", env_var="PORT", type=int, help="Listen for connections on this port")
+    p.add_argument("--dev-mode", action="store_true", env_var="DEV", help="Run server in developer mode so it reloads "
+                   "html templates and source code if they're changed")
+    p.add_argument("-w", "--workers", type=int, help="Run a production server with this many worker processes, "
+                   "using gunicorn, instead of the single-process development server. The directory is scanned once "
+                   "before the workers start, and they share the list of pages and metadata. With more than 1 worker, "
+                   "form responses are kept in a SQLite database (see --response-store) so that responses saved by "
+                   "any worker are visible to all of them. Not available on Windows.")
+    p.add_argument("--worker-threads", type=int, default=4, help="With --workers, number of threads in each worker "
+                   "process for handling requests")
+    p.add_argument("directory", default=".", nargs="?", help="Top-level directory to search for images and data files")
+
+    return p
+
+
+def parse_args(argv=None):
+    """Parses and validates the command-line options.
+
+    Args:
+        argv (list): command-line args, not including the program name. Defaults to sys.argv[1:].
+
+    Return:
+        2-tuple: (the argument parser, the parsed args)
+    """
+    p = get_argument_parser()
+    args = p.parse_args(argv)
+
+    if args.verbose > 1:
+        p.print_values()
+
+    if not os.path.isdir(args.directory):
+        p.error(f"{args.directory} directory not found")
+
+    args.directory = os.path.realpath(args.directory)
+
+    if args.workers is not None:
+        if args.workers < 1 or args.worker_threads < 1:
+            p.error("--workers and --worker-threads must be at least 1")
+        if args.dev_mode:
+            p.error("--dev-mode can't be used with --workers")
+        if args.workers > 1 and args.response_store == MEMORY_RESPONSE_STORE:
+            print(f"NOTE: using '--response-store {SQLITE_RESPONSE_STORE}' since form responses need to be shared "
+                  f"between --workers")
+            args.response_store = SQLITE_RESPONSE_STORE
+
+    return p, args
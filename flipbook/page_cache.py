@@ -0,0 +1,109 @@
+"""An in-memory LRU cache of rendered data pages.
+
+A rendered page only changes when its form responses, its metadata or one of its files change. Form responses and
+metadata are tracked with version counters that are incremented by invalidate_page(..) and invalidate_all_pages(), and
+file changes are detected by including the files' sizes and mtimes in the cache key.
+"""
+
+import collections
+import json
+import os
+import threading
+
+from flask import Response
+
+PAGE_CACHE_LOCK = threading.Lock()
+RENDERED_PAGES = collections.OrderedDict()  # maps cache key => html, least recently used first
+PAGE_CACHE_MAX_SIZE = 0
+
+# version counters that are part of each cache key
+RELATIVE_DIRECTORY_TO_PAGE_VERSION = collections.defaultdict(int)
+ALL_PAGES_VERSION = 0
+
+PAGE_CACHE_STATS = {"hits": 0, "misses": 0, "invalidations": 0}
+
+
+def set_page_cache_size(max_size):
+    """Sets the max. number of rendered pages to keep. 0 disables the cache."""
+    global PAGE_CACHE_MAX_SIZE
+    with PAGE_CACHE_LOCK:
+        PAGE_CACHE_MAX_SIZE = max(max_size, 0)
+        while len(RENDERED_PAGES) > PAGE_CACHE_MAX_SIZE:
+            RENDERED_PAGES.popitem(last=False)
+
+
+def get_file_stats(paths):
+    """Returns a tuple of (size, mtime) for each path, or None for paths that don't exist"""
+    file_stats = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            file_stats.append((stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            file_stats.append(None)
+
+    return tuple(file_stats)
+
+
+def get_page_cache_key(relative_dir, page_params, file_paths):
+    """Returns the key for a rendered page.
+
+    Args:
+        relative_dir (str): the page's relative directory
+        page_params (tuple): other values that the rendered html depends on, such as the page number
+        file_paths (list): paths of the files whose contents are included in the page
+    """
+    with PAGE_CACHE_LOCK:
+        versions = (RELATIVE_DIRECTORY_TO_PAGE_VERSION.get(relative_dir, 0), ALL_PAGES_VERSION)
+
+    return (relative_dir, page_params, versions, get_file_stats(file_paths))
+
+
+def get_rendered_page(cache_key):
+    """Returns the cached html for the given key, or None"""
+    with PAGE_CACHE_LOCK:
+        html = RENDERED_PAGES.get(cache_key)
+        if html is None:
+            PAGE_CACHE_STATS["misses"] += 1
+            return None
+
+        RENDERED_PAGES.move_to_end(cache_key)
+        PAGE_CACHE_STATS["hits"] += 1
+
+    return html
+
+
+def put_rendered_page(cache_key, html):
+    with PAGE_CACHE_LOCK:
+        if PAGE_CACHE_MAX_SIZE <= 0:
+            return
+        RENDERED_PAGES[cache_key] = html
+        RENDERED_PAGES.move_to_end(cache_key)
+        while len(RENDERED_PAGES) > PAGE_CACHE_MAX_SIZE:
+            RENDERED_PAGES.popitem(last=False)
+
+
+def invalidate_page(relative_dir):
+    """Marks the cached html for the given page as stale, for example after its form responses change"""
+    with PAGE_CACHE_LOCK:
+        RELATIVE_DIRECTORY_TO_PAGE_VERSION[relative_dir] += 1
+        PAGE_CACHE_STATS["invalidations"] += 1
+
+
+def invalidate_all_pages():
+    """Marks all cached html as stale, for example after the metadata or the list of pages changes"""
+    global ALL_PAGES_VERSION
+    with PAGE_CACHE_LOCK:
+        ALL_PAGES_VERSION += 1
+        PAGE_CACHE_STATS["invalidations"] += 1
+        RENDERED_PAGES.clear()
+
+
+def page_cache_stats_handler():
+    """Returns the page cache hit and miss counters"""
+    with PAGE_CACHE_LOCK:
+        stats = dict(PAGE_CACHE_STATS)
+        stats["size"] = len(RENDERED_PAGES)
+        stats["max_size"] = PAGE_CACHE_MAX_SIZE
+
+    return Response(json.dumps(stats), mimetype='application/json')
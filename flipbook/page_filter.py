@@ -0,0 +1,210 @@
+"""Filter expressions for selecting a subset of pages based on their metadata and form response values.
+
+Expressions use Python syntax, for example:
+
+    Verdict == "" and coverage > 30
+    Confidence in ["borderline", ""] or not Notes
+    "chr1" in Path and 10 <= `repeat size` < 100
+
+Column names that aren't valid Python identifiers can be quoted with backticks. A column name on its own is true for
+pages that have a value in that column. Comparisons with numbers are only true for pages whose value is a number,
+while comparisons with strings compare the values as text, with missing values treated as "". `"x" in column` checks
+whether the value contains "x", and `column in [..]` checks whether it's one of the listed values.
+
+Expressions are evaluated on whole columns at once using the numpy arrays from the page index, rather than page by
+page.
+"""
+
+import ast
+import numbers
+import operator
+import re
+
+import numpy as np
+
+BACKTICK_QUOTED_COLUMN_REGEX = re.compile("`([^`]+)`")
+
+# maps each comparison operator to (function for comparing arrays, function for comparing 2 constants)
+COMPARISON_OPERATORS = {
+    ast.Eq: (np.equal, operator.eq),
+    ast.NotEq: (np.not_equal, operator.ne),
+    ast.Lt: (np.less, operator.lt),
+    ast.LtE: (np.less_equal, operator.le),
+    ast.Gt: (np.greater, operator.gt),
+    ast.GtE: (np.greater_equal, operator.ge),
+}
+
+
+class Column:
+    """The values of one column for all pages, as arrays"""
+
+    def __init__(self, numbers_array, strings_array, is_missing):
+        """
+        Args:
+            numbers_array (numpy array): float values, with NaN for values that aren't numbers
+            strings_array (numpy array): values converted to strings, with "" for missing values
+            is_missing (numpy array): booleans that are True for missing values
+        """
+        self.numbers = numbers_array
+        self.strings = strings_array
+        self.is_missing = is_missing
+
+
+def is_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+class PageFilter:
+    """A parsed filter expression"""
+
+    def __init__(self, expression):
+        """Parses the given expression.
+
+        Raises:
+            ValueError: if the expression isn't valid
+        """
+        self.expression = expression
+
+        # replace `quoted column names` with placeholder identifiers so the expression can be parsed as Python
+        self._placeholder_to_column = {}
+
+        def replace_quoted_column(match):
+            placeholder = f"__column{len(self._placeholder_to_column)}__"
+            self._placeholder_to_column[placeholder] = match.group(1)
+            return placeholder
+
+        self._source = BACKTICK_QUOTED_COLUMN_REGEX.sub(replace_quoted_column, expression).strip()
+        try:
+            self._tree = ast.parse(self._source, mode="eval").body
+        except SyntaxError as e:
+            raise ValueError(f"Unable to parse filter expression '{expression}': {e.msg}")
+
+        self.columns = set()
+        self._validate(self._tree)
+
+    def _get_column_name(self, node):
+        return self._placeholder_to_column.get(node.id, node.id)
+
+    def _validate(self, node):
+        """Checks that the expression only contains supported syntax, and records the column names it uses"""
+        if isinstance(node, ast.BoolOp):
+            for value in node.values:
+                self._validate(value)
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            self._validate(node.operand)
+        elif isinstance(node, ast.Compare):
+            for operand in [node.left] + node.comparators:
+                self._validate(operand)
+            for op in node.ops:
+                if type(op) not in COMPARISON_OPERATORS and not isinstance(op, (ast.In, ast.NotIn)):
+                    raise ValueError(f"Unsupported operator in filter expression '{self.expression}': "
+                                     f"{type(op).__name__}")
+        elif isinstance(node, ast.Name):
+            self.columns.add(self._get_column_name(node))
+        elif isinstance(node, (ast.List, ast.Tuple)):
+            for element in node.elts:
+                if self._get_constant(element) is None:
+                    raise ValueError(f"Lists in filter expression '{self.expression}' can only contain strings and "
+                                     f"numbers")
+        elif self._get_constant(node) is None:
+            raise ValueError(f"Unsupported syntax in filter expression '{self.expression}': "
+                             f"{ast.get_source_segment(self._source, node) or type(node).__name__}")
+
+    @staticmethod
+    def _get_constant(node):
+        """Returns the value of a string, number or boolean constant node, or None if it's not a constant"""
+        if isinstance(node, ast.Constant) and isinstance(node.value, (str, int, float, bool)):
+            return node.value
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)) and \
+                isinstance(node.operand, ast.Constant) and is_number(node.operand.value):
+            return -node.operand.value if isinstance(node.op, ast.USub) else node.operand.value
+        return None
+
+    def evaluate(self, get_column, num_pages):
+        """Returns a numpy array of booleans that are True for pages that match this filter.
+
+        Args:
+            get_column (function): takes a column name and returns a Column object with its values
+            num_pages (int): the number of pages
+        """
+        return self._evaluate_as_bool(self._tree, get_column, num_pages)
+
+    def _evaluate_as_bool(self, node, get_column, num_pages):
+        result = self._evaluate(node, get_column, num_pages)
+        if isinstance(result, Column):
+            result = ~result.is_missing
+        elif not isinstance(result, np.ndarray):
+            result = np.full(num_pages, bool(result))
+
+        return result
+
+    def _evaluate(self, node, get_column, num_pages):
+        if isinstance(node, ast.BoolOp):
+            results = [self._evaluate_as_bool(value, get_column, num_pages) for value in node.values]
+            return np.logical_and.reduce(results) if isinstance(node.op, ast.And) else np.logical_or.reduce(results)
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return ~self._evaluate_as_bool(node.operand, get_column, num_pages)
+        elif isinstance(node, ast.Compare):
+            # chained comparisons like 10 < x < 20 are evaluated as 10 < x and x < 20
+            result = np.ones(num_pages, dtype=bool)
+            left = self._evaluate(node.left, get_column, num_pages)
+            for op, comparator in zip(node.ops, node.comparators):
+                right = self._evaluate(comparator, get_column, num_pages)
+                result &= self._compare(op, left, right, num_pages)
+                left = right
+            return result
+        elif isinstance(node, ast.Name):
+            return get_column(self._get_column_name(node))
+        elif isinstance(node, (ast.List, ast.Tuple)):
+            return [self._get_constant(element) for element in node.elts]
+        else:
+            return self._get_constant(node)
+
+    def _compare(self, op, left, right, num_pages):
+        if isinstance(op, (ast.In, ast.NotIn)):
+            result = self._contains(left, right, num_pages)
+            return ~result if isinstance(op, ast.NotIn) else result
+
+        compare, compare_constants = COMPARISON_OPERATORS[type(op)]
+        if not isinstance(left, Column) and not isinstance(right, Column):
+            try:
+                return np.full(num_pages, bool(compare_constants(left, right)))
+            except TypeError as e:
+                raise ValueError(f"Unable to evaluate filter expression '{self.expression}': {e}")
+
+        if isinstance(left, Column) and isinstance(right, Column):
+            # compare as numbers where both values are numbers, and as strings otherwise
+            both_numbers = ~np.isnan(left.numbers) & ~np.isnan(right.numbers)
+            return np.where(both_numbers, compare(left.numbers, right.numbers), compare(left.strings, right.strings))
+
+        column, value, reflected = (left, right, False) if isinstance(left, Column) else (right, left, True)
+        if isinstance(value, list):
+            raise ValueError(f"Lists can only be used with 'in' in filter expression '{self.expression}'")
+
+        if is_number(value):
+            with np.errstate(invalid="ignore"):
+                result = compare(value, column.numbers) if reflected else compare(column.numbers, value)
+            if isinstance(op, ast.NotEq):
+                result |= np.isnan(column.numbers)
+            return result
+
+        value = str(value)
+        return compare(value, column.strings) if reflected else compare(column.strings, value)
+
+    def _contains(self, left, right, num_pages):
+        if isinstance(right, list):
+            # column in [..] or "x" in [..]
+            string_values = [str(v) for v in right if not is_number(v)]
+            number_values = [v for v in right if is_number(v)]
+            if not isinstance(left, Column):
+                return np.full(num_pages, left in right)
+            return np.isin(left.strings, string_values) | np.isin(left.numbers, number_values)
+
+        if not isinstance(right, Column):
+            raise ValueError(f"The right side of 'in' must be a column or a list in filter expression "
+                             f"'{self.expression}'")
+
+        if isinstance(left, Column):
+            return np.array([a in b for a, b in zip(left.strings.tolist(), right.strings.tolist())], dtype=bool)
+
+        return np.char.find(right.strings, str(left)) >= 0
@@ -0,0 +1,305 @@
+"""A column-oriented index of the pages, used to sort and filter them by metadata or form response columns at runtime.
+
+Each column is stored as a numpy array that has the rank of each page's value, so pages can be sorted by any
+combination of columns with one np.lexsort(..) call. Page orders are cached, and a reversed order is a reversed view of
+the cached order, so it costs nothing. Filter expressions (see page_filter.py) are evaluated on the columns' number and
+string arrays, and their results are cached too. Since filter expressions and sort columns come from url params, only the
+most recently used MAX_CACHED_FILTERS filters and MAX_CACHED_SORT_ORDERS page orders are kept.
+"""
+
+import collections
+import numbers
+import threading
+
+import numpy as np
+
+from flipbook.page_filter import Column, PageFilter
+
+NUMBER_VALUE_TYPE = "number"
+TEXT_VALUE_TYPE = "text"
+MISSING_VALUE_TYPE = "missing"
+
+MAX_CACHED_FILTERS = 32
+MAX_CACHED_SORT_ORDERS = 64
+
+# values are sorted by type first: numbers, then text, then missing values
+VALUE_TYPE_SORT_ORDER = {NUMBER_VALUE_TYPE: 0, TEXT_VALUE_TYPE: 1, MISSING_VALUE_TYPE: 2}
+
+
+def get_value_type(value):
+    if value is None or value == "" or (isinstance(value, float) and np.isnan(value)):
+        return MISSING_VALUE_TYPE
+    if isinstance(value, numbers.Real) and not isinstance(value, bool):
+        return NUMBER_VALUE_TYPE
+    return TEXT_VALUE_TYPE
+
+
+def get_column_arrays(values):
+    """Converts a column's values to numpy arrays that are used for sorting and filtering pages.
+
+    Return:
+        3-tuple: (array with the rank of each value, dict that maps each value type to the number of values with that
+            type, page_filter.Column with the values as numbers and strings). Equal values have equal ranks. Numbers
+            are sorted numerically and before all other values, which are sorted as strings. Missing values are
+            sorted last.
+    """
+    value_types = [get_value_type(value) for value in values]
+    type_keys = np.array([VALUE_TYPE_SORT_ORDER[value_type] for value_type in value_types], dtype=np.int8)
+    number_values = np.array([
+        float(value) if value_type == NUMBER_VALUE_TYPE else np.nan for value, value_type in zip(values, value_types)
+    ], dtype=np.float64)
+    string_values = np.array([
+        str(value) if value_type != MISSING_VALUE_TYPE else "" for value, value_type in zip(values, value_types)
+    ], dtype=str)
+
+    # numbers are sorted by number_keys, and other values by text_keys
+    is_number = type_keys == VALUE_TYPE_SORT_ORDER[NUMBER_VALUE_TYPE]
+    number_keys = np.where(is_number, number_values, 0.0)
+    text_keys = np.where(is_number, "", string_values)
+
+    ranks = np.zeros(len(values), dtype=np.int64)
+    if len(values) > 0:
+        order = np.lexsort((text_keys, number_keys, type_keys))
+        sorted_type_keys = type_keys[order]
+        sorted_number_keys = number_keys[order]
+        sorted_text_keys = text_keys[order]
+        # a value's rank is the number of distinct values before it
+        is_new_value = (sorted_type_keys[1:] != sorted_type_keys[:-1]) | \
+            (sorted_number_keys[1:] != sorted_number_keys[:-1]) | \
+            (sorted_text_keys[1:] != sorted_text_keys[:-1])
+        ranks[order[1:]] = np.cumsum(is_new_value)
+
+    type_counts = {value_type: value_types.count(value_type) for value_type in VALUE_TYPE_SORT_ORDER}
+    column = Column(number_values, string_values, type_keys == VALUE_TYPE_SORT_ORDER[MISSING_VALUE_TYPE])
+
+    return ranks, type_counts, column
+
+
+class PageIndex:
+    """Sorts and filters a list of pages by their column values, and caches the results."""
+
+    def __init__(self, pages, get_column_values):
+        """
+        Args:
+            pages (list): the list of (relative directory, data files) tuples. Page orders are arrays of positions in
+                this list. If the list is changed, reset() must be called. See also PageSet.
+            get_column_values (function): takes a list of relative directories and a column name, and returns the list
+                of values of that column for those pages
+        """
+        self._pages = pages
+        self._get_column_values = get_column_values
+        self._lock = threading.Lock()
+        self._num_pages = len(pages)
+        self._columns = {}  # maps column name => (ranks array, value type counts, page_filter.Column)
+        # maps (tuple of column names, filter expression) => array of positions in self._pages, in LRU order
+        self._sort_orders = collections.OrderedDict()
+        self._filters = collections.OrderedDict()  # maps filter expression => PageFilter, in LRU order
+        # maps filter expression => array of booleans that are True for matching pages. Only has expressions that are
+        # in self._filters.
+        self._filter_masks = {}
+        self._search_strings = {}  # maps column name => array of the column's values as lowercase strings
+        self._positions = None  # maps relative directory => position in self._pages
+
+    def _clear(self):
+        self._num_pages = len(self._pages)
+        self._columns.clear()
+        self._sort_orders.clear()
+        self._filter_masks.clear()
+        self._search_strings.clear()
+        self._positions = None
+
+    def reset(self):
+        """Discards all cached columns and page orders, for example after the list of pages or the metadata changes"""
+        with self._lock:
+            self._clear()
+
+    def invalidate_columns(self, columns):
+        """Discards the cached values of the given columns, and page orders and filter results that depend on them,
+        for example after form responses are saved
+        """
+        columns = set(columns)
+        with self._lock:
+            for column in columns & set(self._columns):
+                del self._columns[column]
+            for column in columns & set(self._search_strings):
+                del self._search_strings[column]
+            for expression in [e for e in self._filter_masks if columns & self._filters[e].columns]:
+                del self._filter_masks[expression]
+            for sort_by, expression in list(self._sort_orders):
+                if columns & set(sort_by) or (expression and columns & self._filters[expression].columns):
+                    del self._sort_orders[(sort_by, expression)]
+
+    def _get_column(self, column):
+        """Returns the (ranks array, value type counts, page_filter.Column) for the given column. Must be called with
+        self._lock held.
+        """
+        if column not in self._columns:
+            relative_directories = [relative_dir for relative_dir, _ in self._pages]
+            self._columns[column] = get_column_arrays(self._get_column_values(relative_directories, column))
+
+        return self._columns[column]
+
+    def get_value_type_counts(self, column):
+        """Returns a dict that maps each value type (number, text, missing) to the number of pages with that type of
+        value in the given column
+        """
+        with self._lock:
+            return dict(self._get_column(column)[1])
+
+    def get_ranks(self, column):
+        """Returns an array with the rank of each page's value in the given column, in the same order as the list of
+        pages. Equal values have equal ranks, and missing values have the highest rank.
+        """
+        with self._lock:
+            if self._num_pages != len(self._pages):
+                self._clear()
+            return self._get_column(column)[0]
+
+    def search(self, columns, search_term):
+        """Returns an array of booleans that are True for pages where the value of at least one of the given columns
+        contains the given lowercase search term.
+        """
+        with self._lock:
+            if self._num_pages != len(self._pages):
+                self._clear()
+            matches = np.zeros(self._num_pages, dtype=bool)
+            for column in columns:
+                if column not in self._search_strings:
+                    self._search_strings[column] = np.char.lower(self._get_column(column)[2].strings)
+                matches |= np.char.find(self._search_strings[column], search_term) >= 0
+
+            return matches
+
+    def _get_filter(self, filter_expression):
+        """Returns the parsed PageFilter for the given expression. If this evicts the least recently used filter from
+        the cache, its results are discarded too. Must be called with self._lock held.
+
+        Raises:
+            ValueError: if the expression isn't valid
+        """
+        if filter_expression in self._filters:
+            self._filters.move_to_end(filter_expression)
+            return self._filters[filter_expression]
+
+        page_filter = PageFilter(filter_expression)
+        self._filters[filter_expression] = page_filter
+        while len(self._filters) > MAX_CACHED_FILTERS:
+            evicted_expression, _ = self._filters.popitem(last=False)
+            self._filter_masks.pop(evicted_expression, None)
+            for key in [key for key in self._sort_orders if key[1] == evicted_expression]:
+                del self._sort_orders[key]
+
+        return page_filter
+
+    def get_filter(self, filter_expression):
+        """Returns the parsed PageFilter for the given expression.
+
+        Raises:
+            ValueError: if the expression isn't valid
+        """
+        with self._lock:
+            return self._get_filter(filter_expression)
+
+    def _get_filter_mask(self, filter_expression):
+        """Returns an array of booleans that are True for pages that match the given filter. Must be called with
+        self._lock held.
+        """
+        page_filter = self._get_filter(filter_expression)
+        if filter_expression not in self._filter_masks:
+            self._filter_masks[filter_expression] = page_filter.evaluate(
+                lambda column: self._get_column(column)[2], self._num_pages)
+
+        return self._filter_masks[filter_expression]
+
+    def _get_cached_sort_order(self, key, compute_sort_order):
+        """Returns the cached page order for the given (tuple of column names, filter expression) key, or computes it
+        with compute_sort_order() and caches it, evicting the least recently used page order if the cache is full.
+        Must be called with self._lock held.
+        """
+        if key in self._sort_orders:
+            self._sort_orders.move_to_end(key)
+            return self._sort_orders[key]
+
+        sort_order = compute_sort_order()
+        self._sort_orders[key] = sort_order
+        while len(self._sort_orders) > MAX_CACHED_SORT_ORDERS:
+            self._sort_orders.popitem(last=False)
+
+        return sort_order
+
+    def get_sort_order(self, sort_by, reverse=False, filter_expression=None):
+        """Returns the positions of the pages in self._pages, ordered by the given columns. Pages with equal values
+        keep their current order.
+
+        Args:
+            sort_by (tuple): column names. The pages are ordered by the 1st column, then by the 2nd column, etc.
+            reverse (bool): whether to reverse the order
+            filter_expression (str): optional filter expression. If specified, only the positions of pages that match
+                it are returned.
+
+        Raises:
+            ValueError: if the filter expression isn't valid
+        """
+        sort_by = tuple(sort_by)
+        filter_expression = filter_expression or ""
+
+        with self._lock:
+            if self._num_pages != len(self._pages):
+                # the list of pages changed before reset() was called
+                self._clear()
+
+            def compute_sort_order():
+                if sort_by:
+                    # np.lexsort(..) sorts by the last key first
+                    return np.lexsort([self._get_column(column)[0] for column in reversed(sort_by)])
+                return np.arange(self._num_pages)
+
+            sort_order = self._get_cached_sort_order((sort_by, ""), compute_sort_order)
+            if filter_expression:
+                unfiltered_sort_order = sort_order
+                sort_order = self._get_cached_sort_order(
+                    (sort_by, filter_expression),
+                    lambda: unfiltered_sort_order[self._get_filter_mask(filter_expression)[unfiltered_sort_order]])
+
+        return sort_order[::-1] if reverse else sort_order
+
+    def get_position(self, relative_dir):
+        """Returns the position of the given page in self._pages, or None if it's not there"""
+        with self._lock:
+            if self._num_pages != len(self._pages):
+                self._clear()
+            if self._positions is None:
+                self._positions = {relative_dir: i for i, (relative_dir, _) in enumerate(self._pages)}
+
+            return self._positions.get(relative_dir)
+
+    def get_page_number(self, position, sort_by, reverse=False, filter_expression=None):
+        """Returns the 1-based page number of the page at the given position in self._pages, in the given order, or
+        None if the page doesn't match the filter
+        """
+        page_numbers = np.flatnonzero(self.get_sort_order(sort_by, reverse, filter_expression) == position)
+        return int(page_numbers[0]) + 1 if len(page_numbers) > 0 else None
+
+
+class PageSet(collections.namedtuple("PageSet", ["relative_directory_to_data_files_list", "page_index"])):
+    """The list of pages together with its PageIndex. Positions from a PageIndex are only valid in its own list, so
+    with --watch, state.pages is replaced with a new PageSet in one assignment instead of changing the list in place,
+    and request handlers read state.pages once and use that snapshot for the whole request.
+
+    Attributes:
+        relative_directory_to_data_files_list (tuple): the (relative directory, data files) tuples of the pages
+        page_index (PageIndex): the index of these pages
+    """
+    __slots__ = ()
+
+    @classmethod
+    def create(cls, relative_directory_to_data_files_list, get_column_values):
+        """Returns a new PageSet with the given pages and a new PageIndex for them.
+
+        Args:
+            relative_directory_to_data_files_list (list): the (relative directory, data files) tuples of the pages
+            get_column_values (function): see PageIndex
+        """
+        relative_directory_to_data_files_list = tuple(relative_directory_to_data_files_list)
+        return cls(relative_directory_to_data_files_list,
+                   PageIndex(relative_directory_to_data_files_list, get_column_values))
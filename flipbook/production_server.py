@@ -0,0 +1,55 @@
+"""With --workers, FlipBook runs under gunicorn instead of Flask's development server.
+
+The app is created in gunicorn's main process before the workers are forked (gunicorn's preload_app setting), so the
+directory is only scanned once, and the workers share the list of pages, the metadata and the page index copy-on-write
+rather than each building its own copy. Background threads, such as the one that updates the form responses table, don't
+survive a fork, so they're started in each worker after it's forked.
+"""
+
+import gc
+
+
+def run_production_server(app, host, port, workers, threads, start_worker, verbose=0):
+    """Serves the app with gunicorn until the server is stopped.
+
+    Args:
+        app (flask.Flask): the app, created by create_app(..)
+        host (str): hostname or IP to listen on
+        port (int): port to listen on
+        workers (int): number of worker processes
+        threads (int): number of request-handling threads in each worker process
+        start_worker (function): called in each worker process after it's forked, with the app as the only arg
+        verbose (int): if > 0, print a line for each request
+
+    Raises:
+        ImportError: if gunicorn isn't installed
+    """
+    from gunicorn.app.base import BaseApplication
+
+    class FlipBookApplication(BaseApplication):
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    options = {
+        "bind": f"{host}:{port}",
+        "workers": workers,
+        "threads": threads,
+        "preload_app": True,
+        "post_fork": lambda server, worker: start_worker(app),
+        "accesslog": "-" if verbose else None,
+    }
+
+    # objects created before the fork, such as the scanned pages and their metadata, are never freed, so move them out
+    # of the garbage collector's view. Otherwise, each collection in a worker would touch them and cause their memory
+    # pages to be copied into the worker.
+    gc.freeze()
+
+    FlipBookApplication(options).run()
@@ -0,0 +1,400 @@
+import abc
+import collections
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+
+from flipbook.journal import ResponseJournal
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, where only one process exports the database at a time anyway (see --workers)
+    fcntl = None
+
+MEMORY_RESPONSE_STORE = "memory"
+SQLITE_RESPONSE_STORE = "sqlite"
+RESPONSE_STORE_TYPES = (MEMORY_RESPONSE_STORE, SQLITE_RESPONSE_STORE)
+
+SQLITE_DB_FILE_SUFFIX = ".sqlite"
+SQLITE_EXPORT_LOCK_FILE_SUFFIX = ".export-lock"
+SQLITE_MAX_QUERY_PARAMS = 900
+
+
+class ResponseStore(abc.ABC):
+    """Base class for objects that store users' form responses.
+
+    Responses are stored as a dictionary of column name => value for each relative directory. Implementations must be
+    safe to use from multiple request-handling threads. They also keep the form responses table up to date: after
+    start(..) is called, they periodically pass the current responses to the write_table function, and do so one last
+    time when close() is called.
+    """
+
+    @abc.abstractmethod
+    def get(self, relative_directory, default=None):
+        """Returns a copy of the responses for the given relative directory, or default if there aren't any."""
+
+    @abc.abstractmethod
+    def get_all(self):
+        """Returns a snapshot of all responses as an OrderedDict of relative directory => responses dict."""
+
+    def get_many(self, relative_directories):
+        """Returns a dictionary of relative directory => copy of the responses, for those of the given relative
+        directories that have responses.
+        """
+        form_responses = {}
+        for relative_directory in relative_directories:
+            responses = self.get(relative_directory)
+            if responses is not None:
+                form_responses[relative_directory] = responses
+        return form_responses
+
+    @abc.abstractmethod
+    def update(self, relative_directory, values):
+        """Atomically sets the given column name => value pairs for the given relative directory. Columns that are
+        not in values keep their previous values.
+        """
+
+    @abc.abstractmethod
+    def update_many(self, relative_directories_and_values):
+        """Atomically sets the responses for several relative directories, so that other requests see either all of
+        the changes or none of them.
+
+        Args:
+            relative_directories_and_values (list): list of (relative directory, column name => value dict) tuples.
+        """
+
+    @abc.abstractmethod
+    def has_unwritten_responses(self):
+        """Returns True if some responses haven't been written to the form responses table yet"""
+
+    @abc.abstractmethod
+    def __len__(self):
+        """Returns the number of relative directories that have responses"""
+
+    def __contains__(self, relative_directory):
+        return self.get(relative_directory) is not None
+
+    @abc.abstractmethod
+    def start(self, write_table, table_update_interval):
+        """Starts updating the form responses table in the background.
+
+        Args:
+            write_table (function): takes an OrderedDict of relative directory => responses dict and writes it to the
+                form responses table.
+            table_update_interval (float): number of seconds between table updates.
+        """
+
+    @abc.abstractmethod
+    def close(self):
+        """Writes any remaining responses to the form responses table and releases resources."""
+
+
+class InMemoryResponseStore(ResponseStore):
+    """Keeps responses in a dictionary, and records each update in a ResponseJournal (see flipbook/journal.py).
+
+    This only works with a single server process.
+    """
+
+    def __init__(self, form_responses_table_path, form_responses, path_column, fsync_interval=1.0, verbose=False):
+        self.form_responses_table_path = form_responses_table_path
+        self.path_column = path_column
+        self.fsync_interval = fsync_interval
+        self.verbose = verbose
+        self.journal = None
+
+        self._form_responses = collections.OrderedDict(form_responses)
+        self._lock = threading.RLock()
+
+    def get(self, relative_directory, default=None):
+        with self._lock:
+            responses = self._form_responses.get(relative_directory)
+            return dict(responses) if responses is not None else default
+
+    def get_all(self):
+        with self._lock:
+            return collections.OrderedDict((k, dict(v)) for k, v in self._form_responses.items())
+
+    def get_many(self, relative_directories):
+        with self._lock:
+            return {
+                relative_directory: dict(self._form_responses[relative_directory])
+                for relative_directory in relative_directories if relative_directory in self._form_responses
+            }
+
+    def update(self, relative_directory, values):
+        with self._lock:
+            self._form_responses.setdefault(relative_directory, {}).update(values)
+            if self.journal is not None:
+                self.journal.append({self.path_column: relative_directory, **values})
+
+    def update_many(self, relative_directories_and_values):
+        relative_directories_and_values = list(relative_directories_and_values)
+        with self._lock:
+            for relative_directory, values in relative_directories_and_values:
+                self._form_responses.setdefault(relative_directory, {}).update(values)
+            if self.journal is not None:
+                self.journal.append_many([
+                    {self.path_column: relative_directory, **values}
+                    for relative_directory, values in relative_directories_and_values])
+
+    def __len__(self):
+        return len(self._form_responses)
+
+    def __contains__(self, relative_directory):
+        return relative_directory in self._form_responses
+
+    def has_unwritten_responses(self):
+        return self.journal is not None and self.journal.has_uncompacted_records()
+
+    def start(self, write_table, table_update_interval):
+        self.journal = ResponseJournal(
+            self.form_responses_table_path,
+            get_table_snapshot=self.get_all,
+            write_table=write_table,
+            fsync_interval=self.fsync_interval,
+            compact_interval=table_update_interval,
+            lock=self._lock,
+            verbose=self.verbose)
+        self.journal.start()
+
+        print(f"Will append form responses to {self.journal.journal_path} and update "
+              f"{self.form_responses_table_path} every {table_update_interval:g} seconds")
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+
+
+class SQLiteResponseStore(ResponseStore):
+    """Keeps responses in a SQLite database in WAL mode, so that concurrent requests from multiple threads or server
+    processes can read and save responses without lost updates.
+
+    Each (relative directory, column name) pair is stored as a separate row, so concurrent saves of different columns
+    for the same relative directory don't overwrite each other, and changes to the form schema don't require a
+    migration. A version counter is incremented by each update, and each row records the version that last changed
+    it. This way, the form responses table only gets rewritten when something has changed, and server processes can
+    find out which responses were saved by other processes (see get_changes_since(..)).
+
+    With --workers, each server process has its own SQLiteResponseStore and exports the database in the background.
+    A lock file and the last exported version, which is stored in the database, make sure that only one process at a
+    time rewrites the form responses table, and only when it's out of date.
+    """
+
+    def __init__(self, db_path, verbose=False):
+        self.db_path = db_path
+        self.verbose = verbose
+
+        self._local = threading.local()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._write_table = None
+        self._export_lock = threading.Lock()
+
+        conn = self._get_connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS form_responses (
+                path TEXT NOT NULL,
+                column_name TEXT NOT NULL,
+                value,
+                PRIMARY KEY (path, column_name)
+            );
+            CREATE TABLE IF NOT EXISTS store_info (
+                key TEXT PRIMARY KEY,
+                value INTEGER
+            );
+            INSERT OR IGNORE INTO store_info (key, value) VALUES ('version', 0);
+        """)
+
+        # databases created by older versions of flipbook don't have a version column
+        column_names = [row[1] for row in conn.execute("PRAGMA table_info(form_responses)")]
+        if "version" not in column_names:
+            conn.execute("ALTER TABLE form_responses ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        conn.execute("CREATE INDEX IF NOT EXISTS form_responses_version ON form_responses (version)")
+
+    def _get_connection(self):
+        # sqlite3 connections can't be shared between threads, so keep one per thread. They also can't be used after a
+        # fork, so a worker process that inherited a connection from the server's main process opens a new one.
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=True)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _get_info(self, key, default=None):
+        row = self._get_connection().execute("SELECT value FROM store_info WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else default
+
+    def _set_info(self, key, value):
+        self._get_connection().execute("INSERT OR REPLACE INTO store_info (key, value) VALUES (?, ?)", (key, value))
+
+    def get_version(self):
+        return self._get_info("version")
+
+    def get_changes_since(self, version):
+        """Returns the responses that changed after the given version, including ones saved by other processes.
+
+        Args:
+            version (int): a version returned by get_version() or by a previous call to this method.
+
+        Return:
+            2-tuple: (the current version, set of (relative directory, column name) tuples that changed)
+        """
+        # get the version first, so that an update that's committed in between is reported now or by the next call
+        current_version = self.get_version()
+        if current_version == version:
+            return current_version, set()
+
+        changes = self._get_connection().execute(
+            "SELECT path, column_name FROM form_responses WHERE version > ?", (version,)).fetchall()
+        return current_version, set(changes)
+
+    def get(self, relative_directory, default=None):
+        rows = self._get_connection().execute(
+            "SELECT column_name, value FROM form_responses WHERE path = ? ORDER BY rowid", (relative_directory,),
+        ).fetchall()
+        return dict(rows) if rows else default
+
+    def get_all(self):
+        form_responses = collections.OrderedDict()
+        for path, column_name, value in self._get_connection().execute(
+                "SELECT path, column_name, value FROM form_responses ORDER BY rowid"):
+            form_responses.setdefault(path, {})[column_name] = value
+        return form_responses
+
+    def get_many(self, relative_directories):
+        form_responses = {}
+        relative_directories = list(relative_directories)
+        # stay below SQLite's limit on the number of parameters in a query
+        for i in range(0, len(relative_directories), SQLITE_MAX_QUERY_PARAMS):
+            batch = relative_directories[i:i + SQLITE_MAX_QUERY_PARAMS]
+            for path, column_name, value in self._get_connection().execute(
+                    f"SELECT path, column_name, value FROM form_responses WHERE path IN ({', '.join('?' * len(batch))}) "
+                    f"ORDER BY rowid", batch):
+                form_responses.setdefault(path, {})[column_name] = value
+        return form_responses
+
+    def update(self, relative_directory, values):
+        self.update_many([(relative_directory, values)])
+
+    def update_many(self, relative_directories_and_values):
+        # the updates are applied in one transaction
+        conn = self._get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("UPDATE store_info SET value = value + 1 WHERE key = 'version'")
+            version = self.get_version()
+            conn.executemany(
+                "INSERT INTO form_responses (path, column_name, value, version) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (path, column_name) DO UPDATE SET value = excluded.value, version = excluded.version",
+                [(relative_directory, column_name, value, version)
+                 for relative_directory, values in relative_directories_and_values
+                 for column_name, value in values.items()])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def __len__(self):
+        return self._get_connection().execute("SELECT COUNT(DISTINCT path) FROM form_responses").fetchone()[0]
+
+    def __contains__(self, relative_directory):
+        return self._get_connection().execute(
+            "SELECT 1 FROM form_responses WHERE path = ? LIMIT 1", (relative_directory,)).fetchone() is not None
+
+    def has_unwritten_responses(self):
+        return self._write_table is not None and self.get_version() != self._get_info("exported_version")
+
+    @contextlib.contextmanager
+    def _lock_export(self):
+        """Makes sure that only one thread, and only one server process, exports the database at a time"""
+        with self._export_lock:
+            if fcntl is None:
+                yield
+                return
+
+            with open(f"{self.db_path}{SQLITE_EXPORT_LOCK_FILE_SUFFIX}", "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def write_table(self):
+        """Passes the current responses to the write_table function if they changed since they were last exported
+        by this or any other server process.
+        """
+        with self._lock_export():
+            version = self.get_version()
+            if version == self._get_info("exported_version"):
+                return
+
+            start_time = time.time()
+            self._write_table(self.get_all())
+            self._set_info("exported_version", version)
+            if self.verbose:
+                print(f"Exported {self.db_path} in {time.time() - start_time:0.2f} seconds")
+
+    def _run(self, table_update_interval):
+        while not self._stop_event.wait(table_update_interval):
+            try:
+                self.write_table()
+            except Exception as e:
+                print(f"ERROR: unable to export {self.db_path}: {type(e).__name__} {e}")
+
+    def start(self, write_table, table_update_interval):
+        if self._thread is not None:
+            return
+
+        self._write_table = write_table
+        # the form responses table is up to date when the database is created. For databases that were created by
+        # older versions of flipbook, assume that it was up to date when the server last shut down.
+        self._get_connection().execute(
+            "INSERT OR IGNORE INTO store_info (key, value) VALUES ('exported_version', ?)", (self.get_version(),))
+        self._thread = threading.Thread(
+            target=self._run, args=(table_update_interval,), name="flipbook-response-store", daemon=True)
+        self._thread.start()
+
+        print(f"Will save form responses to {self.db_path} and export them every {table_update_interval:g} seconds")
+
+    def close(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            self.write_table()
+
+
+def create_response_store(store_type, form_responses_table_path, form_responses, path_column, fsync_interval=1.0,
+                          verbose=False):
+    """Creates a ResponseStore of the given type.
+
+    Args:
+        store_type (str): one of RESPONSE_STORE_TYPES.
+        form_responses_table_path (str): path of the form responses table.
+        form_responses (dict): responses parsed from the form responses table. The SQLite store is only initialized
+            with these if its database doesn't exist yet. Otherwise, the database takes precedence.
+        path_column (str): name of the relative directory column in the form responses table.
+        fsync_interval (float): max. number of seconds before the in-memory store's journal is flushed to disk.
+    """
+    if store_type == MEMORY_RESPONSE_STORE:
+        return InMemoryResponseStore(
+            form_responses_table_path, form_responses, path_column, fsync_interval=fsync_interval, verbose=verbose)
+
+    if store_type == SQLITE_RESPONSE_STORE:
+        db_path = f"{form_responses_table_path}{SQLITE_DB_FILE_SUFFIX}"
+        is_new_db = not os.path.isfile(db_path)
+        store = SQLiteResponseStore(db_path, verbose=verbose)
+        if is_new_db and form_responses:
+            store.update_many(form_responses.items())
+            print(f"Imported {len(form_responses)} rows from {form_responses_table_path} into {db_path}")
+        elif form_responses:
+            print(f"Loading form responses from {db_path} rather than {form_responses_table_path}")
+        return store
+
+    raise ValueError(f"Unexpected response store type: {store_type}")
@@ -1,18 +1,125 @@
+import atexit
+import collections
+import functools
 import json
+import os
+import time
 from flask import request, Response
-import pandas as pd
 
-from flipbook import args, FORM_SCHEMA, FORM_RESPONSES, FORM_SCHEMA_COLUMNS, PATH_COLUMN, \
-    METADATA_COLUMNS, RELATIVE_DIRECTORY_TO_METADATA, EXTRA_COLUMNS_IN_FORM_RESPONSES_TABLE, \
-    EXTRA_DATA_IN_FORM_RESPONSES_TABLE
+from flipbook.page_cache import invalidate_page
+from flipbook.state import get_state
+from flipbook.tables import PATH_COLUMN, write_table
 
 
 def error_response(message, status=400):
     return Response(json.dumps({"error": message}), status=status, mimetype='application/json')
 
 
+def get_form_responses_table_row(state, relative_dir, responses, include_metadata=False):
+    """Returns a dictionary of column name => value with the given page's form responses, the values of extra columns
+    from the form responses table, and optionally its metadata.
+
+    Args:
+        state (FlipBookState): the server state
+        relative_dir (str): the page's relative directory
+        responses (dict): the page's form responses
+        include_metadata (bool): whether to include metadata columns
+    """
+    output_dict = {
+        PATH_COLUMN: relative_dir,
+    }
+    if include_metadata:
+        output_dict.update(state.relative_directory_to_metadata.get(relative_dir, {}))
+    output_dict.update(responses)
+    output_dict.update(state.extra_data_in_form_responses_table.get(relative_dir, {}))
+
+    return output_dict
+
+
+def get_form_responses_table_rows(state, form_responses):
+    """Returns the list of rows to write to the form responses table.
+
+    Args:
+        state (FlipBookState): the server state
+        form_responses (dict): relative directory => responses dict, as returned by state.form_response_store.get_all()
+    """
+    return [
+        get_form_responses_table_row(
+            state, relative_dir, responses, include_metadata=state.args.add_metadata_to_form_responses_table)
+        for relative_dir, responses in form_responses.items()
+    ]
+
+
+def write_form_responses_table(state, form_responses):
+    import pandas as pd
+
+    args = state.args
+    start_time = time.time()
+    try:
+        output_table_rows = get_form_responses_table_rows(state, form_responses)
+        output_table_columns = [PATH_COLUMN] + state.form_schema_columns + state.extra_columns_in_form_responses_table
+        if args.add_metadata_to_form_responses_table:
+            output_table_columns += state.metadata_columns
+
+        df = pd.DataFrame(output_table_rows, columns=output_table_columns).fillna('')
+        print(f"Saving {len(df)} rows to {args.form_responses_table}")
+
+        write_table(df, args.form_responses_table)
+    except Exception as e:
+        state.form_responses_table_write_error = f"{type(e).__name__}: {e}"
+        raise
+
+    state.form_responses_table_write_seconds = time.time() - start_time
+    state.form_responses_table_write_error = None
+
+
+def start_form_response_store(state):
+    state.form_response_store.start(
+        functools.partial(write_form_responses_table, state), state.args.table_update_interval)
+    atexit.register(state.form_response_store.close)
+    state.form_response_store_started = True
+
+
+def get_form_response_values(state, params):
+    """Returns a dictionary of column name => value for the form fields in params.
+
+    Args:
+        state (FlipBookState): the server state
+        params (dict): form field name => value. Must include 'relative_directory'.
+    """
+    values = {}
+    for form_schema_row in [{'name': 'relative_directory', 'columnName': PATH_COLUMN}] + state.form_schema:
+        value = params.get(form_schema_row['name'])
+        if value is None:
+            continue
+        values[form_schema_row['columnName']] = value
+        if state.args.verbose:
+            print(f"Setting {params['relative_directory']} {form_schema_row['columnName']} = {value}")
+
+    return values
+
+
+def save_form_responses(state, relative_directories_and_values):
+    """Saves form responses for one or more pages in one atomic update.
+
+    Args:
+        state (FlipBookState): the server state
+        relative_directories_and_values (list): list of (relative directory, column name => value dict) tuples.
+    """
+    # state.form_response_store updates the form responses table in the background, so the time it takes to save
+    # doesn't depend on the size of the table.
+    state.form_response_store.update_many(relative_directories_and_values)
+
+    columns = set()
+    for relative_directory, values in relative_directories_and_values:
+        invalidate_page(relative_directory)
+        columns.update(values)
+    state.pages.page_index.invalidate_columns(columns)
+
+
 def save_form_handler():
-    if not FORM_SCHEMA:
+    state = get_state()
+    if not state.form_schema or not state.form_response_store_started:
         return error_response("Server state error: form table not initialized", status=500)
 
     # check params
@@ -20,45 +127,73 @@ def save_form_handler():
     if 'relative_directory' not in params:
         return error_response("'relative_directory' not provided")
 
-    # transfer values to FORM_RESPONSES
-    for form_schema_row in [{'name': 'relative_directory', 'columnName': PATH_COLUMN}] + FORM_SCHEMA:
-        value = params.get(form_schema_row['name'])
-        if value is None:
-            continue
-        if params['relative_directory'] not in FORM_RESPONSES:
-            FORM_RESPONSES[params['relative_directory']] = {}
-            if args.verbose:
-                print(f"Adding {params['relative_directory']} row to responses")
+    values = get_form_response_values(state, params)
+    if values:
+        save_form_responses(state, [(params['relative_directory'], values)])
 
-        FORM_RESPONSES[params['relative_directory']][form_schema_row['columnName']] = value
-        if args.verbose:
-            print(f"Setting {params['relative_directory']} {form_schema_row['columnName']} = {value}")
+    return Response(json.dumps({"success": True}), status=200, mimetype='application/json')
 
-    # transfer metadata values to FORM_RESPONSES
-    output_table_rows = []
-    output_table_columns = [PATH_COLUMN] + FORM_SCHEMA_COLUMNS + EXTRA_COLUMNS_IN_FORM_RESPONSES_TABLE
-    if args.add_metadata_to_form_responses_table:
-        output_table_columns += METADATA_COLUMNS
 
-    for relative_dir in FORM_RESPONSES:  # set(RELATIVE_DIRECTORY_TO_METADATA.keys()) |
-        output_dict = {
-            PATH_COLUMN: relative_dir,
-        }
-        if args.add_metadata_to_form_responses_table:
-            output_dict.update(RELATIVE_DIRECTORY_TO_METADATA.get(relative_dir, {}))
-        output_dict.update(FORM_RESPONSES.get(relative_dir, {}))
-        output_dict.update(EXTRA_DATA_IN_FORM_RESPONSES_TABLE.get(relative_dir, {}))
-        output_table_rows.append(output_dict)
-
-    # write table to file
-    # NOTE: This is not thread-safe and assumes a single-threaded server. For multi-threaded
-    # or multi-process servers like gunicorn, this will need to be replaced with a sqlite or redis backend.
-    df = pd.DataFrame(output_table_rows, columns=output_table_columns).fillna('')
-    print(f"Saving {len(df)} rows to {args.form_responses_table}")
-    if args.form_responses_table_is_excel:
-        df.to_excel(args.form_responses_table)
-    else:
-        df.to_csv(args.form_responses_table, sep="\t", header=True, index=False)
+def save_batch_handler():
+    """Saves the form responses for several pages at once. The request body is a json object like
 
-    return Response(json.dumps({"success": True}), status=200, mimetype='application/json')
+        {"updates": [{"relative_directory": "dir1", "fields": {"verdict": "normal", "notes": "..."}}, ...]}
+
+    where the fields are form field names and values, like the params of a /save request. Updates are applied in
+    order, so if the same page appears more than once, the later values take precedence. Either all updates are saved,
+    or none are.
+    """
+    state = get_state()
+    if not state.form_schema or not state.form_response_store_started:
+        return error_response("Server state error: form table not initialized", status=500)
+
+    # navigator.sendBeacon(..) may not set the content type, so parse the body as json regardless
+    body = request.get_json(force=True, silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("updates"), list):
+        return error_response("Expected a json object with an 'updates' list")
+
+    # validate all updates before saving any of them, and merge updates for the same page
+    relative_directory_to_values = collections.OrderedDict()
+    for i, update in enumerate(body["updates"]):
+        if not isinstance(update, dict) or not isinstance(update.get("relative_directory"), str):
+            return error_response(f"Update #{i+1}: 'relative_directory' not provided")
+        fields = update.get("fields", {})
+        if not isinstance(fields, dict) or not all(isinstance(value, str) for value in fields.values()):
+            return error_response(f"Update #{i+1}: 'fields' must be an object with string values")
+
+        params = dict(fields)
+        params['relative_directory'] = update['relative_directory']
+        values = get_form_response_values(state, params)
+        relative_directory_to_values.setdefault(update['relative_directory'], {}).update(values)
+
+    if relative_directory_to_values:
+        save_form_responses(state, list(relative_directory_to_values.items()))
+
+    return Response(json.dumps({"success": True, "saved": len(relative_directory_to_values)}),
+                    status=200, mimetype='application/json')
+
+
+def form_responses_table_status_handler():
+    """Returns json with the time when the form responses table was last written successfully, and whether there are
+    saved responses that haven't been written to it yet. The table is only replaced after it's been completely
+    written, so its modification time is the time of the last successful update, even if it was written by another
+    server process.
+    """
+    state = get_state()
+    if not state.form_schema:
+        return error_response("The form responses table isn't enabled", status=404)
+
+    table_path = state.args.form_responses_table
+    try:
+        last_write_time = os.path.getmtime(table_path)
+    except OSError:
+        last_write_time = None
 
+    return Response(json.dumps({
+        "path": table_path,
+        "last_write_time": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(last_write_time))
+                           if last_write_time is not None else None,
+        "last_write_seconds": state.form_responses_table_write_seconds,
+        "last_error": state.form_responses_table_write_error,
+        "unwritten_responses": state.form_response_store.has_unwritten_responses(),
+    }), status=200, mimetype='application/json')
@@ -0,0 +1,196 @@
+"""The scan index records which data files are in each directory under the top-level directory, along with directory
+mtimes and the parsed contents of flipbook_metadata.json files. It can be built ahead of time by running
+
+    python3 -m flipbook index /path/dir-with-images
+
+and is then loaded by the server instead of searching the whole directory tree. When the index is refreshed, only the
+directories whose mtime changed are listed again, and only the flipbook_metadata.json files whose mtime changed are
+parsed again.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import time
+
+from flipbook.utils import DATA_FILE_SUFFIXES, METADATA_JSON_FILE_SUFFIX, WEBSITE_DIR, DEFAULT_SCAN_THREADS, \
+    get_relative_directory_to_data_files_list, get_relative_directory_to_metadata, scan_directory_tree
+
+INDEX_COMMAND = "index"
+SCAN_INDEX_FILENAME = "flipbook_index.json.gz"
+SCAN_INDEX_FORMAT_VERSION = 1
+
+
+def load_scan_index(index_path):
+    """Returns the scan index dict from the given path, or None if it doesn't exist or can't be used."""
+    if not os.path.isfile(index_path):
+        return None
+
+    try:
+        with gzip.open(index_path, "rt") as f:
+            scan_index = json.load(f)
+    except Exception as e:
+        print(f"WARNING: unable to parse {index_path}: {e}. Ignoring it...")
+        return None
+
+    if not isinstance(scan_index, dict) or scan_index.get("format_version") != SCAN_INDEX_FORMAT_VERSION:
+        print(f"WARNING: {index_path} has an unexpected format version. Ignoring it...")
+        return None
+
+    scan_index["changed"] = False
+
+    return scan_index
+
+
+def save_scan_index(index_path, scan_index):
+    # write to a temp file and then rename it so the index is never left partially written. With --watch and --workers,
+    # each server process may update the index, so the temp file name includes the pid.
+    temp_path = f"{index_path}.{os.getpid()}.tmp"
+    with gzip.open(temp_path, "wt", compresslevel=1) as f:
+        json.dump(scan_index, f)
+    os.replace(temp_path, index_path)
+
+
+def get_relative_data_file_paths(scan_index):
+    """Returns the list of data file paths in the scan index, relative to the top-level directory."""
+    return [
+        os.path.join(relative_dir, filename)
+        for relative_dir, entry in scan_index["directories"].items()
+        for filename in entry["files"]
+    ]
+
+
+def refresh_scan_index(top_level_dir, scan_index=None, suffixes=DATA_FILE_SUFFIXES, keywords_to_exclude=None,
+                       num_threads=DEFAULT_SCAN_THREADS, verbose=False, print_summary=True):
+    """Creates a new scan index for top_level_dir, or updates the given one by re-listing only the directories whose
+    mtime changed.
+
+    Directories that contain any of the keywords_to_exclude aren't included in a new index. An existing index is only
+    reused if all the keywords it was created with are in keywords_to_exclude, since otherwise it could be missing
+    data files.
+
+    Metadata json files are only added to the index later by get_relative_directory_to_metadata_using_scan_index(..),
+    since they're parsed after filtering by the --include and --exclude keywords.
+    """
+    start_time = time.time()
+    if scan_index is not None and tuple(scan_index.get("suffixes", [])) != tuple(suffixes):
+        print("File suffixes changed since the scan index was created, so the whole directory tree will be rescanned")
+        scan_index = None
+
+    keywords_to_exclude = list(keywords_to_exclude or [])
+    if scan_index is not None:
+        missing_keywords = set(scan_index.get("excluded_keywords", [])) - set(keywords_to_exclude)
+        if missing_keywords:
+            print(f"The scan index was created with excluded keyword(s) that are no longer excluded: "
+                  f"{', '.join(sorted(missing_keywords))}, so the whole directory tree will be rescanned")
+            scan_index = None
+        else:
+            # keep the index consistent by only skipping directories that the index was created without
+            keywords_to_exclude = scan_index.get("excluded_keywords", [])
+
+    directories, stats = scan_directory_tree(
+        top_level_dir,
+        suffixes=suffixes,
+        keywords_to_exclude=keywords_to_exclude,
+        previous_directories=scan_index["directories"] if scan_index else None,
+        num_threads=num_threads,
+        verbose=verbose)
+
+    if print_summary:
+        print(f"Listed {stats['num_directories_listed']} out of {len(directories)} directories in {top_level_dir} in "
+              f"{time.time() - start_time:0.1f} seconds. {stats['num_directories_changed']} directories changed.")
+
+    return {
+        "format_version": SCAN_INDEX_FORMAT_VERSION,
+        "suffixes": list(suffixes),
+        "excluded_keywords": keywords_to_exclude,
+        "directories": directories,
+        "metadata_json_files": scan_index["metadata_json_files"] if scan_index else {},
+        "changed": scan_index is None or stats["num_directories_changed"] > 0,
+    }
+
+
+def prune_scan_index_metadata(scan_index):
+    """Removes cached metadata for flipbook_metadata.json files that are no longer in the scan index."""
+    metadata_json_paths = {
+        path for path in get_relative_data_file_paths(scan_index) if path.endswith(METADATA_JSON_FILE_SUFFIX)}
+    for path in list(scan_index["metadata_json_files"]):
+        if path not in metadata_json_paths:
+            del scan_index["metadata_json_files"][path]
+            scan_index["changed"] = True
+
+
+def get_relative_directory_to_metadata_using_scan_index(
+        top_level_dir, scan_index, relative_directory_to_data_files_list, verbose=False, print_summary=True,
+        num_threads=DEFAULT_SCAN_THREADS, keys_to_keep=None):
+    """Same as utils.get_relative_directory_to_metadata, but only parses the flipbook_metadata.json files that have
+    changed since they were cached in the scan index.
+    """
+    metadata_json_cache = scan_index["metadata_json_files"]
+    previous_mtimes = {path: entry["mtime"] for path, entry in metadata_json_cache.items()}
+    result = get_relative_directory_to_metadata(
+        top_level_dir, relative_directory_to_data_files_list, verbose=verbose, metadata_json_cache=metadata_json_cache,
+        print_summary=print_summary, num_threads=num_threads, keys_to_keep=keys_to_keep)
+
+    if any(previous_mtimes.get(path) != entry["mtime"] for path, entry in metadata_json_cache.items()):
+        scan_index["changed"] = True
+
+    return result
+
+
+def write_scan_index_if_changed(index_path, scan_index):
+    prune_scan_index_metadata(scan_index)
+    if not scan_index.pop("changed", True):
+        return
+
+    try:
+        save_scan_index(index_path, scan_index)
+    except OSError as e:
+        print(f"WARNING: unable to write {index_path}: {e}")
+        return
+
+    print(f"Wrote scan index to {index_path}")
+
+
+def index_command_main(argv):
+    """Builds or refreshes the scan index for a directory. This is run by 'python3 -m flipbook index'."""
+    p = argparse.ArgumentParser(
+        prog=f"flipbook {INDEX_COMMAND}",
+        description="Build or refresh the FlipBook scan index for a directory, so that the FlipBook server can "
+                    "start without searching the whole directory tree.")
+    p.add_argument("--index-file", default=SCAN_INDEX_FILENAME, help="Path of the scan index file, relative to the "
+                   "top-level directory")
+    p.add_argument("-x", "--exclude", action="append", help="Skip directories whose path contains this keyword. "
+                   "The server can then only use this index if it's started with the same or additional --exclude "
+                   "keywords.")
+    p.add_argument("--scan-threads", type=int, default=DEFAULT_SCAN_THREADS, help="Number of directories to list "
+                   "in parallel")
+    p.add_argument("-v", "--verbose", action='count', default=0, help="Print more info")
+    p.add_argument("directory", default=".", nargs="?", help="Top-level directory to search for images and data files")
+    args = p.parse_args(argv)
+
+    if args.exclude is None:
+        args.exclude = [WEBSITE_DIR]
+
+    if not os.path.isdir(args.directory):
+        p.error(f"{args.directory} directory not found")
+
+    args.directory = os.path.realpath(args.directory)
+    index_path = os.path.join(args.directory, args.index_file)
+
+    scan_index = refresh_scan_index(
+        args.directory, load_scan_index(index_path), keywords_to_exclude=args.exclude, num_threads=args.scan_threads,
+        verbose=args.verbose)
+
+    # parse all metadata json files so they're cached in the index
+    relative_directory_to_data_files_list = get_relative_directory_to_data_files_list(
+        args.directory, None, None, verbose=args.verbose,
+        relative_data_file_paths=get_relative_data_file_paths(scan_index), num_threads=args.scan_threads)
+    get_relative_directory_to_metadata_using_scan_index(
+        args.directory, scan_index, relative_directory_to_data_files_list, verbose=args.verbose,
+        num_threads=args.scan_threads)
+
+    write_scan_index_if_changed(index_path, scan_index)
+    if not os.path.isfile(index_path):
+        p.error(f"Unable to create {index_path}")
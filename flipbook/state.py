@@ -0,0 +1,555 @@
+"""The state of a FlipBook server: the list of pages, their metadata, the form schema and the form responses.
+
+FlipBookState loads all of these when it's created, based on the command-line args. create_app(..) in __init__.py
+creates one for each Flask app, and request handlers get it by calling get_state().
+"""
+
+import collections
+import functools
+import json
+import os
+import re
+from urllib.parse import urlencode
+
+from flipbook.journal import replay_journal
+from flipbook.page_filter import PageFilter
+from flipbook.page_index import PageIndex, PageSet, MISSING_VALUE_TYPE
+from flipbook.response_store import create_response_store, InMemoryResponseStore, SQLiteResponseStore
+from flipbook.scan_index import load_scan_index, refresh_scan_index, get_relative_data_file_paths, \
+    get_relative_directory_to_metadata_using_scan_index, write_scan_index_if_changed
+from flipbook.tables import PATH_COLUMN, parse_table, get_table_rows, check_table_format_is_supported
+from flipbook.utils import get_relative_directory_to_data_files_list, get_relative_directory_to_metadata, \
+    get_data_page_url, SINGLE_PAGE_STATIC_WEBSITE_MODE, STATIC_WEBSITE_VIEWER_FILENAME
+
+# the key under which the FlipBookState is stored in app.extensions
+FLIPBOOK_EXTENSION_KEY = "flipbook"
+
+# url params for viewing pages in a different order, or a subset of pages
+SORT_URL_PARAM = "sort"
+REVERSE_SORT_URL_PARAM = "reverse"
+FILTER_URL_PARAM = "filter"
+
+# define input form fields to show on each data page
+DEFAULT_FORM_SCHEMA = [
+    {
+        "type": "radio",
+        "columnName": "Verdict",
+        "choices": [
+            {"value": "normal", "label": "Normal"},
+            {"value": "intermediate", "label": "Intermediate"},
+            {"value": "full-expansion", "label": "Full Expansion"},
+            {"value": "double-expansion", "label": "Double Expansion"},
+        ]
+    },
+    {
+        "type": "radio",
+        "columnName": "Confidence",
+        "inputLabel": "Confidence",
+        "choices": [
+            {"value": "borderline", "label": "Borderline"},
+            {"value": "confident", "label": "Confident"},
+        ]
+    },
+    {
+        "type": "text",
+        "columnName": "Notes",
+        "size": 60
+    }
+]
+
+
+def get_state(app=None):
+    """Returns the FlipBookState of the given Flask app, or of the app that's handling the current request"""
+    if app is None:
+        from flask import current_app
+        app = current_app
+
+    return app.extensions[FLIPBOOK_EXTENSION_KEY]
+
+
+class FlipBookState:
+    """Finds the pages under the top-level directory and loads their metadata and form responses"""
+
+    def __init__(self, args):
+        """
+        Args:
+            args (argparse.Namespace): the parsed command-line args (see options.py)
+
+        Raises:
+            ValueError: if the pages, metadata, form schema or form responses can't be loaded
+        """
+        self.args = args
+
+        self.scan_index = None
+        self.scan_index_path = os.path.join(args.directory, args.index_file)
+        self.scan_index_file_exists = False
+        # the list of pages and its page index. With --watch, this is replaced by a new PageSet when the pages change,
+        # so request handlers should read it once and use that snapshot.
+        self.pages = PageSet.create([], self.get_column_values)
+
+        # with --lazy-metadata, these are the only keys that are kept from the flipbook_metadata.json files at startup
+        self.lazy_metadata_keys = None
+        # relative directories whose flipbook_metadata.json files were fully loaded after startup with --lazy-metadata
+        self.relative_directories_with_full_metadata = set()
+        self.metadata_columns = []
+        self.relative_directory_to_metadata = {}
+        self.relative_directory_to_metadata_from_table = {}
+
+        self.form_schema = []
+        self.form_schema_columns = []
+        self.form_radio_button_keyboard_shortcuts = {}
+        self.form_response_store = InMemoryResponseStore(None, {}, PATH_COLUMN)
+        self.form_response_store_started = False
+        # the duration and error message of the last attempt to write the form responses table from this process
+        self.form_responses_table_write_seconds = None
+        self.form_responses_table_write_error = None
+        # with --workers, the version of the SQLite response store whose changes this process has already applied
+        self.form_response_version = 0
+
+        # if a form_responses_table is provided with additional columns which are not in the current form schema (eg.
+        # if the form schema changes), save this info here so it's not lost when the table is updated after new form
+        # responses.
+        self.extra_columns_in_form_responses_table = []
+        self.extra_data_in_form_responses_table = {}
+
+        self._scan_directory()
+        self._load_metadata()
+        self._load_form_schema()
+        self._load_form_responses()
+        self._sort_pages()
+        self._apply_filter()
+
+    def _scan_directory(self):
+        args = self.args
+
+        # load the scan index if it exists. With --watch, the watcher needs the directory listings from the scan, so
+        # they're kept in an in-memory scan index even if there's no index file.
+        self.scan_index = load_scan_index(self.scan_index_path)
+        self.scan_index_file_exists = self.scan_index is not None
+        if self.scan_index is not None:
+            print(f"Loaded scan index from {self.scan_index_path}")
+        if self.scan_index is not None or args.watch:
+            if self.scan_index is None or not args.skip_index_refresh:
+                self.scan_index = refresh_scan_index(
+                    args.directory, self.scan_index, keywords_to_exclude=args.exclude, num_threads=args.scan_threads,
+                    verbose=args.verbose)
+
+        # search directory for images and data files
+        relative_directory_to_data_files_list = get_relative_directory_to_data_files_list(
+            args.directory,
+            args.include,
+            args.exclude,
+            verbose=args.verbose,
+            relative_data_file_paths=get_relative_data_file_paths(self.scan_index) if self.scan_index is not None else None,
+            num_threads=args.scan_threads)
+
+        if not relative_directory_to_data_files_list:
+            raise ValueError(f"No images or data files found in {args.directory}")
+
+        # the page index sorts and filters pages at runtime, when they're requested with ?sort= or ?filter= url params
+        self.pages = PageSet.create(relative_directory_to_data_files_list, self.get_column_values)
+
+    def _load_metadata(self):
+        args = self.args
+
+        if args.lazy_metadata:
+            if args.generate_static_website or args.add_metadata_to_form_responses_table:
+                print("WARNING: --lazy-metadata can't be used with --generate-static-website or "
+                      "--add-metadata-to-form-responses-table since they need all metadata. Ignoring --lazy-metadata...")
+                args.lazy_metadata = False
+            elif not args.hide_metadata_on_home_page and not args.home_page_metadata_column:
+                print("WARNING: --lazy-metadata has no effect unless --hide-metadata-on-home-page or "
+                      "--home-page-metadata-column is also specified, since the home page shows all metadata columns. "
+                      "Ignoring --lazy-metadata...")
+                args.lazy_metadata = False
+            else:
+                self.lazy_metadata_keys = set(args.sort_by or [])
+                if args.filter:
+                    self.lazy_metadata_keys.update(PageFilter(args.filter).columns)
+                if not args.hide_metadata_on_home_page:
+                    self.lazy_metadata_keys.update(args.home_page_metadata_column)
+
+        # parse metadata from flipbook_metadata.json files
+        if self.scan_index is not None:
+            self.metadata_columns, self.relative_directory_to_metadata = \
+                get_relative_directory_to_metadata_using_scan_index(
+                    args.directory,
+                    self.scan_index,
+                    self.pages.relative_directory_to_data_files_list,
+                    verbose=args.verbose,
+                    num_threads=args.scan_threads,
+                    keys_to_keep=self.lazy_metadata_keys)
+            if self.scan_index_file_exists:
+                write_scan_index_if_changed(self.scan_index_path, self.scan_index)
+        else:
+            self.metadata_columns, self.relative_directory_to_metadata = get_relative_directory_to_metadata(
+                args.directory,
+                self.pages.relative_directory_to_data_files_list,
+                verbose=args.verbose,
+                num_threads=args.scan_threads,
+                keys_to_keep=self.lazy_metadata_keys)
+
+        # parse metadata from the metadata_table if specified
+        if not args.metadata_table or not os.path.isfile(args.metadata_table):
+            return
+
+        df = parse_table(args.metadata_table, columns=args.metadata_table_column)
+        metadata_table_columns = [c for c in df.columns if c != PATH_COLUMN]
+        for relative_directory, metadata_dict in get_table_rows(df, metadata_table_columns):
+            if relative_directory not in self.relative_directory_to_metadata:
+                self.relative_directory_to_metadata[relative_directory] = {}
+                if args.verbose:
+                    print(f"Setting new metadata row for {relative_directory} to {metadata_dict}")
+            else:
+                if args.verbose:
+                    print(f"Updating existing metadata row for {relative_directory} to {metadata_dict}")
+            # with a scan index, the metadata dicts are also the scan index's cached flipbook_metadata.json contents,
+            # so merge into a copy to keep the table values out of the index
+            metadata = dict(self.relative_directory_to_metadata[relative_directory])
+            metadata.update(metadata_dict)
+            self.relative_directory_to_metadata[relative_directory] = metadata
+            self.relative_directory_to_metadata_from_table[relative_directory] = metadata_dict
+
+        if len(df) > 0:
+            for key in metadata_table_columns:
+                if key not in self.metadata_columns:
+                    self.metadata_columns.append(key)
+
+    def _load_form_schema(self):
+        args = self.args
+
+        form_schema = [dict(form_schema_row) for form_schema_row in DEFAULT_FORM_SCHEMA]
+        if args.generate_static_website:
+            form_schema = []
+
+        if args.form_schema_json:
+            print(f"Loading form schema from {args.form_schema_json}")
+            try:
+                if os.path.isfile(args.form_schema_json):
+                    with open(args.form_schema_json, "rt") as f:
+                        form_schema = json.load(f)
+                elif args.form_schema_json.startswith("http"):
+                    import requests
+
+                    # Convert https://github.com/broadinstitute/flipbook/blob/main/flipbook/__init__.py to the raw url:
+                    # https://raw.githubusercontent.com/broadinstitute/flipbook/main/flipbook/__init__.py
+                    github_match = re.search("//github.com/(.*)/blob/(.*)", args.form_schema_json)
+                    if github_match:
+                        part1 = github_match.group(1)
+                        part2 = github_match.group(2)
+                        github_raw_file_url = f"https://raw.githubusercontent.com/{part1}/{part2}"
+                        if args.verbose:
+                            print(f"Converting form schema url {args.form_schema_json} to {github_raw_file_url}")
+                        args.form_schema_json = github_raw_file_url
+                    r = requests.get(url=args.form_schema_json)
+                    form_schema = r.json()
+            except Exception as e:
+                raise ValueError(f"Couldn't parse {args.form_schema_json}: {e}")
+
+        # validate the form schema and determine keyboard shortcuts
+        for i, form_schema_row in enumerate(form_schema):
+            if not isinstance(form_schema_row, dict):
+                raise ValueError(f"FORM_SCHEMA row #{i+1} must be a dictionary")
+
+            missing_keys = {'type', 'columnName'} - set(form_schema_row.keys())
+            unknown_keys = set(form_schema_row.keys()) - {'type', 'columnName', 'name', 'inputLabel', 'choices', 'size', 'newLine'}
+            if unknown_keys:
+                print(f"WARNING: FORM_SCHEMA row #{i+1} includes unexpected key(s): {', '.join(unknown_keys)}")
+            if missing_keys:
+                raise ValueError(f"FORM_SCHEMA row #{i+1} is missing values for these keys: {', '.join(missing_keys)}")
+            if form_schema_row['type'] not in ('text', 'radio'):
+                raise ValueError(f"FORM_SCHEMA row #{i+1} has unexpected 'type' value: {form_schema_row['type']}")
+            if 'name' not in form_schema_row:
+                form_schema_row['name'] = form_schema_row['columnName'].lower()
+            form_schema_row['name'] = re.sub("[^a-zA-Z0-9_]", "_", form_schema_row['name'])
+            if 'inputLabel' not in form_schema_row:
+                form_schema_row['inputLabel'] = form_schema_row['columnName']
+
+            if form_schema_row['type'] == 'radio':
+                if 'choices' not in form_schema_row or not isinstance(form_schema_row['choices'], list):
+                    raise ValueError(f"FORM_SCHEMA row #{i+1} is missing a 'choices' list")
+                for j, choice in enumerate(form_schema_row['choices']):
+                    if not isinstance(choice, dict):
+                        raise ValueError(f"FORM_SCHEMA row #{i+1} 'choices' list entry #{j+1} must be a dictionary")
+                    missing_keys = {'value', 'label'} - set(choice.keys())
+                    if missing_keys:
+                        raise ValueError(f"FORM_SCHEMA row #{i+1} 'choices' list entry #{j+1} is missing these keys: {', '.join(missing_keys)}")
+
+                    label_without_html = re.sub("<[^<]+?>", "", choice['label']).strip()
+                    first_letter = (label_without_html or choice["value"])[0]
+                    self.form_radio_button_keyboard_shortcuts[first_letter] = choice['value']
+                    print(f"Form Keyboard Shortcut: {first_letter} => {choice['label']}")
+
+            if 'newLine' in form_schema_row:
+                if not isinstance(form_schema_row['newLine'], int):
+                    raise ValueError(f"FORM_SCHEMA row #{i+1} 'newLine' value must be an integer rather than '{form_schema_row['newLine']}'")
+
+        self.form_schema = form_schema
+        self.form_schema_columns = [r['columnName'] for r in form_schema]
+
+    def _load_form_responses(self):
+        """Parses the form responses table and creates the form response store for saving users' responses"""
+        args = self.args
+        if not self.form_schema:
+            return
+
+        args.form_responses_table = os.path.join(args.directory, args.form_responses_table)
+        check_table_format_is_supported(args.form_responses_table)
+
+        form_responses = collections.OrderedDict()
+        if os.path.isfile(args.form_responses_table):
+            df = parse_table(args.form_responses_table)
+            self.extra_columns_in_form_responses_table = [
+                c for c in df.columns if c not in self.form_schema_columns and c != PATH_COLUMN]
+
+            # if the form responses table has additional columns that overlap with columns in the metadata table(s),
+            # print a message and discard them from the form resonses table so that the metadata takes precedence
+            # over any outdated values in the form responses table.
+            if set(self.extra_columns_in_form_responses_table) & set(self.metadata_columns):
+                print("NOTE: the following columns are present in both the metadata files and in the form responses "
+                      "table, so the values from the metadata will take precedence over the values from the form "
+                      "responses table:\n\t" + ",\n\t".join(
+                        sorted(set(self.extra_columns_in_form_responses_table) & set(self.metadata_columns))))
+
+                df = df[[c for c in df.columns if c not in self.metadata_columns]]
+                self.extra_columns_in_form_responses_table = [
+                    c for c in self.extra_columns_in_form_responses_table if c not in self.metadata_columns]
+
+            form_responses.update(get_table_rows(df, [c for c in df.columns if c in self.form_schema_columns]))
+            self.extra_data_in_form_responses_table.update(
+                get_table_rows(df, [c for c in df.columns if c not in self.form_schema_columns and c != PATH_COLUMN]))
+        elif not os.access(os.path.dirname(args.form_responses_table), os.W_OK):
+            # make sure the table can be written out later
+            raise ValueError(f"Unable to create {args.form_responses_table}")
+
+        # apply responses that were saved to the journal but not yet written to the form responses table
+        replay_journal(args.form_responses_table, form_responses, PATH_COLUMN, verbose=args.verbose)
+
+        self.form_response_store = create_response_store(
+            args.response_store,
+            args.form_responses_table,
+            form_responses,
+            PATH_COLUMN,
+            fsync_interval=args.journal_fsync_interval,
+            verbose=args.verbose)
+        if isinstance(self.form_response_store, SQLiteResponseStore):
+            self.form_response_version = self.form_response_store.get_version()
+
+        print(f"Will save form responses to {args.form_responses_table}  (columns: "
+              f"{', '.join(self.form_schema_columns + self.extra_columns_in_form_responses_table)})")
+
+    def _sort_pages(self):
+        args = self.args
+        if not args.sort_by:
+            return
+
+        valid_columns = self.get_sort_columns()
+        invalid_values = ", ".join([f"'{s}'" for s in args.sort_by if s not in valid_columns])
+        if invalid_values:
+            raise ValueError(f"{invalid_values} column(s) not found in metadata. --sort-by value should be one of: " +
+                             ", ".join(valid_columns))
+
+        relative_directory_to_data_files_list, page_index = self.pages
+        sort_key_summary = []
+        for column in args.sort_by:
+            value_type_counts = page_index.get_value_type_counts(column)
+            sort_key_summary.append(f"{column} (" + ", ".join(
+                f"{count} {value_type}" for value_type, count in value_type_counts.items() if count > 0) + ")")
+            if value_type_counts[MISSING_VALUE_TYPE] > 0:
+                print(f"WARNING: {value_type_counts[MISSING_VALUE_TYPE]} pages don't have a value in the '{column}' "
+                      f"column, so they will be sorted {'first' if args.reverse_sort else 'last'}")
+
+        print(f"Sorting {len(relative_directory_to_data_files_list)} pages by {', '.join(sort_key_summary)}")
+        self.pages = PageSet.create(self.sort_relative_directory_to_data_files_list(
+            relative_directory_to_data_files_list, page_index=page_index), self.get_column_values)
+
+    def _apply_filter(self):
+        args = self.args
+        if not args.filter:
+            return
+
+        self.validate_filter_expression(args.filter)
+        relative_directory_to_data_files_list, page_index = self.pages
+        matching_positions = page_index.get_sort_order((), filter_expression=args.filter)
+        print(f"{len(matching_positions)} out of {len(relative_directory_to_data_files_list)} pages match --filter "
+              f"'{args.filter}'")
+
+        if args.generate_static_website:
+            # the static website can't filter pages at runtime, so only include the matching pages
+            self.pages = PageSet.create(
+                [relative_directory_to_data_files_list[position] for position in matching_positions],
+                self.get_column_values)
+
+    def get_page_metadata(self, relative_dir, data_file_types_and_paths):
+        """Returns the metadata to show on the given page. With --lazy-metadata, the page's flipbook_metadata.json file
+        is fully parsed the first time the page is opened.
+
+        Args:
+            relative_dir (str): the page's relative directory
+            data_file_types_and_paths (list): the page's (data_file_type, data_file_path) tuples
+        """
+        if not self.args.lazy_metadata or relative_dir in self.relative_directories_with_full_metadata:
+            return self.relative_directory_to_metadata.get(relative_dir, {})
+
+        _, relative_directory_to_metadata = get_relative_directory_to_metadata(
+            self.args.directory, [(relative_dir, data_file_types_and_paths)], verbose=self.args.verbose,
+            print_summary=False, num_threads=1)
+        metadata = relative_directory_to_metadata.get(relative_dir, {})
+        metadata.update(self.relative_directory_to_metadata_from_table.get(relative_dir, {}))
+
+        self.relative_directory_to_metadata[relative_dir] = metadata
+        self.relative_directories_with_full_metadata.add(relative_dir)
+
+        return metadata
+
+    def get_column_values(self, relative_directories, column):
+        """Returns the value of the given column for each of the given pages. This is used for sorting pages.
+
+        Args:
+            relative_directories (list): the pages' relative directories
+            column (str): the 'Path' column, a form response column, or a metadata column
+        """
+        if column == PATH_COLUMN:
+            return list(relative_directories)
+
+        form_responses = self.form_response_store.get_all()
+        values = []
+        for relative_dir in relative_directories:
+            value = form_responses.get(relative_dir, {}).get(column)
+            if value is None:
+                value = self.relative_directory_to_metadata.get(relative_dir, {}).get(column)
+            if value is None:
+                value = self.extra_data_in_form_responses_table.get(relative_dir, {}).get(column)
+            values.append(value)
+
+        return values
+
+    def sync_form_response_changes(self):
+        """With --workers, form responses can also be saved by other server processes. This finds the responses that
+        were saved since the last call, and discards the rendered pages and page index columns that depend on them.
+        """
+        from flipbook.page_cache import invalidate_page
+
+        self.form_response_version, changes = self.form_response_store.get_changes_since(self.form_response_version)
+        if not changes:
+            return
+
+        for relative_directory in {relative_directory for relative_directory, _ in changes}:
+            invalidate_page(relative_directory)
+        self.pages.page_index.invalidate_columns({column for _, column in changes})
+
+    def get_sort_columns(self):
+        """Returns the columns that pages can be sorted by"""
+        return [PATH_COLUMN] + self.form_schema_columns + [
+            c for c in self.metadata_columns + self.extra_columns_in_form_responses_table if c != PATH_COLUMN]
+
+    def sort_relative_directory_to_data_files_list(self, relative_directory_to_data_files_list, page_index=None):
+        """Returns a copy of the list of pages, sorted by the --sort-by column(s), or by relative directory if
+        --sort-by wasn't specified
+
+        Args:
+            relative_directory_to_data_files_list (list): the pages to sort
+            page_index (PageIndex): optional index of the given pages, if one was already created
+        """
+        if not self.args.sort_by:
+            return sorted(relative_directory_to_data_files_list, key=lambda entry: entry[0])
+
+        if page_index is None:
+            page_index = PageIndex(relative_directory_to_data_files_list, self.get_column_values)
+
+        sort_order = page_index.get_sort_order(self.args.sort_by, reverse=self.args.reverse_sort)
+        return [relative_directory_to_data_files_list[position] for position in sort_order]
+
+    def validate_filter_expression(self, filter_expression):
+        """Raises a ValueError if the given filter expression can't be parsed or refers to unknown columns"""
+        unknown_columns = self.pages.page_index.get_filter(filter_expression).columns - set(self.get_sort_columns())
+        if unknown_columns:
+            raise ValueError(f"Filter expression '{filter_expression}' refers to unknown column(s): " +
+                             ", ".join(sorted(unknown_columns)) + ". Valid columns are: " +
+                             ", ".join(self.get_sort_columns()))
+
+    def get_requested_page_order(self, request_args):
+        """Returns the page order requested by the ?sort=<column>&reverse=1&filter=<expression> url params. ?sort= can
+        be repeated to sort by more than one column. Without ?sort=, pages are in their default order, and without
+        ?filter=, the --filter expression is used.
+
+        Args:
+            request_args (werkzeug.datastructures.MultiDict): the request's url params
+
+        Return:
+            3-tuple: (tuple of sort columns, whether to reverse the order, filter expression or "")
+
+        Raises:
+            ValueError: if the filter expression isn't valid
+        """
+        valid_columns = set(self.get_sort_columns())
+        sort_by = []
+        for column in request_args.getlist(SORT_URL_PARAM):
+            if column in valid_columns:
+                sort_by.append(column)
+            elif column:
+                print(f"ERROR: unable to sort by '{column}' since it's not a form response or metadata column. "
+                      f"Ignoring it...")
+
+        reverse = request_args.get(REVERSE_SORT_URL_PARAM, "") not in ("", "0", "false")
+
+        filter_expression = request_args.get(FILTER_URL_PARAM, self.args.filter or "").strip()
+        if filter_expression:
+            self.validate_filter_expression(filter_expression)
+
+        return tuple(sort_by), reverse, filter_expression
+
+    def get_page_order_query_string(self, sort_by, reverse, filter_expression):
+        """Returns the url params for the given page order, so that links to other pages keep the same order"""
+        params = [(SORT_URL_PARAM, column) for column in sort_by]
+        if reverse:
+            params.append((REVERSE_SORT_URL_PARAM, "1"))
+        if filter_expression != (self.args.filter or ""):
+            params.append((FILTER_URL_PARAM, filter_expression))
+
+        return urlencode(params)
+
+    def get_data_page_url_function(self, sort_order=None, page_order_query_string="", page_set=None):
+        """Returns a function that takes a page number and the number of pages, and returns the url of that data page.
+
+        Args:
+            sort_order (numpy array): optional positions of the pages in relative_directory_to_data_files_list, in the
+                order that page numbers refer to
+            page_order_query_string (str): url params for the page order, which are added to the page urls
+            page_set (PageSet): the snapshot of state.pages that sort_order refers to. Required if sort_order is
+                specified.
+        """
+        if sort_order is None:
+            return functools.partial(get_data_page_url, page_order_query_string=page_order_query_string)
+
+        def get_page_url(page_number, last):
+            url = get_data_page_url(page_number, last, page_order_query_string)
+            if 1 <= page_number <= len(sort_order):
+                # saving a form response can change which pages match a filter or the sort order, and therefore the
+                # numbers of the other pages, so also identify the page by its path
+                relative_dir, _ = page_set.relative_directory_to_data_files_list[sort_order[page_number - 1]]
+                url += "&" + urlencode({"path": relative_dir})
+            return url
+
+        return get_page_url
+
+    def get_static_data_page_url(self, page_number, last):
+        i = page_number - 1
+        relative_directory_to_data_files_list = self.pages.relative_directory_to_data_files_list
+        num_pages = len(relative_directory_to_data_files_list)
+        if i < 0 or i >= num_pages:
+            raise ValueError(f"page_number arg is out of bounds. It must be between 1 and {num_pages}")
+
+        if self.args.static_website_mode == SINGLE_PAGE_STATIC_WEBSITE_MODE:
+            return f"{STATIC_WEBSITE_VIEWER_FILENAME}#i={page_number}"
+
+        relative_dir, _ = relative_directory_to_data_files_list[i]
+        name = relative_dir.replace("/", "__")
+        return f"page_{name}.html"
+
+    def get_ctime(self, path):
+        """Returns the last-changed-time of the given path, or 0 if it doesn't exist. Relative paths are relative to
+        the top-level directory.
+        """
+        path = os.path.join(self.args.directory, path)
+        return int(os.path.getctime(path)) if os.path.isfile(path) else 0
@@ -0,0 +1,129 @@
+"""Serves the packaged /static/ files (javascript, css, fonts, images) from memory.
+
+They're read once at startup along with gzip-compressed and, if the optional 'brotli' package is installed,
+brotli-compressed versions, so requests for them don't touch the disk and browsers that accept compressed responses
+download a fraction of the bytes.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from flask import request, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(__file__), "static")
+
+# compress these types of files. Images and woff/woff2 fonts are already compressed.
+COMPRESSIBLE_FILE_SUFFIXES = (".js", ".css", ".html", ".svg", ".ttf", ".json", ".txt")
+
+# only keep a compressed version if it's at least this much smaller than the original
+MIN_COMPRESSION_RATIO = 0.9
+
+# these urls aren't versioned, so let browsers reuse them for a day before checking the ETag
+STATIC_ASSET_MAX_AGE = 24 * 60 * 60
+
+# mimetypes.guess_type(..) doesn't know these types on all platforms
+SUFFIX_TO_MIMETYPE = {
+    ".js": "application/javascript",
+    ".css": "text/css",
+    ".woff": "font/woff",
+    ".woff2": "font/woff2",
+    ".ttf": "font/ttf",
+    ".svg": "image/svg+xml",
+}
+
+GZIP_ENCODING = "gzip"
+BROTLI_ENCODING = "br"
+
+# maps the path relative to STATIC_DIR => {"mimetype": .., "etag": .., "encodings": {encoding: bytes}}
+STATIC_ASSETS = {}
+
+
+def get_mimetype(path):
+    suffix = os.path.splitext(path)[1].lower()
+    return SUFFIX_TO_MIMETYPE.get(suffix) or mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+def compress(data, encoding):
+    if encoding == GZIP_ENCODING:
+        # mtime=0 so the output and its ETag are the same every time the server starts
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    elif encoding == BROTLI_ENCODING:
+        return brotli.compress(data, quality=9)
+    else:
+        raise ValueError(f"Unexpected encoding: {encoding}")
+
+
+def load_static_assets(verbose=False):
+    """Reads all files in STATIC_DIR into STATIC_ASSETS, and precomputes their compressed versions"""
+    encodings = [BROTLI_ENCODING, GZIP_ENCODING] if brotli is not None else [GZIP_ENCODING]
+    total_size = 0
+    total_compressed_size = 0
+    for dirpath, _, filenames in os.walk(STATIC_DIR):
+        for filename in filenames:
+            absolute_path = os.path.join(dirpath, filename)
+            relative_path = os.path.relpath(absolute_path, STATIC_DIR).replace(os.sep, "/")
+            with open(absolute_path, "rb") as f:
+                data = f.read()
+
+            asset = {
+                "mimetype": get_mimetype(relative_path),
+                "etag": hashlib.sha1(data).hexdigest()[:20],
+                "encodings": {None: data},
+            }
+            if relative_path.lower().endswith(COMPRESSIBLE_FILE_SUFFIXES):
+                for encoding in encodings:
+                    compressed_data = compress(data, encoding)
+                    if len(compressed_data) <= len(data) * MIN_COMPRESSION_RATIO:
+                        asset["encodings"][encoding] = compressed_data
+
+            STATIC_ASSETS[relative_path] = asset
+            total_size += len(data)
+            total_compressed_size += min(len(d) for d in asset["encodings"].values())
+
+    if verbose:
+        print(f"Loaded {len(STATIC_ASSETS)} static files ({total_size:,d} bytes, {total_compressed_size:,d} bytes "
+              f"compressed)")
+
+
+def get_response_encoding(asset):
+    """Returns the encoding to use for the given asset based on the request's Accept-Encoding header, or None to send
+    it uncompressed
+    """
+    available_encodings = [encoding for encoding in (BROTLI_ENCODING, GZIP_ENCODING) if encoding in asset["encodings"]]
+    if not available_encodings:
+        return None
+
+    return request.accept_encodings.best_match(available_encodings)
+
+
+def static_asset_handler(filename):
+    asset = STATIC_ASSETS.get(filename)
+    if asset is None:
+        return Response(f"{filename} not found", status=404)
+
+    encoding = get_response_encoding(asset)
+    etag = asset["etag"] if encoding is None else f"{asset['etag']}-{encoding}"
+
+    response = Response(mimetype=asset["mimetype"])
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = STATIC_ASSET_MAX_AGE
+    if len(asset["encodings"]) > 1:
+        response.vary.add("Accept-Encoding")
+
+    if etag in request.if_none_match:
+        response.status_code = 304
+        return response
+
+    response.set_data(asset["encodings"][encoding])
+    if encoding is not None:
+        response.content_encoding = encoding
+
+    return response
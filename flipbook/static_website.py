@@ -0,0 +1,389 @@
+"""Generates the static website for --generate-static-website.
+
+Pages are rendered and their images are copied by a pool of worker processes. A manifest in the output directory
+records a hash of each page's inputs (page number, metadata, file sizes and mtimes, templates and settings) and the
+size and mtime of each copied image, so when the website is generated again, only pages and images that changed are
+written.
+
+With --static-website-mode single-page, instead of an html file for each page, the website has one viewer page, and the
+data for all pages (paths, images, metadata and content html) is written to json files that each contain
+--static-website-shard-size pages. The viewer loads the json file for the page being viewed, and renders the page.
+"""
+
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import pkgutil
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from flipbook import DATA_PAGE_HEADER_FILENAME
+from flipbook.state import get_state
+from flipbook.utils import get_data_page_url, load_jinja_template, METADATA_JSON_FILE_TYPE, CONTENT_HTML_FILE_TYPE, \
+    IMAGE_FILE_TYPE, WEBSITE_DIR, HARDLINK_LINK_MODE, REFLINK_LINK_MODE, SINGLE_PAGE_STATIC_WEBSITE_MODE, \
+    STATIC_WEBSITE_VIEWER_FILENAME
+
+STATIC_WEBSITE_MANIFEST_FILENAME = ".flipbook_static_website_manifest.json"
+STATIC_WEBSITE_MANIFEST_FORMAT_VERSION = 1
+
+# with --static-website-mode single-page, the page data json files are written to this subdirectory
+PAGE_DATA_DIR = "flipbook_data"
+
+# ioctl request code for cloning a file on filesystems that support copy-on-write (btrfs, xfs, etc.). From linux/fs.h
+FICLONE = 0x40049409
+
+# the worker processes inherit these from the parent process
+APP = None
+STATE = None
+DATA_PAGE_HANDLER = None
+RENDER_SETTINGS_HASH = None
+PREVIOUS_MANIFEST = None
+
+
+def load_manifest(manifest_path):
+    """Returns the manifest from a previous run, or an empty manifest"""
+    empty_manifest = {"format_version": STATIC_WEBSITE_MANIFEST_FORMAT_VERSION, "pages": {}, "files": {}}
+    if not os.path.isfile(manifest_path):
+        return empty_manifest
+
+    try:
+        with open(manifest_path, "rt") as f:
+            manifest = json.load(f)
+    except Exception as e:
+        print(f"WARNING: unable to parse {manifest_path}: {e}. All pages will be generated again.")
+        return empty_manifest
+
+    if manifest.get("format_version") != STATIC_WEBSITE_MANIFEST_FORMAT_VERSION:
+        return empty_manifest
+
+    return manifest
+
+
+def save_manifest(manifest_path, manifest):
+    temp_path = f"{manifest_path}.tmp"
+    with open(temp_path, "wt") as f:
+        json.dump(manifest, f)
+    os.replace(temp_path, manifest_path)
+
+
+def get_file_stat(path):
+    """Returns [size, mtime] for the given path, or None if it doesn't exist"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def get_render_settings_hash():
+    """Returns a hash of the templates and settings that affect every page, so that changing any of them causes all
+    pages to be generated again.
+    """
+    settings = [
+        pkgutil.get_data("flipbook", "templates/data_page.html").decode("UTF-8"),
+        pkgutil.get_data("flipbook", "templates/main_list.html").decode("UTF-8"),
+        STATE.args.show_one_key_per_line,
+        STATE.args.zoom,
+        STATE.args.scroll_to_image,
+        STATE.args.static_website_gzip,
+        get_file_stat(DATA_PAGE_HEADER_FILENAME),
+    ]
+
+    return hashlib.sha1(json.dumps(settings, default=str).encode("UTF-8")).hexdigest()
+
+
+def get_page_inputs_hash(page_number, last_page_number, relative_directory, data_file_types_and_paths):
+    page_inputs = [
+        RENDER_SETTINGS_HASH,
+        page_number,
+        last_page_number,
+        relative_directory,
+        # the prev/next links point to the neighboring pages' filenames, which change when a directory next to this
+        # one is added, removed or renamed
+        [STATE.get_static_data_page_url(neighbor_page_number, last_page_number)
+         for neighbor_page_number in (page_number - 1, page_number + 1)
+         if 1 <= neighbor_page_number <= last_page_number],
+        STATE.relative_directory_to_metadata.get(relative_directory, {}),
+        STATE.extra_data_in_form_responses_table.get(relative_directory, {}),
+        [(data_file_path, get_file_stat(data_file_path)) for _, data_file_path in data_file_types_and_paths],
+    ]
+
+    return hashlib.sha1(json.dumps(page_inputs, sort_keys=True, default=str).encode("UTF-8")).hexdigest()
+
+
+def write_html(path, html):
+    with open(path, "wt") as f:
+        f.write(html)
+
+    if STATE.args.static_website_gzip:
+        # mtime=0 so that unchanged pages produce identical .gz files
+        with open(f"{path}.gz", "wb") as f:
+            f.write(gzip.compress(html.encode("UTF-8"), compresslevel=9, mtime=0))
+
+
+def link_or_copy_file(source_path, dest_path, link_mode):
+    """Writes source_path to dest_path as a hardlink, a reflink (copy-on-write clone) or a copy. Falls back on copying
+    if the filesystem doesn't support links.
+    """
+    if os.path.lexists(dest_path):
+        os.remove(dest_path)
+
+    if link_mode == HARDLINK_LINK_MODE:
+        try:
+            os.link(source_path, dest_path)
+            return
+        except OSError:
+            pass
+    elif link_mode == REFLINK_LINK_MODE:
+        try:
+            import fcntl
+            with open(source_path, "rb") as source_file, open(dest_path, "wb") as dest_file:
+                fcntl.ioctl(dest_file.fileno(), FICLONE, source_file.fileno())
+            shutil.copymode(source_path, dest_path)
+            return
+        except (ImportError, OSError):
+            if os.path.lexists(dest_path):
+                os.remove(dest_path)
+
+    shutil.copy(source_path, dest_path)
+
+
+def copy_page_files(relative_directory, data_file_types_and_paths):
+    """Copies a page's images to the website directory, unless they're unchanged since the previous run.
+
+    Returns:
+        2-tuple: (dict that maps output paths of images => [size, mtime], number of images copied)
+    """
+    previous_files = PREVIOUS_MANIFEST["files"]
+
+    page_dir = os.path.join(WEBSITE_DIR, relative_directory)
+    os.makedirs(page_dir, exist_ok=True)
+
+    files = {}
+    num_files_copied = 0
+    for data_file_type, data_file_path in data_file_types_and_paths:
+        if data_file_type in (METADATA_JSON_FILE_TYPE, CONTENT_HTML_FILE_TYPE):
+            continue
+        dest_path = os.path.join(page_dir, os.path.basename(data_file_path))
+        files[dest_path] = get_file_stat(data_file_path)
+        if previous_files.get(dest_path) == files[dest_path] and os.path.exists(dest_path):
+            continue
+        if STATE.args.verbose:
+            print("Copying", data_file_type, data_file_path, "to", page_dir)
+        link_or_copy_file(data_file_path, dest_path, STATE.args.static_website_link_mode)
+        num_files_copied += 1
+
+    return files, num_files_copied
+
+
+def generate_page(task):
+    """Renders one data page and copies its images, unless they're unchanged since the previous run.
+
+    Args:
+        task (tuple): (page number, last page number, relative directory, data files)
+
+    Returns:
+        dict: the page filename and inputs hash, the output paths of the images and their [size, mtime], whether the
+            page was rendered, and the number of images copied
+    """
+    page_number, last_page_number, relative_directory, data_file_types_and_paths = task
+    files, num_files_copied = copy_page_files(relative_directory, data_file_types_and_paths)
+
+    page_filename = STATE.get_static_data_page_url(page_number, last_page_number)
+    page_hash = get_page_inputs_hash(page_number, last_page_number, relative_directory, data_file_types_and_paths)
+    page_path = os.path.join(WEBSITE_DIR, page_filename)
+    rendered = page_hash != PREVIOUS_MANIFEST["pages"].get(page_filename) or not os.path.isfile(page_path)
+    if rendered:
+        with APP.test_request_context(get_data_page_url(page_number, last_page_number)):
+            write_html(page_path, DATA_PAGE_HANDLER(is_static_website=True).get_data(as_text=True))
+
+    return {
+        "page_filename": page_filename,
+        "page_hash": page_hash,
+        "files": files,
+        "rendered": rendered,
+        "num_files_copied": num_files_copied,
+    }
+
+
+def generate_page_data(task):
+    """Same as generate_page(..), but instead of rendering the page, returns the data that the single-page viewer
+    needs to render it
+    """
+    page_number, last_page_number, relative_directory, data_file_types_and_paths = task
+    files, num_files_copied = copy_page_files(relative_directory, data_file_types_and_paths)
+
+    metadata = dict(STATE.relative_directory_to_metadata.get(relative_directory, {}))
+    metadata.update(STATE.extra_data_in_form_responses_table.get(relative_directory, {}))
+
+    content_html = []
+    for data_file_type, data_file_path in data_file_types_and_paths:
+        if data_file_type == CONTENT_HTML_FILE_TYPE:
+            with open(data_file_path, "rt") as f:
+                content_html.append([data_file_path, f.read()])
+
+    return {
+        "files": files,
+        "num_files_copied": num_files_copied,
+        "page_data": {
+            "path": relative_directory,
+            "images": [p for data_file_type, p in data_file_types_and_paths if data_file_type == IMAGE_FILE_TYPE],
+            "metadata": metadata,
+            "content_html": content_html,
+        },
+    }
+
+
+def write_page_data_files(page_data_list):
+    """Writes the page data to json files with --static-website-shard-size pages each. Files whose contents are
+    unchanged aren't rewritten.
+
+    Returns:
+        3-tuple: (list of paths written or unchanged, number of files written, hash of the contents of all files)
+    """
+    os.makedirs(os.path.join(WEBSITE_DIR, PAGE_DATA_DIR), exist_ok=True)
+    shard_size = max(1, STATE.args.static_website_shard_size)
+    paths = []
+    num_files_written = 0
+    contents_hash = hashlib.sha1()
+    for shard_index, start in enumerate(range(0, len(page_data_list), shard_size)):
+        path = os.path.join(WEBSITE_DIR, PAGE_DATA_DIR, f"pages_{shard_index}.json")
+        data = json.dumps(page_data_list[start:start + shard_size], separators=(",", ":"), default=str).encode("UTF-8")
+        contents_hash.update(data)
+        paths.append(path)
+
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                if f.read() == data:
+                    continue
+        with open(path, "wb") as f:
+            f.write(data)
+        num_files_written += 1
+
+    return paths, num_files_written, contents_hash.hexdigest()
+
+
+def write_single_page_viewer(num_pages, manifest_version):
+    header_html = ""
+    if os.path.isfile(DATA_PAGE_HEADER_FILENAME):
+        with open(DATA_PAGE_HEADER_FILENAME, "rt") as f:
+            header_html = f.read()
+
+    write_html(os.path.join(WEBSITE_DIR, STATIC_WEBSITE_VIEWER_FILENAME), load_jinja_template("static_viewer").render(
+        header_html=header_html,
+        num_pages=num_pages,
+        shard_size=max(1, STATE.args.static_website_shard_size),
+        manifest_dir=PAGE_DATA_DIR,
+        manifest_version=manifest_version[:12],
+        show_one_key_per_line=STATE.args.show_one_key_per_line,
+        zoom=STATE.args.zoom,
+    ))
+
+
+def get_process_pool(num_processes):
+    """Returns a process pool whose workers are forked from this process, so they share its state. Returns None if
+    forking isn't supported on this platform or only 1 process was requested.
+    """
+    if num_processes <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+        return None
+
+    return ProcessPoolExecutor(max_workers=num_processes, mp_context=multiprocessing.get_context("fork"))
+
+
+def generate_static_website(app, main_list_handler, data_page_handler):
+    global APP, STATE, DATA_PAGE_HANDLER, RENDER_SETTINGS_HASH, PREVIOUS_MANIFEST
+
+    APP = app
+    STATE = get_state(app)
+
+    os.chdir(STATE.args.directory)
+    os.makedirs(WEBSITE_DIR, exist_ok=True)
+
+    DATA_PAGE_HANDLER = data_page_handler
+    RENDER_SETTINGS_HASH = get_render_settings_hash()
+
+    manifest_path = os.path.join(WEBSITE_DIR, STATIC_WEBSITE_MANIFEST_FILENAME)
+    previous_manifest = PREVIOUS_MANIFEST = load_manifest(manifest_path)
+
+    with app.test_request_context("/"):
+        write_html(os.path.join(WEBSITE_DIR, "index.html"), main_list_handler(is_static_website=True).get_data(as_text=True))
+    with open(os.path.join(WEBSITE_DIR, "favicon.png"), "wb") as f:
+        f.write(pkgutil.get_data('flipbook', 'static/images/favicon.png'))
+
+    flipbook_package_dir = sys.modules['flipbook'].__path__[0]
+    static_dir = os.path.join(flipbook_package_dir, "static")
+    print("Copying", static_dir)
+    shutil.copytree(static_dir, os.path.join(WEBSITE_DIR, "static"), dirs_exist_ok=True)
+
+    relative_directory_to_data_files_list = STATE.pages.relative_directory_to_data_files_list
+    last_page_number = len(relative_directory_to_data_files_list)
+    tasks = [
+        (i + 1, last_page_number, relative_directory, data_file_types_and_paths)
+        for i, (relative_directory, data_file_types_and_paths) in enumerate(relative_directory_to_data_files_list)
+    ]
+
+    is_single_page_website = STATE.args.static_website_mode == SINGLE_PAGE_STATIC_WEBSITE_MODE
+    manifest = {"format_version": STATIC_WEBSITE_MANIFEST_FORMAT_VERSION, "pages": {}, "files": {}}
+    page_data_list = []
+    num_pages_rendered = 0
+    num_files_copied = 0
+    process_pool = get_process_pool(STATE.args.static_website_processes)
+    task_function = generate_page_data if is_single_page_website else generate_page
+    try:
+        if process_pool is not None:
+            print(f"Generating {len(tasks)} pages using {STATE.args.static_website_processes} processes")
+            chunk_size = max(1, min(64, len(tasks) // (4 * STATE.args.static_website_processes)))
+            results = process_pool.map(task_function, tasks, chunksize=chunk_size)
+        else:
+            results = map(task_function, tasks)
+
+        for result in results:
+            manifest["files"].update(result["files"])
+            num_files_copied += result["num_files_copied"]
+            if is_single_page_website:
+                page_data_list.append(result["page_data"])
+            else:
+                manifest["pages"][result["page_filename"]] = result["page_hash"]
+                num_pages_rendered += int(result["rendered"])
+    finally:
+        if process_pool is not None:
+            process_pool.shutdown()
+
+    if is_single_page_website:
+        page_data_paths, num_page_data_files_written, page_data_hash = write_page_data_files(page_data_list)
+        write_single_page_viewer(len(page_data_list), page_data_hash)
+        # record the page data files in the manifest so that they're deleted if they're no longer needed
+        manifest["page_data_files"] = page_data_paths
+        print(f"Wrote {num_page_data_files_written} out of {len(page_data_paths)} page data files to "
+              f"{os.path.join(WEBSITE_DIR, PAGE_DATA_DIR)}. The rest were unchanged since the previous run.")
+
+    # delete pages and images that were generated previously but are no longer part of the website, and .gz files
+    # from previous runs with --static-website-gzip
+    paths_to_delete = [os.path.join(WEBSITE_DIR, p) for p in set(previous_manifest["pages"]) - set(manifest["pages"])]
+    paths_to_delete += [f"{p}.gz" for p in paths_to_delete]
+    paths_to_delete += list(set(previous_manifest["files"]) - set(manifest["files"]))
+    paths_to_delete += list(set(previous_manifest.get("page_data_files", [])) - set(manifest.get("page_data_files", [])))
+    if previous_manifest.get("page_data_files") and not is_single_page_website:
+        paths_to_delete.append(os.path.join(WEBSITE_DIR, STATIC_WEBSITE_VIEWER_FILENAME))
+    if not STATE.args.static_website_gzip and previous_manifest.get("gzip"):
+        paths_to_delete += [os.path.join(WEBSITE_DIR, f"{p}.gz") for p in [
+            "index.html", STATIC_WEBSITE_VIEWER_FILENAME] + list(manifest["pages"])]
+    manifest["gzip"] = STATE.args.static_website_gzip
+
+    num_files_deleted = 0
+    for path in paths_to_delete:
+        if os.path.isfile(path):
+            os.remove(path)
+            num_files_deleted += 1
+
+    save_manifest(manifest_path, manifest)
+
+    print((f"Rendered {num_pages_rendered} out of {len(tasks)} pages and copied " if not is_single_page_website else
+           "Copied ") + f"{num_files_copied} out of {len(manifest['files'])} files. The rest were unchanged since the "
+          f"previous run." + (f" Deleted {num_files_deleted} files that are no longer needed." if num_files_deleted else ""))
+    print("Done")
+    print(f"Generated static website in the {os.path.realpath(WEBSITE_DIR)} directory")
@@ -0,0 +1,164 @@
+"""Reading and writing the metadata and form responses tables.
+
+Tables can be .tsv, .xls/.xlsx, or - if the optional 'pyarrow' package is installed - Parquet or Feather (Arrow IPC)
+files. Parquet and Feather tables are memory-mapped, and when only some columns are needed, the other columns aren't
+read from disk at all.
+
+pandas and pyarrow are only imported when a table is read or written, since importing them takes a noticeable part of
+the server's startup time.
+
+Writing a large Excel table takes seconds of CPU time, so Excel tables are written by a separate process. Otherwise,
+the thread that updates the form responses table would hold the GIL for that long, and slow down request handling.
+"""
+
+import importlib.util
+import os
+
+PATH_COLUMN = 'Path'
+
+EXCEL_TABLE_SUFFIXES = ("xls", "xlsx")
+PARQUET_TABLE_SUFFIXES = (".parquet", ".pq")
+FEATHER_TABLE_SUFFIXES = (".feather", ".arrow", ".ipc")
+
+# reads a pickled table from stdin and writes it to the given Excel file, like write_excel_table(..)
+EXCEL_WRITER_SCRIPT = """
+import pickle, sys
+df = pickle.load(sys.stdin.buffer)
+with open(sys.argv[1], "wb") as f:
+    df.to_excel(f, index=False, engine="openpyxl")
+"""
+
+
+def is_excel_table(path):
+    return any(path.endswith(suffix) for suffix in EXCEL_TABLE_SUFFIXES)
+
+
+def is_parquet_table(path):
+    return path.lower().endswith(PARQUET_TABLE_SUFFIXES)
+
+
+def is_feather_table(path):
+    return path.lower().endswith(FEATHER_TABLE_SUFFIXES)
+
+
+def is_arrow_table(path):
+    """Returns True if the given table is a Parquet or Feather file, which requires the 'pyarrow' package"""
+    return is_parquet_table(path) or is_feather_table(path)
+
+
+def is_pyarrow_available():
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def check_table_format_is_supported(path):
+    """Raises a ValueError if reading or writing the given table requires a package that isn't installed"""
+    if is_arrow_table(path) and not is_pyarrow_available():
+        raise ValueError(f"{path} is a Parquet or Feather table, which requires the 'pyarrow' package. To install it, "
+                         f"run: python3 -m pip install pyarrow")
+
+
+def parse_table(path, columns=None):
+    """Parses a .tsv, .xls, .parquet or .feather table that has a 'Path' column.
+
+    Args:
+        path (str): table path
+        columns (list): if specified, only these columns are read (along with the 'Path' column)
+
+    Return:
+        pandas.DataFrame: the table, indexed by the 'Path' column, with missing values replaced by empty strings
+    """
+    if not os.path.isfile(path):
+        raise ValueError(f"{path} not found")
+
+    check_table_format_is_supported(path)
+
+    if columns is not None:
+        columns = [PATH_COLUMN] + [c for c in columns if c != PATH_COLUMN]
+
+    import pandas as pd
+
+    try:
+        if is_arrow_table(path):
+            import pyarrow.feather
+            import pyarrow.parquet
+
+            read_arrow_table = pyarrow.parquet.read_table if is_parquet_table(path) else pyarrow.feather.read_table
+            df = read_arrow_table(path, columns=columns, memory_map=True).to_pandas()
+        elif is_excel_table(path):
+            df = pd.read_excel(path, engine="openpyxl", usecols=columns)
+        else:
+            df = pd.read_table(path, usecols=columns)
+    except Exception as e:
+        raise ValueError(f"Unable to parse {path}: {e}")
+
+        # validate table contents
+    if PATH_COLUMN not in df.columns:
+        raise ValueError(f"{path} must have a column named '{PATH_COLUMN}'")
+
+    df.set_index(PATH_COLUMN, inplace=True, drop=False)
+
+    df = df.fillna('')
+    print(f"Parsed {len(df)} rows from {path}")
+
+    return df
+
+
+def get_table_rows(df, columns):
+    """Returns (path, row dict) pairs for all rows in the given table. Unlike df.iterrows(), this doesn't create a
+    pandas Series for each row, and values keep the type of their column instead of being converted to a type that's
+    common to the whole row.
+
+    Args:
+        df (pandas.DataFrame): a table returned by parse_table(..)
+        columns (list): the columns to include in each row dict
+    """
+    return zip(df[PATH_COLUMN].tolist(), df[columns].to_dict(orient="records"))
+
+
+def write_excel_table(df, path):
+    """Writes the given table to an Excel file in .xlsx format, which is the format that parse_table(..) reads
+    both .xls and .xlsx tables as. The file object is passed to pandas so that it doesn't reject the .xls suffix.
+    """
+    with open(path, "wb") as f:
+        df.to_excel(f, index=False, engine="openpyxl")
+
+
+def write_excel_table_in_separate_process(df, path):
+    """Writes the table with write_excel_table(..) in a new python process. The table is passed to the process as a
+    pickle, so the process only needs to import pandas, and not flipbook or the script that started the server.
+    """
+    import pickle
+    import subprocess
+    import sys
+
+    try:
+        result = subprocess.run([sys.executable, "-c", EXCEL_WRITER_SCRIPT, path], input=pickle.dumps(df),
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except OSError as e:
+        print(f"WARNING: unable to start a process for writing {path}: {e}. Writing it in the server process instead.")
+        write_excel_table(df, path)
+        return
+
+    if result.returncode != 0:
+        error_message = result.stderr.decode("UTF-8", errors="replace").strip().split("\n")[-1]
+        raise ValueError(f"Unable to write {path}: {error_message}")
+
+
+def write_table(df, path):
+    """Writes the given table to a .tsv, .xls, .parquet or .feather file, depending on the path's suffix. The table is
+    written to a temp file first and then renamed, so it's never left partially written.
+    """
+    output_dir, output_filename = os.path.split(path)
+    temp_path = os.path.join(output_dir, f".tmp.{output_filename}")
+    if is_excel_table(path):
+        write_excel_table_in_separate_process(df, temp_path)
+    elif is_arrow_table(path):
+        # columns that contain a mix of strings and numbers can't be stored in Arrow format
+        df = df.astype(str)
+        if is_parquet_table(path):
+            df.to_parquet(temp_path, index=False)
+        else:
+            df.reset_index(drop=True).to_feather(temp_path)
+    else:
+        df.to_csv(temp_path, sep="\t", header=True, index=False)
+    os.replace(temp_path, path)
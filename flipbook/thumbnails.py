@@ -0,0 +1,225 @@
+"""Downscaled copies of images for the thumbnail column on the home page (--show-thumbnails) and for data pages
+(--max-image-width). They're created on demand by the /thumb/<path>?w=<width> endpoint and kept in a disk cache that's
+limited to --thumbnail-cache-size megabytes by deleting the least recently used files.
+
+Resizing requires the optional 'Pillow' package. Without it, the /thumb endpoint returns the original images.
+"""
+
+import collections
+import hashlib
+import io
+import os
+import threading
+
+from flask import request, Response, send_file as flask_send_file
+from werkzeug.utils import safe_join
+
+from flipbook.file_server import send_file, set_cache_headers
+from flipbook.state import get_state
+from flipbook.utils import DATA_FILE_SUFFIXES, IMAGE_FILE_TYPE, get_suffix_lookup, get_data_file_suffix
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+THUMBNAIL_URL_PREFIX = "/thumb/"
+DEFAULT_THUMBNAIL_CACHE_DIR = ".flipbook_thumbnails"
+
+MIN_THUMBNAIL_WIDTH = 16
+MAX_THUMBNAIL_WIDTH = 4096
+# round requested widths up to a multiple of this, so that arbitrary ?w= values don't fill up the cache
+THUMBNAIL_WIDTH_STEP = 32
+
+# animated gifs and svgs are always served as-is
+RESIZABLE_IMAGE_SUFFIX_TO_FORMAT = {"png": "PNG", "jpg": "JPEG", "jpeg": "JPEG", "webp": "WEBP"}
+IMAGE_FORMAT_TO_MIMETYPE = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+SUFFIX_LOOKUP = get_suffix_lookup(DATA_FILE_SUFFIXES)
+
+THUMBNAIL_CACHE = None
+THUMBNAIL_CACHE_LOCK = threading.Lock()
+
+
+class ThumbnailCache:
+    """A directory of resized images that's kept under max_size bytes by deleting the least recently used files.
+
+    The order of use is kept in memory and also recorded in the file mtimes, so it's preserved across restarts.
+    """
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._file_sizes = collections.OrderedDict()  # maps filename => size, least recently used first
+        self._total_size = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        cached_files = []
+        with os.scandir(cache_dir) as dir_entries:
+            for dir_entry in dir_entries:
+                if dir_entry.name.startswith(".") or not dir_entry.is_file():
+                    continue
+                stat = dir_entry.stat()
+                cached_files.append((stat.st_mtime, dir_entry.name, stat.st_size))
+
+        for _, filename, size in sorted(cached_files):
+            self._file_sizes[filename] = size
+            self._total_size += size
+
+        self._evict()
+
+    def __len__(self):
+        return len(self._file_sizes)
+
+    def get_path(self, filename):
+        """Returns the path of the given file if it's in the cache, and marks it as recently used. Otherwise returns
+        None.
+        """
+        with self._lock:
+            if filename not in self._file_sizes:
+                return None
+            self._file_sizes.move_to_end(filename)
+
+        path = os.path.join(self.cache_dir, filename)
+        try:
+            os.utime(path)
+        except OSError:
+            # the file was deleted outside of the server
+            with self._lock:
+                self._total_size -= self._file_sizes.pop(filename, 0)
+            return None
+
+        return path
+
+    def put(self, filename, data):
+        """Adds a file with the given contents to the cache, deleting least recently used files if the cache is
+        larger than max_size. Returns the path of the new file.
+        """
+        path = os.path.join(self.cache_dir, filename)
+
+        # write to a temp file and then rename it so that concurrent requests never see a partially written file. With
+        # --workers, other server processes may be writing the same file, so the temp file name includes the pid.
+        temp_path = os.path.join(self.cache_dir, f".tmp.{os.getpid()}.{threading.get_ident()}.{filename}")
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            self._total_size += len(data) - self._file_sizes.pop(filename, 0)
+            self._file_sizes[filename] = len(data)
+            self._evict()
+
+        return path
+
+    def _evict(self):
+        # always keep the most recently added file, even if it's larger than max_size by itself
+        while self._total_size > self.max_size and len(self._file_sizes) > 1:
+            filename, size = self._file_sizes.popitem(last=False)
+            self._total_size -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, filename))
+            except OSError as e:
+                print(f"WARNING: unable to delete {filename} from the thumbnail cache: {e}")
+
+
+def is_resizing_available():
+    return Image is not None
+
+
+def get_thumbnail_cache(args):
+    global THUMBNAIL_CACHE
+    with THUMBNAIL_CACHE_LOCK:
+        if THUMBNAIL_CACHE is None:
+            cache_dir = os.path.join(args.directory, args.thumbnail_cache_dir or DEFAULT_THUMBNAIL_CACHE_DIR)
+            THUMBNAIL_CACHE = ThumbnailCache(cache_dir, int(args.thumbnail_cache_size * 1024 * 1024))
+            if args.verbose:
+                print(f"Using thumbnail cache in {cache_dir} with {len(THUMBNAIL_CACHE)} files")
+
+    return THUMBNAIL_CACHE
+
+
+def get_thumbnail_url(relative_path, width):
+    """Returns the url of a version of the given image that's at most width pixels wide"""
+    return f"{THUMBNAIL_URL_PREFIX}{relative_path}?w={width}"
+
+
+def get_first_image_path(data_file_types_and_paths):
+    """Returns the relative path of the first image on a page, or None if the page has no images"""
+    for data_file_type, data_file_path in data_file_types_and_paths:
+        if data_file_type == IMAGE_FILE_TYPE:
+            return data_file_path
+
+    return None
+
+
+def get_thumbnail_width(value):
+    try:
+        width = int(value)
+    except (ValueError, TypeError):
+        return None
+
+    width = min(max(width, MIN_THUMBNAIL_WIDTH), MAX_THUMBNAIL_WIDTH)
+
+    return -(-width // THUMBNAIL_WIDTH_STEP) * THUMBNAIL_WIDTH_STEP
+
+
+def resize_image(absolute_path, width, image_format):
+    """Returns the bytes of the image scaled down to the given width, or None if it's not wider than that already"""
+    with Image.open(absolute_path) as image:
+        # Image.open(..) only reads the header, so this check doesn't decode the image
+        if image.width <= width:
+            return None
+
+        height = max(1, round(image.height * width / image.width))
+        if image_format == "JPEG":
+            # let the JPEG decoder skip detail that would be discarded anyway
+            image.draft("RGB", (width, height))
+        if image.mode not in ("RGB", "RGBA", "L", "LA"):
+            image = image.convert("RGBA" if image_format != "JPEG" else "RGB")
+        resized_image = image.resize((width, height), Image.LANCZOS)
+
+        output = io.BytesIO()
+        resized_image.save(output, format=image_format, **({"quality": 85} if image_format == "JPEG" else {}))
+
+    return output.getvalue()
+
+
+def thumbnail_handler(path):
+    """Returns the image at the given path, scaled down to the width given by the 'w' url param"""
+    args = get_state().args
+    width = get_thumbnail_width(request.args.get("w"))
+    if args.verbose:
+        print(f"thumbnail_handler received {request.url}")
+
+    absolute_path = safe_join(args.directory, path)
+    if absolute_path is None or not os.path.isfile(absolute_path):
+        return Response(f"{path} not found", status=404)
+
+    suffix = get_data_file_suffix(path, DATA_FILE_SUFFIXES, SUFFIX_LOOKUP)
+    image_format = RESIZABLE_IMAGE_SUFFIX_TO_FORMAT.get(suffix)
+    if width is None or image_format is None or not is_resizing_available():
+        return send_file(path)
+
+    # the cache key includes the size and mtime of the original, so the thumbnail is recreated if the image changes
+    stat = os.stat(absolute_path)
+    cache_key = hashlib.sha1(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\0{width}".encode("UTF-8")).hexdigest()
+    filename = f"{cache_key}.{image_format.lower()}"
+
+    try:
+        thumbnail_cache = get_thumbnail_cache(args)
+        thumbnail_path = thumbnail_cache.get_path(filename)
+        if thumbnail_path is None:
+            data = resize_image(absolute_path, width, image_format)
+            if data is None:
+                return send_file(path)
+            thumbnail_path = thumbnail_cache.put(filename, data)
+    except Exception as e:
+        print(f"WARNING: unable to create a {width} pixel wide version of {path}: {type(e).__name__} {e}")
+        return send_file(path)
+
+    # the cached file's mtime changes whenever it's used, so base the ETag and Last-Modified headers on the original
+    response = flask_send_file(thumbnail_path, mimetype=IMAGE_FORMAT_TO_MIMETYPE[image_format], conditional=True,
+                               etag=cache_key, last_modified=stat.st_mtime)
+
+    return set_cache_headers(response)
@@ -1,10 +1,10 @@
 import collections
-from jinja2 import Template
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import json
 import os
-import pkg_resources
+import pkgutil
 import sys
-from wcmatch import glob
+import time
 
 IMAGE_FILE_TYPE = "image"
 METADATA_JSON_FILE_TYPE = "metadata_json"
@@ -13,55 +13,219 @@ CONTENT_HTML_FILE_TYPE = "content_html"
 METADATA_JSON_FILE_SUFFIX = "flipbook_metadata.json"
 CONTENT_HTML_FILE_SUFFIX = "flipbook_content.html"
 
+DATA_FILE_SUFFIXES = ("svg", "png", "jpeg", "jpg", "gif", "webp", CONTENT_HTML_FILE_SUFFIX, METADATA_JSON_FILE_SUFFIX)
 
-def get_relative_directory_to_data_files_list(
+WEBSITE_DIR = "flipbook_html"
+
+# ways of adding images to the static website directory
+COPY_LINK_MODE = "copy"
+HARDLINK_LINK_MODE = "hardlink"
+REFLINK_LINK_MODE = "reflink"
+LINK_MODES = (COPY_LINK_MODE, HARDLINK_LINK_MODE, REFLINK_LINK_MODE)
+
+# static website layouts: one html file per page, or one viewer page that loads pages from a sharded json manifest
+PAGES_STATIC_WEBSITE_MODE = "pages"
+SINGLE_PAGE_STATIC_WEBSITE_MODE = "single-page"
+STATIC_WEBSITE_MODES = (PAGES_STATIC_WEBSITE_MODE, SINGLE_PAGE_STATIC_WEBSITE_MODE)
+STATIC_WEBSITE_VIEWER_FILENAME = "viewer.html"
+
+DEFAULT_SCAN_THREADS = min(32, 4 * (os.cpu_count() or 1))
+
+
+def get_suffix_lookup(suffixes):
+    """Returns a dict that maps the last '.'-separated part of each suffix to the list of suffixes that end with it,
+    longest first. This allows get_data_file_suffix(..) to classify a filename with one dict lookup.
+    """
+    suffix_lookup = collections.defaultdict(list)
+    for suffix in sorted(suffixes, key=len, reverse=True):
+        suffix_lookup[suffix.rsplit(".", 1)[-1]].append(suffix)
+    return dict(suffix_lookup)
+
+
+def get_data_file_suffix(filename, suffixes, suffix_lookup):
+    """Returns the suffix that the given filename ends with, or None if it doesn't end with any of them"""
+    for suffix in suffix_lookup.get(filename.rsplit(".", 1)[-1], ()):
+        if filename.endswith(suffix):
+            return suffix
+
+    # the filename could end with a suffix without a '.' before it, like "imagepng"
+    for suffix in suffixes:
+        if filename.endswith(suffix):
+            return suffix
+
+    return None
+
+
+def get_data_file_type(suffix):
+    if suffix == METADATA_JSON_FILE_SUFFIX:
+        return METADATA_JSON_FILE_TYPE
+    elif suffix == CONTENT_HTML_FILE_SUFFIX:
+        return CONTENT_HTML_FILE_TYPE
+    else:
+        return IMAGE_FILE_TYPE
+
+
+def list_directory(top_level_dir, relative_dir, suffixes, previous_entry, verbose=False):
+    """Returns a {"mtime": .., "files": [..], "subdirectories": [..]} dict for the given directory, or None if it
+    can't be accessed. If previous_entry has the same mtime as the directory, it's returned without listing the
+    directory again. The 2nd return value is True if the directory was listed.
+    """
+    absolute_dir = os.path.join(top_level_dir, relative_dir)
+    try:
+        mtime = os.stat(absolute_dir).st_mtime
+    except OSError as e:
+        print(f"WARNING: unable to access {absolute_dir}: {e}")
+        return None, False
+
+    if previous_entry is not None and previous_entry["mtime"] == mtime:
+        return previous_entry, False
+
+    if verbose > 1:
+        print(f"Listing {absolute_dir}")
+
+    entry = {"mtime": mtime, "files": [], "subdirectories": []}
+    try:
+        with os.scandir(absolute_dir) as dir_entries:
+            for dir_entry in dir_entries:
+                if dir_entry.name.startswith("."):
+                    continue
+                if dir_entry.is_dir(follow_symlinks=False):
+                    entry["subdirectories"].append(dir_entry.name)
+                elif dir_entry.name.endswith(suffixes) and dir_entry.is_file():
+                    entry["files"].append(dir_entry.name)
+    except OSError as e:
+        print(f"WARNING: unable to list {absolute_dir}: {e}")
+        return None, False
+
+    entry["files"].sort()
+    entry["subdirectories"].sort()
+
+    return entry, True
+
+
+def get_included_keyword_misses(relative_path, keywords_to_include):
+    """Returns the --include keywords that the given path doesn't contain"""
+    return [k for k in keywords_to_include if k not in relative_path] if keywords_to_include else []
+
+
+def get_excluded_keyword_matches(relative_path, keywords_to_exclude):
+    """Returns the --exclude keywords that the given path contains"""
+    return [k for k in keywords_to_exclude if k in relative_path] if keywords_to_exclude else []
+
+
+def scan_directory_tree(
         top_level_dir,
+        suffixes=DATA_FILE_SUFFIXES,
+        keywords_to_exclude=None,
+        previous_directories=None,
+        num_threads=DEFAULT_SCAN_THREADS,
+        verbose=False):
+    """Finds the data files in each directory under top_level_dir by listing directories in parallel using a thread
+    pool. On network filesystems this is mostly limited by the latency of each directory listing, so it's much faster
+    than listing directories one at a time.
+
+    Like a wcmatch GLOBSTAR glob, this skips hidden files and directories and doesn't follow symlinks to directories.
+
+    Args:
+        keywords_to_exclude (list): directories whose relative path contains any of these keywords are skipped without
+            listing them, since all file paths inside them would also contain the keyword.
+        previous_directories (dict): the "directories" dict from a previous scan. Directories whose mtime hasn't
+            changed since then aren't listed again.
+        num_threads (int): number of directories to list in parallel.
+
+    Returns:
+        2-tuple: (directories dict, stats dict). The directories dict maps each relative directory path ("" for
+            top_level_dir) to {"mtime": .., "files": [..], "subdirectories": [..]}. The stats dict has the number of
+            directories that were listed and that changed, and the excluded keyword => number of skipped directories.
+    """
+    start_time = time.time()
+    suffixes = tuple(suffixes)
+    keywords_to_exclude = keywords_to_exclude or []
+    previous_directories = previous_directories or {}
+    directories = {}
+    stats = {
+        "num_directories_listed": 0,
+        "num_directories_changed": 0,
+        "excluded_keyword_to_num_skipped_directories": collections.defaultdict(int),
+    }
+
+    def submit(executor, relative_dir):
+        excluded_keyword_matches = get_excluded_keyword_matches(relative_dir, keywords_to_exclude)
+        if excluded_keyword_matches:
+            keyword = excluded_keyword_matches[0]
+            stats["excluded_keyword_to_num_skipped_directories"][keyword] += 1
+            if verbose:
+                print(f"Skipping directory: {relative_dir} - it contains excluded keyword: '{keyword}'")
+            return None
+        return executor.submit(
+            list_directory, top_level_dir, relative_dir, suffixes, previous_directories.get(relative_dir), verbose)
+
+    with ThreadPoolExecutor(max_workers=max(1, num_threads)) as executor:
+        future_to_relative_dir = {submit(executor, ""): ""}
+        while future_to_relative_dir:
+            done, _ = wait(future_to_relative_dir, return_when=FIRST_COMPLETED)
+            for future in done:
+                relative_dir = future_to_relative_dir.pop(future)
+                entry, was_listed = future.result()
+                if entry is None:
+                    continue
+
+                directories[relative_dir] = entry
+                if was_listed:
+                    stats["num_directories_listed"] += 1
+                    previous_entry = previous_directories.get(relative_dir)
+                    if previous_entry is None or previous_entry["files"] != entry["files"] or \
+                            previous_entry["subdirectories"] != entry["subdirectories"]:
+                        stats["num_directories_changed"] += 1
+
+                for subdirectory in entry["subdirectories"]:
+                    subdirectory = os.path.join(relative_dir, subdirectory)
+                    future = submit(executor, subdirectory)
+                    if future is not None:
+                        future_to_relative_dir[future] = subdirectory
+
+    stats["num_directories_changed"] += len(set(previous_directories) - set(directories))
+
+    if verbose:
+        num_files = sum(len(entry["files"]) for entry in directories.values())
+        print(f"Scanned {len(directories)} directories (listed {stats['num_directories_listed']}) and found "
+              f"{num_files} data files in {time.time() - start_time:0.2f} seconds using {num_threads} threads")
+
+    return directories, stats
+
+
+def group_data_files_by_directory(
+        relative_data_file_paths,
         keywords_to_include,
         keywords_to_exclude,
-        suffixes=("svg", "png", "jpeg", "jpg", "gif", "webp", CONTENT_HTML_FILE_SUFFIX, METADATA_JSON_FILE_SUFFIX),
+        suffixes=DATA_FILE_SUFFIXES,
         verbose=False):
-    data_file_paths = []
+    """Filters data file paths by the --include and --exclude keywords and groups them by directory. Data files in the
+    top-level directory are each put in their own group.
 
-    print(f"Looking for " + ", ".join(suffixes[:-1]) + f", and {suffixes[-1]} files in {top_level_dir}")
-    if keywords_to_include or keywords_to_exclude:
-        sys.stdout.write("Keeping only file paths that ")
-        if keywords_to_include:
-            sys.stdout.write("contain " + " and ".join([f'"{k}"' for k in keywords_to_include]))
-        if keywords_to_include and keywords_to_exclude:
-            sys.stdout.write(" and ")
-        if keywords_to_exclude:
-            sys.stdout.write("don't contain " + " or ".join([f'"{k}"' for k in keywords_to_exclude]))
-        sys.stdout.write("\n")
-
-    glob_string = "|".join([f"{top_level_dir}/**/*{suffix}" for suffix in suffixes]).replace("\\", "/")
-    matching_paths = glob.glob(glob_string, flags=glob.GLOBSTAR|glob.SPLIT)
-    data_file_paths += matching_paths
-
-    # group data files by their directory
+    Returns:
+        2-tuple: (dict that maps relative directory => [(data file type, relative data file path), ...], stats dict)
+    """
+    suffix_lookup = get_suffix_lookup(suffixes)
     subdirectories_list = []
     data_file_counter_by_suffix = collections.defaultdict(int)
     relative_directory_to_data_files = collections.defaultdict(list)
     excluded_keyword_to_matching_paths = collections.defaultdict(list)
-    for data_file_path in data_file_paths:
-        data_file_path = os.path.realpath(data_file_path)
-        for suffix in suffixes:
-            if data_file_path.endswith(suffix):
-                data_file_suffix = suffix
-                break
-        else:
-            raise Exception(f"Unexpected file suffix: {data_file_path}")
+    for relative_data_file_path in relative_data_file_paths:
+        data_file_suffix = get_data_file_suffix(relative_data_file_path, suffixes, suffix_lookup)
+        if data_file_suffix is None:
+            raise Exception(f"Unexpected file suffix: {relative_data_file_path}")
 
         data_file_counter_by_suffix[data_file_suffix] += 1
-        relative_data_file_path = os.path.relpath(data_file_path, top_level_dir)
 
         if keywords_to_include:
-            included_keyword_misses = [k for k in keywords_to_include if k not in relative_data_file_path] if keywords_to_include else []
+            included_keyword_misses = get_included_keyword_misses(relative_data_file_path, keywords_to_include)
             if included_keyword_misses:
                 if verbose:
                     print(f"Skipping {data_file_suffix} file: {relative_data_file_path} - it doesn't contain --include keyword(s): ", ", ".join(included_keyword_misses))
                 continue
 
-        excluded_keyword_matches = [k for k in keywords_to_exclude if k in relative_data_file_path] if keywords_to_exclude else []
+        excluded_keyword_matches = get_excluded_keyword_matches(relative_data_file_path, keywords_to_exclude)
         if excluded_keyword_matches:
             excluded_keyword_to_matching_paths[excluded_keyword_matches[0]].append(relative_data_file_path)
             if verbose:
@@ -77,14 +241,71 @@ def get_relative_directory_to_data_files_list(
         else:
             key = relative_data_file_path
 
-        if data_file_suffix == METADATA_JSON_FILE_SUFFIX:
-            data_file_type = METADATA_JSON_FILE_TYPE
-        elif data_file_suffix == CONTENT_HTML_FILE_SUFFIX:
-            data_file_type = CONTENT_HTML_FILE_TYPE
-        else:
-            data_file_type = IMAGE_FILE_TYPE
+        relative_directory_to_data_files[key].append((get_data_file_type(data_file_suffix), relative_data_file_path))
+
+    # within each directory, order files the same way as the previous glob-based search: by suffix, then by path
+    suffix_order = {suffix: i for i, suffix in enumerate(suffixes)}
+    for data_files in relative_directory_to_data_files.values():
+        data_files.sort(key=lambda data_file: (
+            suffix_order[get_data_file_suffix(data_file[1], suffixes, suffix_lookup)], data_file[1]))
+
+    stats = {
+        "data_file_counter_by_suffix": data_file_counter_by_suffix,
+        "subdirectories_list": subdirectories_list,
+        "excluded_keyword_to_matching_paths": excluded_keyword_to_matching_paths,
+    }
+
+    return relative_directory_to_data_files, stats
+
+
+def get_relative_directory_to_data_files_list(
+        top_level_dir,
+        keywords_to_include,
+        keywords_to_exclude,
+        suffixes=DATA_FILE_SUFFIXES,
+        verbose=False,
+        relative_data_file_paths=None,
+        num_threads=DEFAULT_SCAN_THREADS):
+    """Finds data files in top_level_dir and groups them by directory.
+
+    Args:
+        relative_data_file_paths (list): optional list of data file paths relative to top_level_dir (eg. from the scan
+            index). If specified, these are used instead of searching top_level_dir.
+        num_threads (int): number of directories to list in parallel when searching top_level_dir.
+
+    Returns:
+        list: sorted list of (relative directory, [(data file type, relative data file path), ...]) tuples
+    """
+    if relative_data_file_paths is None:
+        print(f"Looking for " + ", ".join(suffixes[:-1]) + f", and {suffixes[-1]} files in {top_level_dir}")
+    else:
+        print(f"Loaded {len(relative_data_file_paths)} data file paths from the scan index for {top_level_dir}")
+    if keywords_to_include or keywords_to_exclude:
+        sys.stdout.write("Keeping only file paths that ")
+        if keywords_to_include:
+            sys.stdout.write("contain " + " and ".join([f'"{k}"' for k in keywords_to_include]))
+        if keywords_to_include and keywords_to_exclude:
+            sys.stdout.write(" and ")
+        if keywords_to_exclude:
+            sys.stdout.write("don't contain " + " or ".join([f'"{k}"' for k in keywords_to_exclude]))
+        sys.stdout.write("\n")
 
-        relative_directory_to_data_files[key].append((data_file_type, relative_data_file_path))
+    excluded_keyword_to_num_skipped_directories = {}
+    if relative_data_file_paths is None:
+        directories, stats = scan_directory_tree(
+            top_level_dir, suffixes, keywords_to_exclude=keywords_to_exclude, num_threads=num_threads, verbose=verbose)
+        relative_data_file_paths = [
+            os.path.join(relative_dir, filename)
+            for relative_dir, entry in directories.items()
+            for filename in entry["files"]
+        ]
+        excluded_keyword_to_num_skipped_directories = stats["excluded_keyword_to_num_skipped_directories"]
+
+    relative_directory_to_data_files, stats = group_data_files_by_directory(
+        relative_data_file_paths, keywords_to_include, keywords_to_exclude, suffixes=suffixes, verbose=verbose)
+    data_file_counter_by_suffix = stats["data_file_counter_by_suffix"]
+    subdirectories_list = stats["subdirectories_list"]
+    excluded_keyword_to_matching_paths = stats["excluded_keyword_to_matching_paths"]
 
     data_file_counter_string = ", ".join([
         ("" if i < len(data_file_counter_by_suffix) - 1 or len(data_file_counter_by_suffix) < 2 else "and ") +
@@ -96,6 +317,8 @@ def get_relative_directory_to_data_files_list(
         f" in {len(subdirectories_list)} subdirectories" if len(subdirectories_list) > 1 else ""
     ))
 
+    for excluded_keyword, num_skipped_directories in excluded_keyword_to_num_skipped_directories.items():
+        print(f"Skipped {num_skipped_directories} directories which contained excluded keyword: '{excluded_keyword}'")
     for excluded_keyword, matching_paths in excluded_keyword_to_matching_paths.items():
         print(f"Skipped {len(matching_paths)} paths which contained excluded keyword: '{excluded_keyword}'")
 
@@ -104,49 +327,122 @@ def get_relative_directory_to_data_files_list(
     return relative_directory_to_data_files_list
 
 
-def get_relative_directory_to_metadata(top_level_dir, relative_directory_to_data_files_list, verbose=False):
+def read_metadata_json_file(top_level_dir, data_file_path):
+    """Returns the parsed contents of a flipbook_metadata.json file, or None if it can't be parsed"""
+    metadata_json_path = os.path.join(top_level_dir, data_file_path)
+    try:
+        with open(metadata_json_path, "rt") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Unable to parse {metadata_json_path}: {e}")
+        return None
+
+
+def get_relative_directory_to_metadata(top_level_dir, relative_directory_to_data_files_list, verbose=False,
+                                       metadata_json_cache=None, print_summary=True,
+                                       num_threads=DEFAULT_SCAN_THREADS, keys_to_keep=None):
+    """Parses the flipbook_metadata.json files.
+
+    Args:
+        metadata_json_cache (dict): optional dictionary that maps relative metadata json paths to
+            {"mtime": .., "metadata": ..} dicts. Files whose mtime matches the cached mtime are not re-read, and the
+            cache is updated for files that are re-read.
+        print_summary (bool): whether to print the number of files parsed and how long it took.
+        num_threads (int): number of files to read in parallel.
+        keys_to_keep (set): if specified, only these keys are kept from each file, and the rest of the metadata can be
+            loaded later when it's needed. If it's empty and there's no metadata_json_cache, no files are read.
+    """
+    start_time = time.time()
+    metadata_json_file_paths = [
+        (relative_dir, data_file_path)
+        for relative_dir, data_files_list in relative_directory_to_data_files_list
+        for data_file_type, data_file_path in data_files_list
+        if data_file_type == METADATA_JSON_FILE_TYPE
+    ]
+
+    if keys_to_keep is not None and not keys_to_keep and metadata_json_cache is None:
+        if metadata_json_file_paths and print_summary:
+            print(f"Deferred parsing {len(metadata_json_file_paths)} {METADATA_JSON_FILE_SUFFIX} files until their "
+                  f"pages are opened")
+        return [], {}
+
+    def load_metadata_json(data_file_path):
+        """Returns a (metadata_json, mtime, was_read) tuple. The cache is only read here and updated by the caller."""
+        mtime = None
+        if metadata_json_cache is not None:
+            try:
+                mtime = os.path.getmtime(os.path.join(top_level_dir, data_file_path))
+            except OSError as e:
+                print(f"Unable to parse {os.path.join(top_level_dir, data_file_path)}: {e}")
+                return None, None, False
+
+            cached_entry = metadata_json_cache.get(data_file_path)
+            if cached_entry is not None and cached_entry["mtime"] == mtime:
+                return cached_entry["metadata"], mtime, False
+
+        return read_metadata_json_file(top_level_dir, data_file_path), mtime, True
+
+    # most of the time is spent waiting for the filesystem, so threads help even though json parsing holds the GIL
+    data_file_paths = [data_file_path for _, data_file_path in metadata_json_file_paths]
+    if num_threads > 1 and len(data_file_paths) > 1:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            results = list(executor.map(load_metadata_json, data_file_paths))
+    else:
+        results = [load_metadata_json(data_file_path) for data_file_path in data_file_paths]
+
     metadata_columns = collections.OrderedDict()
     relative_directory_to_metadata = {}
-    # parse the flipbook_metadata.json file from each directory
-    for relative_dir, data_files_list in relative_directory_to_data_files_list:
-        for data_file_type, data_file_path in data_files_list:
-            if data_file_type != METADATA_JSON_FILE_TYPE:
-                continue
+    num_files_read = 0
+    for (relative_dir, data_file_path), (metadata_json, mtime, was_read) in zip(metadata_json_file_paths, results):
+        if was_read and metadata_json is not None:
+            num_files_read += 1
+            if metadata_json_cache is not None:
+                metadata_json_cache[data_file_path] = {"mtime": mtime, "metadata": metadata_json}
+
+        if metadata_json is None:
+            continue
 
-            metadata_json_path = os.path.join(top_level_dir, data_file_path)
-            try:
-                with open(metadata_json_path, "rt") as f:
-                    metadata_json = json.load(f)
-            except Exception as e:
-                print(f"Unable to parse {metadata_json_path}: {e}")
-                continue
+        metadata_json_path = os.path.join(top_level_dir, data_file_path)
+        if not isinstance(metadata_json, dict):
+            print(f"WARNING: {metadata_json_path} doesn't contain a dictionary. Skipping...")
+            continue
 
-            if not isinstance(metadata_json, dict):
-                print(f"WARNING: {metadata_json_path} doesn't contain a dictionary. Skipping...")
-                continue
+        if verbose:
+            print(f"Parsed {len(metadata_json)} metadata entries from {metadata_json_path}")
 
-            if verbose:
-                print(f"Parsed {len(metadata_json)} metadata entries from {metadata_json_path}")
+        if keys_to_keep is not None:
+            metadata_json = {key: value for key, value in metadata_json.items() if key in keys_to_keep}
 
-            relative_directory_to_metadata[relative_dir] = metadata_json
+        relative_directory_to_metadata[relative_dir] = metadata_json
 
-            for key in metadata_json:
-                metadata_columns[key] = None
+        for key in metadata_json:
+            metadata_columns[key] = None
 
-    if relative_directory_to_metadata:
-        print(f"Parsed {len(relative_directory_to_metadata)} {METADATA_JSON_FILE_SUFFIX} files" + (
-            f" with columns: {', '.join(metadata_columns)}" if metadata_columns else ""))
+    if relative_directory_to_metadata and print_summary:
+        print(f"Parsed {len(relative_directory_to_metadata)} {METADATA_JSON_FILE_SUFFIX} files in "
+              f"{time.time() - start_time:0.2f} seconds" + (
+              f" with columns: {', '.join(metadata_columns)}" if metadata_columns else "") + (
+              f" ({num_files_read} files were re-read, the rest were loaded from the scan index)"
+              if metadata_json_cache is not None else f" ({num_files_read} files were read)") + (
+              " - other keys will be loaded when their pages are opened" if keys_to_keep is not None else ""))
 
     return list(metadata_columns.keys()), relative_directory_to_metadata
 
 
-def is_excel_table(path):
-    return any(path.endswith(suffix) for suffix in ("xls", "xlsx"))
+def get_data_page_url(page_number, last, page_order_query_string=""):
+    """Returns the url of a data page.
 
-
-def get_data_page_url(page_number, last):
-    return f"/page?last={last}&i={page_number}"
+    Args:
+        page_number (int): 1-based page number
+        last (int): total number of pages
+        page_order_query_string (str): optional url params that specify the page order, so that page_number refers to
+            a page in that order
+    """
+    url = f"/page?last={last}&i={page_number}"
+    return f"{url}&{page_order_query_string}" if page_order_query_string else url
 
 
 def load_jinja_template(name):
-    return Template(pkg_resources.resource_stream("flipbook" , f"templates/{name}.html").read().decode('UTF-8'))
+    from jinja2 import Template
+
+    return Template(pkgutil.get_data("flipbook", f"templates/{name}.html").decode('UTF-8'))
@@ -0,0 +1,404 @@
+"""With --watch, the server keeps watching the top-level directory for new, changed or deleted images and data files,
+and updates the list of pages and their metadata without restarting.
+
+If the optional 'watchdog' package is installed, filesystem events (eg. inotify on Linux) are used to find the
+directories that changed. Otherwise, every --watch-interval seconds the mtimes of the directories and
+flipbook_metadata.json files in the in-memory scan index are checked to find them. Either way, only the changed
+directories are listed again, only their flipbook_metadata.json files are parsed again, and only their pages are
+replaced in the list of pages and the metadata dict. Request handlers on other threads may be using the current
+PageSet and metadata dict, so new ones are built and then assigned to the state instead of updating the current ones
+in place.
+"""
+
+import bisect
+import os
+import threading
+import time
+
+from flipbook.page_cache import invalidate_all_pages, invalidate_page
+from flipbook.page_index import PageSet
+from flipbook.scan_index import write_scan_index_if_changed
+from flipbook.utils import group_data_files_by_directory, get_relative_directory_to_metadata, list_directory, \
+    get_excluded_keyword_matches, get_included_keyword_misses, scan_directory_tree, DATA_FILE_SUFFIXES, \
+    METADATA_JSON_FILE_TYPE
+
+# wait this many seconds after a filesystem event before applying changes, so that a burst of events (eg. copying a
+# directory of images) results in one update
+WATCHDOG_EVENT_DELAY = 0.5
+
+WATCH_THREAD = None
+
+
+class ChangedDirectories:
+    """The set of relative directories that changed since the last update. Filesystem event handlers add to it from the
+    watchdog thread, and the watch thread takes them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._relative_dirs = set()
+        self._event = threading.Event()
+
+    def add(self, relative_dirs):
+        with self._lock:
+            self._relative_dirs.update(relative_dirs)
+        self._event.set()
+
+    def wait(self):
+        self._event.wait()
+
+    def pop_all(self):
+        with self._lock:
+            self._event.clear()
+            relative_dirs = self._relative_dirs
+            self._relative_dirs = set()
+
+        return relative_dirs
+
+
+def get_depth(relative_dir):
+    return relative_dir.count(os.sep) + 1 if relative_dir else 0
+
+
+def update_scan_index_directories(state, relative_dirs):
+    """Lists the given directories again and updates their entries in the scan index. New subdirectories are listed
+    too, and the entries of deleted directories and their subdirectories are removed. Directories that aren't in the
+    scan index and whose parent directory isn't either (eg. because it contains an excluded keyword) are skipped.
+
+    Args:
+        state (FlipBookState): the server state
+        relative_dirs (iterable): directories to list, relative to the top-level directory ("" for the top-level
+            directory itself)
+
+    Return:
+        dict: maps each directory that was listed or removed to its previous scan index entry, or None if it's new
+    """
+    args = state.args
+    directories = state.scan_index["directories"]
+    keywords_to_exclude = state.scan_index.get("excluded_keywords", [])
+    suffixes = tuple(state.scan_index["suffixes"])
+    previous_entries = {}
+
+    def remove_directory(relative_dir):
+        entry = directories.pop(relative_dir, None)
+        if entry is None:
+            return
+        previous_entries.setdefault(relative_dir, entry)
+        for subdirectory in entry["subdirectories"]:
+            remove_directory(os.path.join(relative_dir, subdirectory))
+
+    # list parent directories before their subdirectories, so that new subdirectories are found by listing the parent
+    relative_dirs_to_list = sorted(set(relative_dirs), key=get_depth)
+    listed_relative_dirs = set()
+    while relative_dirs_to_list:
+        relative_dir = relative_dirs_to_list.pop(0)
+        if relative_dir in listed_relative_dirs or any(keyword in relative_dir for keyword in keywords_to_exclude):
+            continue
+        if relative_dir not in directories and os.path.dirname(relative_dir) not in directories:
+            continue
+        listed_relative_dirs.add(relative_dir)
+
+        entry = None
+        if os.path.isdir(os.path.join(args.directory, relative_dir)):
+            entry, _ = list_directory(args.directory, relative_dir, suffixes, None, verbose=args.verbose)
+        if entry is None:
+            remove_directory(relative_dir)
+            continue
+
+        previous_entry = directories.get(relative_dir)
+        previous_entries.setdefault(relative_dir, previous_entry)
+        directories[relative_dir] = entry
+
+        previous_subdirectories = set(previous_entry["subdirectories"]) if previous_entry is not None else set()
+        for subdirectory in previous_subdirectories - set(entry["subdirectories"]):
+            remove_directory(os.path.join(relative_dir, subdirectory))
+        for subdirectory in entry["subdirectories"]:
+            subdirectory = os.path.join(relative_dir, subdirectory)
+            if subdirectory not in directories:
+                relative_dirs_to_list.append(subdirectory)
+
+        if previous_entry != entry:
+            state.scan_index["changed"] = True
+
+    if any(relative_dir not in directories for relative_dir in previous_entries):
+        state.scan_index["changed"] = True
+
+    return previous_entries
+
+
+def get_directory_pages(state, relative_dir, entry):
+    """Returns a dict that maps relative directory => [(data file type, relative data file path), ...] for the pages
+    made from the data files in the given scan index entry. Like at startup, data files in the top-level directory are
+    each a separate page.
+    """
+    if entry is None:
+        return {}
+
+    args = state.args
+    relative_directory_to_data_files, _ = group_data_files_by_directory(
+        [os.path.join(relative_dir, filename) for filename in entry["files"]], args.include, args.exclude)
+
+    return dict(relative_directory_to_data_files)
+
+
+def find_changed_directories(state):
+    """Without filesystem events, finds the directories that changed since the last check by comparing the mtimes of
+    all directories and flipbook_metadata.json files with those in the scan index. Files are only listed in directories
+    whose mtime changed.
+    """
+    args = state.args
+    scan_index = state.scan_index
+    previous_directories = scan_index["directories"]
+    directories, _ = scan_directory_tree(
+        args.directory,
+        suffixes=tuple(scan_index["suffixes"]),
+        keywords_to_exclude=scan_index.get("excluded_keywords", []),
+        previous_directories=previous_directories,
+        num_threads=args.scan_threads,
+        verbose=args.verbose > 1)
+
+    # directories whose mtime didn't change keep their previous entry
+    changed_relative_dirs = {
+        relative_dir for relative_dir, entry in directories.items() if previous_directories.get(relative_dir) is not entry
+    }
+    changed_relative_dirs.update(set(previous_directories) - set(directories))
+
+    # editing a flipbook_metadata.json file in place doesn't change the mtime of its directory
+    for metadata_json_path, cached_entry in scan_index["metadata_json_files"].items():
+        try:
+            mtime = os.path.getmtime(os.path.join(args.directory, metadata_json_path))
+        except OSError:
+            mtime = None
+        if mtime != cached_entry["mtime"]:
+            changed_relative_dirs.add(os.path.dirname(metadata_json_path))
+
+    return changed_relative_dirs
+
+
+def apply_changes(state, changed_relative_dirs):
+    """Lists the given directories again, and replaces their pages in the list of pages and their metadata.
+
+    Args:
+        state (FlipBookState): the server state to update
+        changed_relative_dirs (iterable): the directories that changed, relative to the top-level directory
+
+    Returns:
+        bool: True if any pages or their metadata changed
+    """
+    args = state.args
+    previous_entries = update_scan_index_directories(state, changed_relative_dirs)
+
+    # the pages made from the data files in the changed directories, before and after the change
+    previous_pages = {}
+    pages = {}
+    for relative_dir, previous_entry in previous_entries.items():
+        previous_pages.update(get_directory_pages(state, relative_dir, previous_entry))
+        pages.update(get_directory_pages(state, relative_dir, state.scan_index["directories"].get(relative_dir)))
+
+    # parse only the metadata json files of these pages. The scan index caches the others.
+    metadata_json_cache = state.scan_index["metadata_json_files"]
+    metadata_json_paths = [
+        data_file_path for relative_dir, data_files_list in list(previous_pages.items()) + list(pages.items())
+        for data_file_type, data_file_path in data_files_list if data_file_type == METADATA_JSON_FILE_TYPE
+    ]
+    previous_mtimes = {path: metadata_json_cache[path]["mtime"] for path in metadata_json_paths
+                       if path in metadata_json_cache}
+    metadata_columns, relative_directory_to_metadata = get_relative_directory_to_metadata(
+        args.directory, list(pages.items()), verbose=args.verbose > 1, metadata_json_cache=metadata_json_cache,
+        print_summary=False, num_threads=args.scan_threads, keys_to_keep=state.lazy_metadata_keys)
+    current_metadata_json_paths = {
+        data_file_path for data_files_list in pages.values()
+        for data_file_type, data_file_path in data_files_list if data_file_type == METADATA_JSON_FILE_TYPE
+    }
+    for path in metadata_json_paths:
+        if path not in current_metadata_json_paths:
+            metadata_json_cache.pop(path, None)
+        if previous_mtimes.get(path) != metadata_json_cache.get(path, {}).get("mtime"):
+            state.scan_index["changed"] = True
+
+    if state.scan_index_file_exists:
+        write_scan_index_if_changed(state.scan_index_path, state.scan_index)
+
+    # build a new metadata dict with the metadata of the changed pages replaced
+    affected_relative_dirs = set(previous_pages) | set(pages)
+    previous_relative_directory_to_metadata = state.relative_directory_to_metadata
+    new_relative_directory_to_metadata = dict(previous_relative_directory_to_metadata)
+    for relative_dir in affected_relative_dirs:
+        metadata = relative_directory_to_metadata.get(relative_dir)
+        if relative_dir in state.relative_directory_to_metadata_from_table:
+            metadata = dict(metadata or {})
+            metadata.update(state.relative_directory_to_metadata_from_table[relative_dir])
+        if metadata is not None:
+            new_relative_directory_to_metadata[relative_dir] = metadata
+        else:
+            new_relative_directory_to_metadata.pop(relative_dir, None)
+
+    pages_changed = previous_pages != pages
+    relative_dirs_with_changed_metadata = {
+        relative_dir for relative_dir in affected_relative_dirs
+        if previous_relative_directory_to_metadata.get(relative_dir) != new_relative_directory_to_metadata.get(relative_dir)
+    }
+    if not pages_changed and not relative_dirs_with_changed_metadata:
+        return False
+
+    new_metadata_columns = list(state.metadata_columns)
+    new_metadata_columns += [column for column in metadata_columns if column not in new_metadata_columns]
+    state.metadata_columns = new_metadata_columns
+    state.relative_directory_to_metadata = new_relative_directory_to_metadata
+    state.relative_directories_with_full_metadata = state.relative_directories_with_full_metadata - affected_relative_dirs
+
+    # build a new list of pages with the changed pages replaced. The page index of the current list is used to find
+    # the positions of the previous pages.
+    previous_page_set = state.pages
+    previous_relative_directory_to_data_files_list, previous_page_index = previous_page_set
+    relative_directory_to_data_files_list = previous_relative_directory_to_data_files_list
+    if pages_changed or args.sort_by:
+        positions = [previous_page_index.get_position(relative_dir) for relative_dir in previous_pages]
+        relative_directory_to_data_files_list = list(previous_relative_directory_to_data_files_list)
+        for position in sorted((position for position in positions if position is not None), reverse=True):
+            del relative_directory_to_data_files_list[position]
+
+        if args.sort_by:
+            # pages are sorted by metadata or form response values, which may have changed too. Like at startup, pages
+            # with equal values are kept in relative directory order.
+            relative_directory_to_data_files_list = state.sort_relative_directory_to_data_files_list(
+                sorted(relative_directory_to_data_files_list + list(pages.items()), key=lambda page: page[0]))
+        else:
+            # the list is sorted by relative directory, and each relative directory is only in it once
+            for page in sorted(pages.items()):
+                bisect.insort(relative_directory_to_data_files_list, page)
+
+    # handlers use positions from the page index in its own list, so the new list and its new page index are published
+    # together in one assignment
+    page_set = PageSet.create(relative_directory_to_data_files_list, state.get_column_values)
+    state.pages = page_set
+
+    if pages_changed or page_set.relative_directory_to_data_files_list != previous_relative_directory_to_data_files_list:
+        # page numbers and links to the previous and next pages may have changed
+        invalidate_all_pages()
+    else:
+        for relative_dir in relative_dirs_with_changed_metadata:
+            invalidate_page(relative_dir)
+
+    if pages_changed:
+        print(f"Directory changed: updated the list of pages from {len(previous_relative_directory_to_data_files_list)} "
+              f"to {len(page_set.relative_directory_to_data_files_list)} pages")
+    else:
+        print(f"Directory changed: updated the metadata of {len(relative_dirs_with_changed_metadata)} page(s)")
+
+    return True
+
+
+def is_ignored_path(args, path, is_directory):
+    """Returns True for paths whose changes can't affect the list of pages, such as hidden files, the form responses
+    table or its journal, and paths that are skipped by the --include and --exclude keywords the same way as when the
+    directory tree is scanned at startup. Like at startup, a directory is only skipped if it contains an --exclude
+    keyword, since paths inside it may still contain the --include keywords.
+    """
+    relative_path = get_relative_dir(args, path)
+    if any(part.startswith(".") for part in relative_path.split(os.sep)):
+        return True
+
+    if get_excluded_keyword_matches(relative_path, args.exclude):
+        return True
+
+    if is_directory:
+        return False
+
+    if not relative_path.endswith(DATA_FILE_SUFFIXES) or get_included_keyword_misses(relative_path, args.include):
+        return True
+
+    filename = os.path.basename(relative_path)
+    if args.form_responses_table and filename.startswith(os.path.basename(args.form_responses_table)):
+        return True
+
+    return filename.startswith(os.path.basename(args.index_file))
+
+
+def get_relative_dir(args, path):
+    relative_dir = os.path.relpath(path, args.directory)
+    return "" if relative_dir == os.curdir else relative_dir
+
+
+def create_watchdog_observer(args, changed_directories):
+    """Returns a started watchdog Observer that adds the directories where relevant files or subdirectories changed to
+    changed_directories, or None if the 'watchdog' package isn't installed.
+    """
+    try:
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+    except ImportError:
+        return None
+
+    class EventHandler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            # directory 'modified' events are redundant with the events for the files inside them
+            if event.event_type not in ("created", "deleted", "modified", "moved") or (
+                    event.is_directory and event.event_type == "modified"):
+                return
+
+            relative_dirs = set()
+            for path in event.src_path, getattr(event, "dest_path", None):
+                if not path or is_ignored_path(args, path, event.is_directory):
+                    continue
+                if event.is_directory:
+                    # the directory's own entry is removed if it was deleted or moved away, and its parent directory's
+                    # list of subdirectories changed
+                    relative_dirs.add(get_relative_dir(args, path))
+                relative_dirs.add(os.path.dirname(get_relative_dir(args, path)))
+
+            if not relative_dirs:
+                return
+            if args.verbose > 1:
+                print(f"Filesystem event: {event.event_type} {event.src_path}")
+            changed_directories.add(relative_dirs)
+
+    observer = Observer()
+    observer.daemon = True
+    observer.schedule(EventHandler(), args.directory, recursive=True)
+    observer.start()
+
+    return observer
+
+
+def watch_loop(state, changed_directories, use_watchdog):
+    args = state.args
+    while True:
+        try:
+            if use_watchdog:
+                changed_directories.wait()
+                time.sleep(WATCHDOG_EVENT_DELAY)
+                changed_relative_dirs = changed_directories.pop_all()
+            else:
+                time.sleep(args.watch_interval)
+                changed_relative_dirs = find_changed_directories(state)
+
+            if changed_relative_dirs:
+                apply_changes(state, changed_relative_dirs)
+        except Exception as e:
+            print(f"ERROR: unable to update pages after a change in {args.directory}: {type(e).__name__} {e}")
+
+
+def start_watching(state):
+    """Starts a background thread that updates the list of pages when files are added, changed or deleted."""
+    global WATCH_THREAD
+    if WATCH_THREAD is not None:
+        return
+
+    args = state.args
+    changed_directories = ChangedDirectories()
+    try:
+        observer = create_watchdog_observer(args, changed_directories)
+    except Exception as e:
+        print(f"WARNING: unable to watch {args.directory} for filesystem events: {e}. Checking for changes every "
+              f"{args.watch_interval} seconds instead.")
+        observer = None
+
+    if observer is not None:
+        print(f"Watching {args.directory} for changes")
+    else:
+        print(f"Checking {args.directory} for changes every {args.watch_interval} seconds")
+
+    WATCH_THREAD = threading.Thread(
+        target=watch_loop, args=(state, changed_directories, observer is not None), daemon=True)
+    WATCH_THREAD.start()
@@ -23,7 +23,6 @@ install_requires = [
     "openpyxl>=3.1.1",
     "pandas>=2.0.3",
     "requests>=2.31.0",
-    "wcmatch>=8.4.1",
     "xlrd>=2.0.1",
     "xlwt>=1.3.0",
 
@@ -39,6 +38,10 @@ setup(
     description="Starts a simple image server that lets you quickly flip through image files from a local directory "
                 "using your web browser and optionally answering customizable questions about each one",
     install_requires=install_requires,
+    extras_require={
+        # reading and writing .parquet and .feather tables
+        "parquet": ["pyarrow>=12.0.0"],
+    },
     entry_points = {
         'console_scripts': [
             'flipbook = flipbook:main',